@@ -0,0 +1,28 @@
+import axios, { AxiosError, AxiosResponse } from 'axios';
+import { API_URL } from '@/utils/config';
+import { BatchOpType, BatchResultType } from '@/components/types';
+
+const batchApiUrl = API_URL + 'batch';
+
+const run = (ops: BatchOpType[]): Promise<BatchResultType[]> =>
+  new Promise((resolve, reject) => {
+    axios
+      .post(
+        batchApiUrl,
+        { ops },
+        {
+          responseType: 'text',
+        }
+      )
+      .then((resp: AxiosResponse) => {
+        const lines: string[] = resp.data.split('\n').filter(Boolean);
+        resolve(lines.map((line) => JSON.parse(line)));
+      })
+      .catch((err: AxiosError) => reject(err));
+  });
+
+const batchClient = {
+  run,
+};
+
+export default batchClient;
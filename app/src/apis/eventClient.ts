@@ -0,0 +1,21 @@
+import { API_URL } from '@/utils/config';
+import { EventType } from '@/components/types';
+
+const eventApiUrl = API_URL + 'events';
+
+const watch = (
+  path: string,
+  onEvent: (event: EventType) => void
+): EventSource => {
+  const source = new EventSource(
+    `${eventApiUrl}?path=${encodeURIComponent(path)}`
+  );
+  source.onmessage = (msg: MessageEvent) => onEvent(JSON.parse(msg.data));
+  return source;
+};
+
+const eventClient = {
+  watch,
+};
+
+export default eventClient;
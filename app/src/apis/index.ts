@@ -1,2 +1,4 @@
 export { default as fileClient } from './fileClient';
 export { default as dirClient } from './dirClient';
+export { default as batchClient } from './batchClient';
+export { default as eventClient } from './eventClient';
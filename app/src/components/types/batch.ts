@@ -0,0 +1,21 @@
+export interface BatchOpType {
+  // Operation, one of 'retrieve', 'store', 'delete', 'mkdir', 'rmdir'
+  op: string;
+  // File path
+  path: string;
+}
+
+export interface BatchResultType {
+  // Index of the operation in the batch
+  index: number;
+  // Operation
+  op: string;
+  // File path
+  path: string;
+  // Whether the operation succeeded
+  ok: boolean;
+  // Operation result
+  msg: string;
+}
+
+export default BatchOpType;
@@ -0,0 +1,10 @@
+export interface EventType {
+  // Change type, one of 'create', 'modify', 'delete'
+  type: string;
+  // File path, relative to server root
+  path: string;
+  // Whether the file is a directory
+  isDir: boolean;
+}
+
+export default EventType;
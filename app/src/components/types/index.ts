@@ -1,3 +1,5 @@
 export { default as FileType } from './file';
 export { default as ReqType } from './request';
 export { default as RespType } from './response';
+export { default as BatchOpType, BatchResultType } from './batch';
+export { default as EventType } from './event';
@@ -0,0 +1,189 @@
+'''
+Helpers shared by the benchmarks, which run live processes of Naive-FTP
+in a scratch working directory, at the default control port 2121.
+'''
+
+import io
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from typing import ContextManager, List, Sequence
+
+repo_dir: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from naive_ftp.client import client  # noqa: E402
+
+
+class live_process():
+    '''
+    A Naive-FTP process started by 'python -m <module>', with its console on a pipe
+    and its output in a log file of the working directory.
+    '''
+
+    def __init__(self, module: str, args: Sequence[str] = (), work_dir: str = None, console: bool = True) -> None:
+        '''
+        Initialize live process.
+
+        :param module: module to run, e.g. 'naive_ftp.server.server'
+        :param args: command line arguments
+        :param work_dir: working directory, a new scratch directory if None
+        :param console: whether the process reads commands from its console,
+                        otherwise it is terminated to stop
+        '''
+
+        # Properties
+        self.module: str = module
+        self.args: List[str] = list(args)
+        self.work_dir: str = work_dir or tempfile.mkdtemp(prefix='naive_ftp_bench_')
+        self.log_path: str = os.path.join(self.work_dir, module.rsplit('.', 1)[-1] + '.log')
+        self.has_console: bool = console
+        self.proc: subprocess.Popen = None
+
+    def start(self, port: int, timeout: float = 30.0) -> None:
+        '''
+        Start the process, and wait until it accepts connections.
+
+        :param port: port to wait for, at the host name for the server, or at 127.0.0.1
+        :param timeout: seconds to wait
+        '''
+
+        env = dict(os.environ, PYTHONPATH=repo_dir)
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', self.module, *self.args],
+            cwd=self.work_dir,
+            stdin=subprocess.PIPE,
+            stdout=open(self.log_path, 'w'),
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        host = client.server_host if port == client.server_port else '127.0.0.1'
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with socket.create_connection((host, port), timeout=1.0) as s:
+                    if port != client.server_port or s.recv(64).startswith(b'220'):
+                        return
+            except OSError:
+                pass
+            if self.proc.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f'{self.module} failed to start, see {self.log_path}')
+            time.sleep(0.2)
+
+    def console(self, line: str) -> None:
+        '''
+        Type a line in the console of the process.
+
+        :param line: the line
+        '''
+
+        self.proc.stdin.write(f'{line}\n'.encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        '''
+        Stop the process, quitting from the console first if any.
+
+        :param timeout: seconds to wait before killed
+        '''
+
+        if not self.proc or self.proc.poll() is not None:
+            return
+        try:
+            if self.has_console:
+                self.console('q')
+            else:
+                self.proc.terminate()
+            self.proc.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+
+def make_server_dir(work_dir: str) -> str:
+    '''
+    Create the server root and the local directory in a working directory.
+
+    Return the server root.
+
+    :param work_dir: the working directory
+    '''
+
+    server_dir = os.path.join(work_dir, 'server_files')
+    os.makedirs(server_dir, exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'local_files'), exist_ok=True)
+    return server_dir
+
+
+def make_file(path: str, size: int) -> None:
+    '''
+    Create a file of random content.
+
+    :param path: path of the file
+    :param size: size in bytes
+    '''
+
+    with open(path, 'wb') as f:
+        while size > 0:
+            chunk = os.urandom(min(size, 1 << 20))
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def remove_dir(path: str) -> None:
+    '''
+    Remove a scratch directory.
+
+    :param path: the directory
+    '''
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def quiet() -> ContextManager:
+    '''
+    Return a context in which logs of clients are dropped, not to mix with reports.
+    '''
+
+    return redirect_stdout(io.StringIO())
+
+
+def jain_index(values: Sequence[float]) -> float:
+    '''
+    Return Jain's fairness index of shares: 1.0 if all equal, 1/n if one takes all.
+
+    :param values: the shares
+    '''
+
+    total = sum(values)
+    squares = sum(v * v for v in values)
+    return total * total / (len(values) * squares) if squares else 1.0
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    '''
+    Return a percentile of values, by linear interpolation.
+
+    :param values: the values
+    :param p: percentile in 0-100
+    '''
+
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method='inclusive')[min(max(int(p), 1), 99) - 1]
+
+
+def mib(size: float) -> str:
+    '''
+    Return a size in MiB for reports.
+
+    :param size: size in bytes
+    '''
+
+    return f'{size / (1 << 20):.2f}'
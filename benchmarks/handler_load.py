@@ -0,0 +1,156 @@
+'''
+Benchmark the client handlers: concurrent API requests to the synchronous
+handler on waitress and to the asynchronous one on Hypercorn, both in front
+of a live server.
+
+Usage: python benchmarks/handler_load.py [-c CONCURRENCY ...] [-t SECONDS] [--handlers run run_async]
+
+Workloads:
+- dir: GET /api/dir?path=/, listing a directory of 20 files
+- file: GET /api/file?path=/small.bin, downloading a 16 KiB file to the handler
+
+Each client keeps its connection alive and sends a request as soon as the
+previous one is answered, as a web user of its own. For each handler,
+workload and concurrency, report requests per second, latency percentiles,
+and requests failed or timed out.
+'''
+
+import argparse
+import asyncio
+import os
+import time
+from typing import Dict, List, Tuple
+from common import client, live_process, make_file, make_server_dir, percentile, remove_dir
+
+handler_port: int = 5000
+request_timeout: float = 30.0
+
+paths: Dict[str, str] = {
+    'dir': '/api/dir?path=/',
+    'file': '/api/file?path=/small.bin',
+}
+
+
+async def request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path: str, user: str) -> int:
+    '''
+    Send a GET request on a kept alive connection, and return the status code.
+
+    :param reader: reader of the connection
+    :param writer: writer of the connection
+    :param path: request path with its query
+    :param user: web user identifier
+    '''
+
+    writer.write(
+        f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{handler_port}\r\n'
+        f'X-Naive-FTP-User: {user}\r\n\r\n'.encode('ascii')
+    )
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    headers = dict(line.lower().split(': ', 1) for line in head[1:] if ': ' in line)
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    return int(head[0].split()[1])
+
+
+async def user(
+    index: int, path: str, ready: asyncio.Event, stop: asyncio.Event, latencies: List[float], errors: List[int]
+) -> None:
+    '''
+    Send requests one after another until stopped, recording those sent
+    after ready is set.
+
+    :param index: index of the user
+    :param path: request path with its query
+    :param ready: set when measuring
+    :param stop: set when finished
+    :param latencies: seconds of each successful request
+    :param errors: count of failed requests, in its only item
+    '''
+
+    conn = None
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            if not conn:
+                conn = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', handler_port), request_timeout)
+            status = await asyncio.wait_for(request(*conn, path, f'bench{index}'), request_timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+            status = None
+        if status is None and conn:
+            conn[1].close()
+            conn = None
+        if ready.is_set() and not stop.is_set():
+            if status == 200:
+                latencies.append(time.monotonic() - start)
+            else:
+                errors[0] += 1
+    if conn:
+        conn[1].close()
+
+
+async def run_load(path: str, concurrency: int, warmup: float, duration: float) -> Tuple[List[float], int]:
+    '''
+    Run concurrent users, and return the latencies of successful requests
+    and the number of failed ones while measuring.
+
+    :param path: request path with its query
+    :param concurrency: number of users
+    :param warmup: seconds before measuring
+    :param duration: seconds to measure
+    '''
+
+    ready, stop = asyncio.Event(), asyncio.Event()
+    latencies: List[float] = []
+    errors = [0]
+    tasks = []
+    for i in range(concurrency):
+        tasks.append(asyncio.create_task(user(i, path, ready, stop, latencies, errors)))
+        await asyncio.sleep(0.005)  # connecting gradually, not to overflow the listen backlog
+    await asyncio.sleep(warmup)
+    ready.set()
+    await asyncio.sleep(duration)
+    stop.set()
+    await asyncio.wait(tasks, timeout=request_timeout)
+    return latencies, errors[0]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Naive-FTP client handler load test')
+    parser.add_argument('-c', '--concurrency', type=int, nargs='+', default=[10, 100, 300],
+                        help='concurrent users (default: 10 100 300)')
+    parser.add_argument('-t', '--duration', type=float, default=5.0, help='seconds measured (default: 5)')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds before measuring (default: 2)')
+    parser.add_argument('--handlers', nargs='+', choices=('run', 'run_async'), default=['run', 'run_async'],
+                        help='handlers to test, by module name (default: run run_async)')
+    args = parser.parse_args()
+
+    server = live_process('naive_ftp.server.server')
+    server_dir = make_server_dir(server.work_dir)
+    for i in range(19):
+        make_file(os.path.join(server_dir, f'file{i}.bin'), 1024)
+    make_file(os.path.join(server_dir, 'small.bin'), 16 << 10)
+    try:
+        server.start(client.server_port)
+        print(f'{args.duration:g}s each, {os.cpu_count()} CPUs, latencies in ms')
+        print(f'{"handler":10} {"workload":8} {"users":>5} {"req/s":>8} {"p50":>8} {"p99":>8} {"errors":>6}')
+        for module in args.handlers:
+            handler = live_process(f'naive_ftp.client_handler.{module}', work_dir=server.work_dir, console=False)
+            try:
+                handler.start(handler_port)
+                for workload, path in paths.items():
+                    for concurrency in args.concurrency:
+                        latencies, errors = asyncio.run(run_load(path, concurrency, args.warmup, args.duration))
+                        print(
+                            f'{module:10} {workload:8} {concurrency:>5} {len(latencies) / args.duration:>8.1f} '
+                            f'{percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 99) * 1000:>8.1f} '
+                            f'{errors:>6}'
+                        )
+            finally:
+                handler.stop()
+    finally:
+        server.stop()
+        remove_dir(server.work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+'''
+Benchmark bandwidth shaping: sessions downloading at once from a live server,
+under each scope of the rate limiter, should share the rate evenly.
+
+Usage: python benchmarks/rate_fairness.py [-c CLIENTS] [-t SECONDS] [--rate BYTES_PER_SECOND]
+
+For each scenario, report the aggregate throughput, the throughput of the
+slowest and the fastest session, and Jain's fairness index (1.0 if all equal).
+'''
+
+import argparse
+import os
+import time
+from threading import Barrier, Event, Thread
+from typing import List, Tuple
+from common import client, jain_index, live_process, make_file, make_server_dir, mib, quiet, remove_dir
+
+
+def download(c: client.ftp_client, counts: List[int], index: int, ready: Barrier, stop: Event) -> None:
+    '''
+    Download a large file over and over in a session, counting received bytes.
+
+    :param c: the connected client
+    :param counts: received bytes of each session
+    :param index: index of the session
+    :param ready: passed once all started
+    :param stop: set when finished
+    '''
+
+    ready.wait()
+    while not stop.is_set():
+        stream = c.retrieve_stream('/big.bin')
+        if not stream:
+            return
+        for data in stream:
+            counts[index] += len(data)
+            if stop.is_set():
+                stream.close()
+                break
+    c.close_ctrl_conn()
+
+
+def run_scenario(clients: int, warmup: float, duration: float) -> List[float]:
+    '''
+    Run sessions downloading at once, and return the throughput of each.
+
+    :param clients: number of sessions
+    :param warmup: seconds before measuring
+    :param duration: seconds to measure
+    '''
+
+    # Connected one by one: a burst would overflow the listen backlog,
+    # and connections retried by SYN retransmission would time out
+    conns = [client.ftp_client(cli_mode=False) for _ in range(clients)]
+    for c in conns:
+        c.buffer_size = 65536
+        if not c.open():
+            raise RuntimeError('session failed to connect')
+    counts = [0] * clients
+    ready = Barrier(clients + 1)
+    stop = Event()
+    threads = [Thread(target=download, args=(c, counts, i, ready, stop)) for i, c in enumerate(conns)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    time.sleep(warmup)
+    start, start_counts = time.monotonic(), list(counts)
+    time.sleep(duration)
+    elapsed, end_counts = time.monotonic() - start, list(counts)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return [(end - begin) / elapsed for begin, end in zip(start_counts, end_counts)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Naive-FTP rate limiter fairness benchmark')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='concurrent sessions (default: 8)')
+    parser.add_argument('-t', '--duration', type=float, default=5.0, help='seconds measured (default: 5)')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds before measuring (default: 1)')
+    parser.add_argument('--rate', type=int, default=16 << 20, help='shared rate in B/s (default: 16 MiB/s)')
+    args = parser.parse_args()
+
+    # (name, console commands, expected aggregate rate or None)
+    per_session = args.rate // args.clients
+    scenarios: List[Tuple[str, List[str], float]] = [
+        ('unlimited', [], None),
+        (f'global {mib(args.rate)} MiB/s', [f'rate global {args.rate}'], args.rate),
+        (f'host {mib(args.rate)} MiB/s', [f'rate host {args.rate}'], args.rate),
+        (f'session {mib(per_session)} MiB/s', [f'rate session {per_session}'], per_session * args.clients),
+    ]
+
+    server = live_process('naive_ftp.server.server')
+    make_file(os.path.join(make_server_dir(server.work_dir), 'big.bin'), 256 << 20)
+    try:
+        server.start(client.server_port)
+        print(f'{args.clients} sessions, {args.duration:g}s each, {os.cpu_count()} CPUs, rates in MiB/s')
+        print(f'{"scenario":24} {"expected":>9} {"total":>9} {"min":>8} {"max":>8} {"jain":>6}')
+        for name, cmds, expected in scenarios:
+            for scope in ('global', 'host', 'session'):
+                server.console(f'rate {scope} 0')
+            for cmd in cmds:
+                server.console(cmd)
+            time.sleep(0.2)
+            with quiet():
+                rates = run_scenario(args.clients, args.warmup, args.duration)
+            print(
+                f'{name:24} {mib(expected) if expected else "-":>9} {mib(sum(rates)):>9} '
+                f'{mib(min(rates)):>8} {mib(max(rates)):>8} {jain_index(rates):>6.3f}'
+            )
+    finally:
+        server.stop()
+        remove_dir(server.work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+'''
+Benchmark multi-process mode: throughput of a live server started with
+different numbers of workers, under load from several client processes.
+
+Usage: python benchmarks/worker_scaling.py [-w WORKERS ...] [-p PROCESSES] [-c SESSIONS] [-t SECONDS]
+
+Workloads:
+- size: 'SIZE' commands, i.e. the control channel and path resolution only
+- retr: downloads of a small file, with a data connection each
+
+For each number of workers, report operations per second of each workload.
+The CPUs of the machine are shared by the server and the clients, so scaling
+can only be seen with more CPUs than workers plus client processes.
+'''
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+from threading import Barrier, Event, Thread
+from typing import Callable, Dict, List
+from common import client, live_process, make_file, make_server_dir, quiet, remove_dir
+
+small_size: int = 16 << 10
+
+
+def size_op(c: client.ftp_client) -> bool:
+    return c.query_size('/small.bin') == small_size
+
+
+def retr_op(c: client.ftp_client) -> bool:
+    stream = c.retrieve_stream('/small.bin')
+    return stream is not None and sum(len(data) for data in stream) == small_size
+
+
+workloads: Dict[str, Callable[[client.ftp_client], bool]] = {'size': size_op, 'retr': retr_op}
+
+
+def load(workload: str, sessions: int, warmup: float, duration: float, results: mp.Queue) -> None:
+    '''
+    Run sessions in a client process, each repeating an operation, and put
+    the number of operations done and failed while measuring.
+
+    :param workload: name of the workload
+    :param sessions: number of sessions
+    :param warmup: seconds before measuring
+    :param duration: seconds to measure
+    :param results: where (done, failed) is put
+    '''
+
+    op = workloads[workload]
+    done, failed = [0] * sessions, [0] * sessions
+    measuring, stop = Event(), Event()
+
+    def run(c: client.ftp_client, index: int, ready: Barrier) -> None:
+        ready.wait()
+        while not stop.is_set():
+            ok = op(c)
+            if measuring.is_set() and not stop.is_set():
+                if ok:
+                    done[index] += 1
+                else:
+                    failed[index] += 1
+        c.close_ctrl_conn()
+
+    with quiet():
+        conns = [client.ftp_client(cli_mode=False) for _ in range(sessions)]
+        for c in conns:
+            if not c.open():
+                raise RuntimeError('session failed to connect')
+        ready = Barrier(sessions + 1)
+        threads = [Thread(target=run, args=(c, i, ready)) for i, c in enumerate(conns)]
+        for thread in threads:
+            thread.start()
+        ready.wait()
+        time.sleep(warmup)
+        measuring.set()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    results.put((sum(done), sum(failed)))
+
+
+def run_workload(workload: str, args: argparse.Namespace) -> List[float]:
+    '''
+    Run the client processes of a workload, and return operations per second
+    done and failed.
+
+    :param workload: name of the workload
+    :param args: command line arguments
+    '''
+
+    results = mp.Queue()
+    procs = [
+        mp.Process(target=load, args=(workload, args.sessions, args.warmup, args.duration, results))
+        for _ in range(args.processes)
+    ]
+    for proc in procs:
+        proc.start()
+    counts = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return [sum(done for done, _ in counts) / args.duration, sum(failed for _, failed in counts) / args.duration]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Naive-FTP worker scaling benchmark')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts (default: 1 2 4)')
+    parser.add_argument('-p', '--processes', type=int, default=4, help='client processes (default: 4)')
+    parser.add_argument('-c', '--sessions', type=int, default=4, help='sessions per client process (default: 4)')
+    parser.add_argument('-t', '--duration', type=float, default=5.0, help='seconds measured (default: 5)')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds before measuring (default: 1)')
+    args = parser.parse_args()
+
+    print(
+        f'{args.processes} client processes x {args.sessions} sessions, {args.duration:g}s each, '
+        f'{os.cpu_count()} CPUs, operations/s'
+    )
+    print(f'{"workers":>7} ' + ' '.join(f'{name:>10} {"failed":>7}' for name in workloads))
+    for workers in args.workers:
+        server = live_process('naive_ftp.server.server', ['-w', str(workers)])
+        make_file(os.path.join(make_server_dir(server.work_dir), 'small.bin'), small_size)
+        try:
+            server.start(client.server_port)
+            time.sleep(1.0)  # until all workers listen
+            rates = [run_workload(name, args) for name in workloads]
+        finally:
+            server.stop()
+            remove_dir(server.work_dir)
+        print(f'{workers:>7} ' + ' '.join(f'{done:>10.0f} {failed:>7.1f}' for done, failed in rates))
+
+
+if __name__ == '__main__':
+    main()
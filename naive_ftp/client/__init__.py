@@ -0,0 +1,4 @@
+from naive_ftp.client.async_client import async_ftp_client
+
+# Library API alias
+AsyncFtpClient = async_ftp_client
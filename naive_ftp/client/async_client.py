@@ -0,0 +1,730 @@
+import asyncio
+import os
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Iterable, List, Tuple
+from naive_ftp.client import client
+from naive_ftp.client.client import parse_stat, to_dict
+from naive_ftp.utils import log
+
+
+class async_ftp_session():
+    '''
+    Naive-FTP non-blocking client session, using a single control connection
+    '''
+
+    def __init__(self) -> None:
+        '''
+        Initialize session.
+        '''
+
+        # Properties
+        self.buffer_size: int = 65536
+        self.ctrl_timeout_duration: float = 3.0
+        self.data_timeout_duration: float = 3.0
+        self.local_dir: str = os.path.realpath('local_files')
+
+        # Current working directory on server, and the one when checked out from a pool
+        self.cwd_path: str = '/'
+        self.checkout_cwd: str = '/'
+
+        # Control connection, and True if closed by the server before a command, e.g. on restart
+        self.ctrl_reader: asyncio.StreamReader = None
+        self.ctrl_writer: asyncio.StreamWriter = None
+        self.refused: bool = False
+
+    async def check_resp(self, code: int) -> Tuple[bool, int, str]:
+        '''
+        Get a response from the server, and check its status code.
+
+        Return the check result, the responded status code and the response message.
+        The result is True if the status code is expected, otherwise False.
+
+        :param code: expected status code
+        '''
+
+        try:
+            raw_resp = await asyncio.wait_for(
+                self.ctrl_reader.readuntil(b'\r\n'),
+                self.ctrl_timeout_duration,
+            )
+            resp = raw_resp.decode('utf-8').strip('\r\n')
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, AttributeError):
+            # A late response would be taken for the next command's, so never reuse the session
+            await self.close()
+            return False, 0, None
+
+        try:
+            resp_code, resp_msg = resp.split(None, 1)
+        except ValueError:
+            log('error', f'Invalid response: {resp}')
+            await self.close()
+            return False, 0, None
+        if resp_code == '421' and code != 421:  # the command was not run
+            self.refused = True
+            await self.close()
+        return resp_code == str(code), resp_code, resp_msg
+
+    async def send_cmd(self, cmd: str) -> bool:
+        '''
+        Send a command to server.
+
+        Return True if succeeded.
+
+        :param cmd: the command
+        '''
+
+        if not self.ctrl_writer:
+            return False
+        try:
+            self.ctrl_writer.write(f'{cmd}\r\n'.encode('utf-8'))
+            await self.ctrl_writer.drain()
+        except OSError:
+            await self.close()
+            return False
+        return True
+
+    async def open_data_conn(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        '''
+        Open data connection, after the server entered passive mode.
+
+        Return the reader and writer of data connection, or None if failed.
+        '''
+
+        expected, _, resp_msg = await self.check_resp(227)
+        if not expected:
+            return None
+        addr = re.search(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)', resp_msg)
+        if not addr:
+            log('error', f'Invalid response: {resp_msg}')
+            return None
+        data_addr = (
+            '.'.join(addr.group(1, 2, 3, 4)),
+            (int(addr.group(5)) << 8) + int(addr.group(6)),
+        )
+        try:
+            data_conn = await asyncio.wait_for(
+                asyncio.open_connection(*data_addr),
+                self.data_timeout_duration,
+            )
+        except (asyncio.TimeoutError, OSError) as e:
+            log('error', f'Data connection failed, error: {e}')
+            return None
+        if not (await self.check_resp(225))[0]:
+            data_conn[1].close()
+            return None
+        return data_conn
+
+    async def start_transfer(self, cmd: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        '''
+        Send a command which transfers data, and open data connection.
+
+        Return the reader and writer of data connection, or None if failed.
+
+        :param cmd: the command
+        '''
+
+        if not await self.send_cmd(cmd):
+            return None
+        expected, _, resp_msg = await self.check_resp(150)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        return await self.open_data_conn()
+
+    async def open(self) -> bool:
+        '''
+        Open a connection to server, if not connected.
+
+        Return True if succeeded.
+        '''
+
+        if self.ctrl_writer:
+            return True
+        self.refused = False
+        try:
+            self.ctrl_reader, self.ctrl_writer = await asyncio.wait_for(
+                asyncio.open_connection(client.server_host, client.server_port),
+                self.ctrl_timeout_duration,
+            )
+        except (asyncio.TimeoutError, OSError) as e:
+            log('error', f'Connection failed, error: {e}')
+            return False
+        if not (await self.check_resp(220))[0] or not await self.login():
+            await self.close()
+            return False
+        self.cwd_path = '/'
+        return True
+
+    async def login(self) -> bool:
+        '''
+        Log in with the user name and password of the client module, if set.
+
+        Return True if succeeded.
+        '''
+
+        if not client.username:
+            return True
+        if not await self.send_cmd(f'USER {client.username}'):
+            return False
+        expected, resp_code, resp_msg = await self.check_resp(331)
+        if resp_code == '230':  # no login required
+            return True
+        if expected:
+            self.ctrl_timeout_duration += client.login_timeout  # delayed if failed
+            try:
+                expected, resp_msg = await self.simple_cmd(f'PASS {client.password or ""}', 230)
+            finally:
+                self.ctrl_timeout_duration -= client.login_timeout
+        if not expected:
+            log('warn', resp_msg or 'Login failed.')
+        return expected
+
+    async def close(self) -> None:
+        '''
+        Close control connection.
+        '''
+
+        if self.ctrl_writer:
+            writer, self.ctrl_writer, self.ctrl_reader = self.ctrl_writer, None, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def ping(self) -> bool:
+        '''
+        Check connection to server. Ping!
+
+        Return True if connected.
+        '''
+
+        if not await self.send_cmd('PING'):
+            return False
+        return (await self.check_resp(220))[0]
+
+    async def ls(self, path: str = '.') -> list[dict]:
+        '''
+        List information of a file or directory.
+
+        Return the parsed file information list, or None if failed.
+
+        :param path: server path to the file or directory
+        '''
+
+        data_conn = await self.start_transfer(f'LIST {path}')
+        if not data_conn:
+            return None
+        reader, writer = data_conn
+        chunks = []
+        try:
+            while True:
+                data = await asyncio.wait_for(
+                    reader.read(self.buffer_size),
+                    self.data_timeout_duration,
+                )
+                if not data:
+                    break
+                chunks.append(data)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        finally:
+            writer.close()
+        infos = []
+        for resp in b''.join(chunks).decode('utf-8').strip('\r\n').split('\r\n'):
+            info = parse_stat(resp)
+            if info:
+                infos.append(to_dict(info))
+        return infos
+
+    async def iter_ls(self, path: str = '.') -> AsyncIterator[dict]:
+        '''
+        List information of a file or directory, yielding each entry as soon
+        as it is received.
+
+        The session is closed if the iteration is stopped early, as the server
+        may still respond to the unfinished listing.
+
+        :param path: server path to the file or directory
+        '''
+
+        data_conn = await self.start_transfer(f'LIST {path}')
+        if not data_conn:
+            return
+        reader, writer = data_conn
+        finished = False
+        try:
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.data_timeout_duration)
+                if not line:
+                    break
+                info = parse_stat(line.decode('utf-8').strip('\r\n'))
+                if info:
+                    yield to_dict(info)
+            finished = True
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
+            if not finished:
+                await self.close()
+
+    async def retrieve(self, path: str) -> str:
+        '''
+        Retrieve a file from server.
+
+        Return the location of the downloaded file if succeeded, otherwise return None.
+
+        :param path: server path to the file
+        '''
+
+        dst_path = os.path.join(self.local_dir, os.path.basename(path))
+        data_conn = await self.start_transfer(f'RETR {path}')
+        if not data_conn:
+            return None
+        reader, writer = data_conn
+        try:
+            with open(dst_path, 'wb') as dst_file:
+                while True:
+                    data = await asyncio.wait_for(
+                        reader.read(self.buffer_size),
+                        self.data_timeout_duration,
+                    )
+                    if not data:
+                        break
+                    dst_file.write(data)
+        except (asyncio.TimeoutError, OSError) as e:
+            log('warn', f'Failed to download file: {e}')
+            return None
+        finally:
+            writer.close()
+        return dst_path
+
+    async def store(self, path: str) -> bool:
+        '''
+        Store a file to server.
+
+        Return True if succeeded.
+
+        :param path: local path to the file
+        '''
+
+        src_path = os.path.realpath(os.path.join(self.local_dir, path.lstrip('/')))
+        if not os.path.isfile(src_path):
+            log('info', 'File not found.')
+            return False
+        expected, resp_msg = await self.simple_cmd(f'ALLO {os.path.getsize(src_path)}', 200)
+        if not expected:  # e.g. over quota
+            log('info', resp_msg)
+            return False
+        data_conn = await self.start_transfer(f'STOR {path}')
+        if not data_conn:
+            return False
+        _, writer = data_conn
+        try:
+            with open(src_path, 'rb') as src_file:
+                while True:
+                    data = src_file.read(self.buffer_size)
+                    if not data:
+                        break
+                    writer.write(data)
+                    await asyncio.wait_for(writer.drain(), self.data_timeout_duration)
+        except (asyncio.TimeoutError, OSError) as e:
+            log('warn', f'Failed to upload file: {e}')
+            return False
+        finally:
+            writer.close()
+        return True
+
+    async def simple_cmd(self, cmd: str, code: int) -> Tuple[bool, str]:
+        '''
+        Send a command without data transfer, and check its response.
+
+        Return the check result and the response message.
+
+        :param cmd: the command
+        :param code: expected status code
+        '''
+
+        if not await self.send_cmd(cmd):
+            return False, None
+        expected, _, resp_msg = await self.check_resp(code)
+        return expected, resp_msg
+
+    async def delete(self, path: str) -> bool:
+        '''
+        Delete a file from server.
+
+        Return True if succeeded.
+
+        :param path: server path to the file
+        '''
+
+        return (await self.simple_cmd(f'DELE {path}', 250))[0]
+
+    async def cwd(self, path: str = '/') -> bool:
+        '''
+        Change working directory.
+
+        Return True if succeeded.
+
+        :param path: server path to the destination
+        '''
+
+        expected, resp_msg = await self.simple_cmd(f'CWD {path}', 257)
+        if expected:
+            self.cwd_path = '/' + resp_msg.lstrip('/')
+        return expected
+
+    async def pwd(self) -> str:
+        '''
+        Print working directory.
+
+        Return current working directory, or None if failed.
+        '''
+
+        expected, resp_msg = await self.simple_cmd('PWD', 257)
+        return resp_msg if expected else None
+
+    async def mkdir(self, path: str) -> bool:
+        '''
+        Make a directory recursively.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        '''
+
+        return (await self.simple_cmd(f'MKD {path}', 257))[0]
+
+    async def rmdir(self, path: str, recursive: bool = False) -> bool:
+        '''
+        Remove a directory.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        :param recursive: remove recursively if True
+        '''
+
+        op = 'RMDA' if recursive else 'RMD'
+        return (await self.simple_cmd(f'{op} {path}', 250))[0]
+
+    async def rmdir_all(self, path: str) -> bool:
+        '''
+        Remove a directory recursively.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        '''
+
+        return await self.rmdir(path, recursive=True)
+
+
+class async_session_pool():
+    '''
+    A pool of non-blocking FTP sessions, shared by coroutines in an event loop.
+
+    Each user has its own working directory, which is restored on
+    whichever session the user checks out.
+    '''
+
+    def __init__(
+        self,
+        max_size: int = 32,
+        idle_timeout: float = 60.0,
+        check_interval: float = 5.0,
+    ) -> None:
+        '''
+        Initialize session pool.
+
+        :param max_size: maximum number of sessions
+        :param idle_timeout: seconds before an idle session is closed
+        :param check_interval: seconds of idle time before a session is
+                               pinged again on checkout
+        '''
+
+        # Properties
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self.check_interval: float = check_interval
+
+        # Sessions, idle ones are stored with their last used time
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(max_size)
+        self.idle: Deque[Tuple[async_ftp_session, float]] = deque()
+
+        # Working directory of each user
+        self.user_cwd: Dict[str, str] = {}
+
+    async def evict_idle(self) -> None:
+        '''
+        Close sessions which have been idle for too long.
+        '''
+
+        now = time.monotonic()
+        while self.idle and now - self.idle[0][1] > self.idle_timeout:
+            await self.idle.popleft()[0].close()
+
+    async def checkout(self, user: str) -> async_ftp_session:
+        '''
+        Check out a session for a user, with the user's working directory.
+
+        Return the session, or None if failed to connect.
+
+        :param user: user identifier
+        '''
+
+        await self.slots.acquire()
+        await self.evict_idle()
+        if self.idle:
+            session, last_used = self.idle.pop()  # most recently used
+            if time.monotonic() - last_used > self.check_interval and not await session.ping():
+                await session.close()
+        else:
+            session = async_ftp_session()
+        if not await session.open():
+            self.slots.release()
+            return None
+
+        cwd = self.user_cwd.get(user, '/')
+        if session.cwd_path != cwd and not await session.cwd(cwd):
+            await session.cwd('/')
+        session.checkout_cwd = cwd
+        return session
+
+    async def checkin(self, session: async_ftp_session, user: str) -> None:
+        '''
+        Return a session to the pool, and remember the user's working directory.
+
+        :param session: the session
+        :param user: user identifier
+        '''
+
+        if session.ctrl_writer:
+            if session.cwd_path != session.checkout_cwd:  # changed by this user
+                self.user_cwd[user] = session.cwd_path
+            self.idle.append((session, time.monotonic()))
+        self.slots.release()
+
+    @asynccontextmanager
+    async def session(self, user: str) -> AsyncIterator[async_ftp_session]:
+        '''
+        Check out a session for an async with block, yielding None if unavailable.
+
+        :param user: user identifier
+        '''
+
+        session = await self.checkout(user)
+        try:
+            yield session
+        finally:
+            if session:
+                await self.checkin(session, user)
+
+    async def close(self) -> None:
+        '''
+        Close all idle sessions.
+        '''
+
+        while self.idle:
+            await self.idle.popleft()[0].close()
+
+
+class async_ftp_client():
+    '''
+    Naive-FTP non-blocking client library API.
+
+    Sessions are managed internally, so that operations can run concurrently,
+    e.g. with asyncio.gather. At most max_sessions operations run at a time,
+    and the rest wait for a free session. The working directory is shared by
+    all sessions of the client.
+
+    Example:
+
+        async with async_ftp_client(max_sessions=16) as client:
+            await client.gather('delete', paths)
+            async for info in client.iter_ls('/'):
+                print(info)
+    '''
+
+    def __init__(self, max_sessions: int = 8, idle_timeout: float = 60.0) -> None:
+        '''
+        Initialize client.
+
+        :param max_sessions: maximum number of concurrent sessions
+        :param idle_timeout: seconds before an idle session is closed
+        '''
+
+        self.pool: async_session_pool = async_session_pool(max_sessions, idle_timeout)
+        self.user: str = 'client'  # working directory key in the pool
+
+    async def __aenter__(self) -> 'async_ftp_client':
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def _call(self, op: str, *args) -> Any:
+        '''
+        Run a session method with a pooled session, again with a new session
+        if the command was refused by a server shutting down.
+
+        Return the result, or None if no session is available.
+
+        :param op: name of the session method
+        :param args: arguments of the method
+        '''
+
+        for _ in range(2):  # again with a new session, if refused by a server shutting down
+            async with self.pool.session(self.user) as session:
+                if not session:
+                    return None
+                result = await getattr(session, op)(*args)
+                if not session.refused:
+                    return result
+        return result
+
+    async def ping(self) -> bool:
+        '''
+        Check connection to server. Ping!
+
+        Return True if connected.
+        '''
+
+        return bool(await self._call('ping'))
+
+    async def ls(self, path: str = '.') -> List[dict]:
+        '''
+        List information of a file or directory.
+
+        Return the parsed file information list, or None if failed.
+
+        :param path: server path to the file or directory
+        '''
+
+        return await self._call('ls', path)
+
+    async def iter_ls(self, path: str = '.') -> AsyncIterator[dict]:
+        '''
+        List information of a file or directory, yielding each entry as soon
+        as it is received. A session is held until the iteration is finished.
+
+        :param path: server path to the file or directory
+        '''
+
+        async with self.pool.session(self.user) as session:
+            if not session:
+                return
+            async for info in session.iter_ls(path):
+                yield info
+
+    async def retrieve(self, path: str) -> str:
+        '''
+        Retrieve a file from server.
+
+        Return the location of the downloaded file if succeeded, otherwise return None.
+
+        :param path: server path to the file
+        '''
+
+        return await self._call('retrieve', path)
+
+    async def store(self, path: str) -> bool:
+        '''
+        Store a file to server.
+
+        Return True if succeeded.
+
+        :param path: local path to the file
+        '''
+
+        return bool(await self._call('store', path))
+
+    async def delete(self, path: str) -> bool:
+        '''
+        Delete a file from server.
+
+        Return True if succeeded.
+
+        :param path: server path to the file
+        '''
+
+        return bool(await self._call('delete', path))
+
+    async def cwd(self, path: str = '/') -> bool:
+        '''
+        Change working directory, for all sessions of the client.
+
+        Return True if succeeded.
+
+        :param path: server path to the destination
+        '''
+
+        return bool(await self._call('cwd', path))
+
+    async def pwd(self) -> str:
+        '''
+        Print working directory.
+
+        Return current working directory, or None if failed.
+        '''
+
+        return await self._call('pwd')
+
+    async def mkdir(self, path: str) -> bool:
+        '''
+        Make a directory recursively.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        '''
+
+        return bool(await self._call('mkdir', path))
+
+    async def rmdir(self, path: str, recursive: bool = False) -> bool:
+        '''
+        Remove a directory.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        :param recursive: remove recursively if True
+        '''
+
+        return bool(await self._call('rmdir', path, recursive))
+
+    async def rmdir_all(self, path: str) -> bool:
+        '''
+        Remove a directory recursively.
+
+        Return True if succeeded.
+
+        :param path: server path to the directory
+        '''
+
+        return await self.rmdir(path, recursive=True)
+
+    async def gather(self, op: str, paths: Iterable[str]) -> list:
+        '''
+        Run an operation on many paths concurrently, within the session limit.
+
+        Return the results in the order of paths.
+
+        :param op: 'ls' / 'retrieve' / 'store' / 'delete' / 'mkdir' / 'rmdir' / 'rmdir_all'
+        :param paths: paths to operate on
+        '''
+
+        method = getattr(self, op)
+        return await asyncio.gather(*(method(path) for path in paths))
+
+    async def close(self) -> None:
+        '''
+        Close all sessions.
+        '''
+
+        await self.pool.close()
@@ -1,15 +1,152 @@
+import getpass
+import glob
 import socket
 import sys
 import os
 import re
+import shlex
+import ssl
 import stat
+import struct
+import time
+import uuid
 from datetime import datetime
-from typing import Callable, Tuple
-from naive_ftp.utils import log
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+from naive_ftp.client.transfer import format_size, run_parallel, transfer_job, transfer_manager
+from naive_ftp.utils import log, set_keepalive
 
 server_host: str = socket.gethostname()
 server_port: int = 2121
 
+# Log in with USER / PASS on connecting if set, otherwise access anonymously
+username: str = None
+password: str = None
+login_timeout: float = 5.0  # extra wait for PASS, as failed logins are delayed
+
+# Secure connections with AUTH TLS and PROT P, verified against tls_cafile
+# (system CAs if None). A context is shared by all sessions, so that data
+# connections resume the TLS session of their control connection.
+use_tls: bool = False
+tls_cafile: str = None
+_tls_context: ssl.SSLContext = None
+
+
+def get_tls_context() -> ssl.SSLContext:
+    '''
+    Return the TLS context shared by all sessions.
+    '''
+
+    global _tls_context
+    if not _tls_context:
+        _tls_context = ssl.create_default_context(cafile=tls_cafile)
+        _tls_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return _tls_context
+
+
+def parse_stat(resp: str) -> Tuple[str, str, str, str, str, str]:
+    '''
+    Parse a line of LIST response to a human readable list for output.
+
+    Return file name, file size, file type, last modified time,
+    permissions and owner.
+
+    :param resp: a line of response
+    '''
+
+    def _parse_size(st_size: int) -> str:
+        '''
+        Interpret st_size to a human readable size.
+
+        Return file size with a proper unit prefix.
+
+        :param st_size: file size
+        '''
+
+        size = float(st_size)
+        for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']:
+            if abs(size) < 1024.0:
+                return f'{size:4.1f} {unit}'
+            size /= 1024.0
+        return f'{size:.1f} YB'
+
+    def _parse_type(st_mode: int) -> str:
+        '''
+        Interpret the result of st_mode to file type.
+
+        Return file type.
+
+        :param st_mode: file mode
+        '''
+
+        type_dict = {
+            stat.S_ISREG: 'File',
+            stat.S_ISDIR: 'Dir',
+            stat.S_ISLNK: 'Link',
+        }
+        for check in type_dict:
+            if check(st_mode):
+                return type_dict[check]
+        return 'Unkn'
+
+    def _parse_perms(st_mode: int) -> str:
+        '''
+        Interpret the result of st_mode to permissions.
+
+        Return a Unix-like permission string.
+
+        :param st_mode: file mode
+        '''
+
+        perm_dict = {
+            stat.S_IRUSR: 'r', stat.S_IWUSR: 'w', stat.S_IXUSR: 'x',
+            stat.S_IRGRP: 'r', stat.S_IWGRP: 'w', stat.S_IXGRP: 'x',
+            stat.S_IROTH: 'r', stat.S_IWOTH: 'w', stat.S_IXOTH: 'x',
+        }
+        perms = 'd' if stat.S_ISDIR(st_mode) else '-'
+        for perm in perm_dict:
+            perms += perm_dict[perm] if st_mode & perm else '-'
+        return perms
+
+    if not resp:
+        return None
+    try:
+        file_name, st_size, st_mode, st_mtime, st_uid = resp.split(' ')
+        file_name = file_name.replace('%20', ' ')
+        file_size = _parse_size(int(st_size))
+        file_type = _parse_type(int(st_mode))
+        if file_type == 'Dir':
+            file_size = ''
+        mod_time = (
+            datetime.fromtimestamp(float(st_mtime))
+            .strftime('%Y-%m-%d %H:%M:%S')
+        )
+        perms = _parse_perms(int(st_mode))
+        owner = st_uid
+    except (ValueError, TypeError) as e:
+        log('error', f'Invalid response: {resp}, error: {e}')
+        return None
+    else:
+        return file_name, file_size, file_type, mod_time, perms, owner
+
+
+def to_dict(info: Tuple[str, str, str, str, str, str]) -> dict:
+    '''
+    Convert an information entry into key-value pairs in JSON syntax.
+
+    Return a dictionary version of info.
+
+    :param info: (file_name, file_size, file_type, mod_time, perms, owner)
+    '''
+
+    return {
+        'fileName': info[0],
+        'fileSize': info[1],
+        'fileType': info[2],
+        'modTime': info[3],
+        'perms': info[4],
+        'owner': info[5],
+    }
+
 
 class ftp_client():
     '''
@@ -27,16 +164,43 @@ class ftp_client():
         self.buffer_size: int = 1024
         self.ctrl_timeout_duration: float = 3.0
         self.data_timeout_duration: float = 3.0
+        self.noop_interval: float = 15.0  # during transfers, while control connection is idle
         self.local_dir: str = os.path.realpath('local_files')
         self.cli_mode: bool = cli_mode
 
-        # Control connection
+        # Current working directory on server
+        self.cwd_path: str = '/'
+
+        # User name and password to log in with on connecting
+        self.credentials: Tuple[str, str] = (username, password) if username else None
+
+        # Background transfers, each worker with its own session,
+        # created on first use, as clients of its workers never use theirs
+        self.transfers: transfer_manager = None
+
+        # Control connection, received bytes of incomplete responses,
+        # and NOOPs sent during a transfer whose responses are not read yet
         self.ctrl_conn: socket.socket = None
+        self.ctrl_buffer: bytes = b''
+        self.ctrl_active: float = 0.0
+        self.noops: int = 0
 
         # Data connection
         self.data_conn: socket.socket = None
         self.data_addr: Tuple[str, int] = None
 
+        # Whether data connections are secured with TLS
+        self.protect_data: bool = False
+
+    def get_transfers(self) -> transfer_manager:
+        '''
+        Return the manager of background transfers, creating it if not created.
+        '''
+
+        if not self.transfers:
+            self.transfers = transfer_manager(self.new_session)
+        return self.transfers
+
     def check_resp(self, code: int) -> Tuple[bool, int, str]:
         '''
         Get a response from the server, and check its status code.
@@ -48,14 +212,19 @@ class ftp_client():
         '''
 
         def _get_resp() -> str:
-            return (
-                self.ctrl_conn
-                .recv(self.buffer_size)
-                .decode('utf-8')
-                .strip('\r\n')
-            )
+            while b'\n' not in self.ctrl_buffer:
+                data = self.ctrl_conn.recv(self.buffer_size)
+                if not data:
+                    raise ConnectionResetError('closed by server')
+                self.ctrl_buffer += data
+            line, _, self.ctrl_buffer = self.ctrl_buffer.partition(b'\n')
+            self.ctrl_active = time.monotonic()
+            return line.decode('utf-8').strip('\r\n')
 
         try:
+            while self.noops:  # responses to NOOPs, sent before this command
+                if _get_resp().startswith('200'):
+                    self.noops -= 1
             resp = _get_resp()
         except socket.timeout:
             if self.cli_mode:
@@ -112,16 +281,43 @@ class ftp_client():
         if err:
             log('error', f'Data connection failed, error: {err}')
             self.close_data_conn()
-        else:
-            if self.cli_mode:
-                log('debug', f'Data connection opened: {self.data_addr}')
-
-    def close_data_conn(self) -> None:
+            return
+        if self.protect_data:
+            try:  # an abbreviated handshake, resuming the control session
+                self.data_conn = get_tls_context().wrap_socket(
+                    self.data_conn,
+                    server_hostname=server_host,
+                    session=self.ctrl_conn.session,
+                )
+            except (ssl.SSLError, OSError) as e:
+                log('error', f'TLS handshake failed, error: {e}')
+                self.close_data_conn()
+                return
+        if self.cli_mode:
+            log('debug', f'Data connection opened: {self.data_addr}')
+
+    def close_data_conn(self, graceful: bool = False, abort: bool = False) -> None:
         '''
         Close data connection.
+
+        :param graceful: True after sending a file, so that a TLS connection
+                         is shut down with close_notify, and no data in flight
+                         is lost to a reset
+        :param abort: True to reset the connection instead, so that the server
+                      discards an incomplete upload rather than storing it
         '''
 
         if self.data_conn:
+            if abort:
+                try:
+                    self.data_conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                except OSError:
+                    pass
+            elif graceful and isinstance(self.data_conn, ssl.SSLSocket):
+                try:
+                    self.data_conn.unwrap()
+                except (ssl.SSLError, OSError):  # closed by server meanwhile
+                    pass
             self.data_conn.close()
             self.data_conn = None
 
@@ -145,6 +341,7 @@ class ftp_client():
 
         self.ctrl_conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.ctrl_conn.settimeout(self.ctrl_timeout_duration)
+        set_keepalive(self.ctrl_conn)
         err = self.ctrl_conn.connect_ex((server_host, server_port))
         if err:
             log('error', f'Connection failed, error: {err}')
@@ -153,15 +350,106 @@ class ftp_client():
         elif not self.check_resp(220)[0]:
             self.close_ctrl_conn()
             return False
+        elif use_tls and not self.auth():
+            self.close_ctrl_conn()
+            return False
+        elif self.credentials and not self.login(*self.credentials):
+            self.close_ctrl_conn()
+            return False
         else:
+            self.cwd_path = '/'
             log('info', 'Connected to server.')
             return True
 
+    def auth(self) -> bool:
+        '''
+        Secure the connection with TLS, for both control and data connections.
+
+        Return True if succeeded.
+        '''
+
+        if isinstance(self.ctrl_conn, ssl.SSLSocket):
+            return True
+        if not self.ctrl_conn:
+            log('info', 'Please connect to server first.')
+            return False
+        self.ctrl_conn.sendall('AUTH TLS\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(234)
+        if not expected:
+            log('warn', resp_msg or 'TLS not supported by server.')
+            return False
+        try:
+            self.ctrl_conn = get_tls_context().wrap_socket(self.ctrl_conn, server_hostname=server_host)
+        except (ssl.SSLError, OSError) as e:
+            log('error', f'TLS handshake failed, error: {e}')
+            self.close_ctrl_conn()
+            return False
+        for cmd in ('PBSZ 0', 'PROT P'):
+            self.ctrl_conn.sendall(f'{cmd}\r\n'.encode('utf-8'))
+            expected, _, resp_msg = self.check_resp(200)
+            if not expected:
+                log('warn', resp_msg)
+                return False
+        self.protect_data = True
+        log('info', f'Connection secured, {self.ctrl_conn.version()}.')
+        return True
+
+    def login(self, name: str, password: str = None) -> bool:
+        '''
+        Log in as a user, asking for the password if not given.
+
+        Return True if succeeded.
+
+        :param name: user name
+        :param password: the password
+        '''
+
+        if not self.ctrl_conn:
+            log('info', 'Please connect to server first.')
+            return False
+        self.ctrl_conn.sendall(f'USER {name}\r\n'.encode('utf-8'))
+        expected, resp_code, resp_msg = self.check_resp(331)
+        if not expected and resp_code != '230':  # 230 if no login required
+            log('warn', resp_msg)
+            return False
+        if not expected:
+            return True
+        if password is None:
+            password = getpass.getpass('Password: ') if self.cli_mode else ''
+        if not isinstance(self.ctrl_conn, ssl.SSLSocket):
+            log('debug', 'Sending password in plain text, consider AUTH first.')
+        self.ctrl_conn.sendall(f'PASS {password}\r\n'.encode('utf-8'))
+        self.ctrl_conn.settimeout(self.ctrl_timeout_duration + login_timeout)  # delayed if failed
+        try:
+            expected, _, resp_msg = self.check_resp(230)
+        finally:
+            if self.ctrl_conn:
+                self.ctrl_conn.settimeout(self.ctrl_timeout_duration)
+        if not expected:
+            log('warn', resp_msg or 'Login failed.')
+            return False
+        self.credentials = (name, password)
+        self.cwd_path = '/'
+        log('info', f'Logged in as {name}.')
+        return True
+
+    def new_session(self) -> 'ftp_client':
+        '''
+        Return an unopened session logging in as the same user, for background workers.
+        '''
+
+        client = ftp_client(cli_mode=False)
+        client.credentials = self.credentials
+        return client
+
     def close_ctrl_conn(self) -> None:
         '''
         Close control connection.
         '''
 
+        self.protect_data = False
+        self.ctrl_buffer = b''
+        self.noops = 0
         if self.ctrl_conn:
             self.ctrl_conn.close()
             self.ctrl_conn = None
@@ -196,12 +484,17 @@ class ftp_client():
         print('COMMANDS:')
         _print_cmd('HELP', '', _read_doc(self.help))
         _print_cmd('OPEN', '', _read_doc(self.open))
+        _print_cmd('AUTH', '', _read_doc(self.auth))
+        _print_cmd('USER', '<name> [password]', _read_doc(self.login))
         _print_cmd('QUIT', '', _read_doc(self.close))
         _print_cmd('EXIT', '', _read_doc(self.close))
         _print_cmd('LIST', '<server_path>', _read_doc(self.ls))
         _print_cmd('LS', '<server_path>', _read_doc(self.ls))
+        _print_cmd('NLST', '<server_path>', _read_doc(self.nlst))
         _print_cmd('RETR', '<server_path>', _read_doc(self.retrieve))
         _print_cmd('GET', '<server_path>', _read_doc(self.retrieve))
+        _print_cmd('SIZE', '<server_path>', _read_doc(self.size))
+        _print_cmd('MDTM', '<server_path>', _read_doc(self.mdtm))
         _print_cmd('STOR', '<local_path>', _read_doc(self.store))
         _print_cmd('PUT', '<local_path>', _read_doc(self.store))
         _print_cmd('DELE', '<server_path>', _read_doc(self.delete))
@@ -215,6 +508,21 @@ class ftp_client():
         _print_cmd('RMD', '<server_path>', _read_doc(self.rmdir))
         _print_cmd('RMDI', '<server_path>', _read_doc(self.rmdir))
         _print_cmd('RMDA', '<server_path>', _read_doc(self.rmdir_all))
+        _print_cmd('RMST', '[job_id]', _read_doc(self.rmstat))
+        _print_cmd('FIND', '<text>', _read_doc(self.find))
+        _print_cmd('QGET', '<server_path>', _read_doc(self.queue_retrieve))
+        _print_cmd('QPUT', '<local_path>', _read_doc(self.queue_store))
+        _print_cmd('JOBS', '', _read_doc(self.jobs))
+        _print_cmd('PAUS', '<job_id>', _read_doc(self.pause))
+        _print_cmd('RESU', '<job_id>', _read_doc(self.resume))
+        _print_cmd('CANC', '<job_id>', _read_doc(self.cancel))
+        _print_cmd('MGET', '<server_path>', _read_doc(self.mget))
+        _print_cmd('MPUT', '<local_path>', _read_doc(self.mput))
+        _print_cmd('MDEL', '<server_path>', _read_doc(self.mdelete))
+        _print_cmd('RENA', '<from> <to>', _read_doc(self.rename))
+        _print_cmd('MV', '<from> <to>', _read_doc(self.rename))
+        _print_cmd('COPY', '<from> <to>', _read_doc(self.copy))
+        _print_cmd('CP', '<from> <to>', _read_doc(self.copy))
 
     def open(self) -> bool:
         '''
@@ -246,14 +554,50 @@ class ftp_client():
             return False
         try:
             self.ctrl_conn.sendall('PING\r\n'.encode('utf-8'))
-            if not self.check_resp(220)[0]:
+            _, resp_code, _ = self.check_resp(220)
+            if resp_code != '220':
                 self.close_ctrl_conn()
-                return False
+                return resp_code == '421' and self.reconnect()
         except (socket.timeout, socket.error):
             return False
         else:
             return True
 
+    def reconnect(self) -> bool:
+        '''
+        Connect again after the session is closed by server, e.g. when idle
+        or on restart, and change to the previous working directory.
+
+        Return True if succeeded.
+        '''
+
+        cwd_path = self.cwd_path
+        log('info', 'Session closed by server, reconnecting.')
+        if not self.open_ctrl_conn():
+            return False
+        if cwd_path != '/':
+            self.ctrl_conn.sendall(f'CWD {cwd_path}\r\n'.encode('utf-8'))
+            if self.check_resp(257)[0]:
+                self.cwd_path = cwd_path
+        return True
+
+    def keep_alive(self) -> None:
+        '''
+        Send a NOOP during a long transfer, if control connection has been idle
+        for noop_interval, so that it is not dropped by middleboxes meanwhile.
+        The server responds after the transfer, skipped by the next check_resp.
+        '''
+
+        now = time.monotonic()
+        if now - self.ctrl_active < self.noop_interval:
+            return
+        self.ctrl_active = now
+        try:
+            self.ctrl_conn.sendall('NOOP\r\n'.encode('utf-8'))
+            self.noops += 1
+        except (AttributeError, OSError):  # found by the next command
+            pass
+
     def get_client_path(self, path: str) -> str:
         '''
         Parse the client path to its real path.
@@ -271,6 +615,19 @@ class ftp_client():
             )
         return client_path
 
+    def get_partial_path(self, client_path: str, tag: str = None) -> str:
+        '''
+        Return the path a download is written to until it finishes,
+        a hidden file next to the local file, which is kept meanwhile.
+
+        :param client_path: real path of the local file
+        :param tag: distinguishes the file of a single download if given,
+                    otherwise the path is where aborted downloads are resumed from
+        '''
+
+        dir_name, file_name = os.path.split(client_path)
+        return os.path.join(dir_name, f'.{file_name}.{tag}.part' if tag else f'.{file_name}.part')
+
     def ls(self, path: str = '.') -> list[dict]:
         '''
         List information of a file or directory.
@@ -281,91 +638,6 @@ class ftp_client():
                      using current path by default
         '''
 
-        def _parse_stat(resp: str) -> Tuple[str, str, str, str, str, str]:
-            '''
-            Parse a line of server response to a human readable list for output.
-
-            Return file name, file size, file type, last modified time,
-            permissions and owner.
-
-            :param resp: a line of response
-            '''
-
-            def _parse_size(st_size: int) -> str:
-                '''
-                Interpret st_size to a human readable size.
-
-                Return file size with a proper unit prefix.
-
-                :param st_size: file size
-                '''
-
-                size = float(st_size)
-                for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB']:
-                    if abs(size) < 1024.0:
-                        return f'{size:4.1f} {unit}'
-                    size /= 1024.0
-                return f'{size:.1f} YB'
-
-            def _parse_type(st_mode: int) -> str:
-                '''
-                Interpret the result of st_mode to file type.
-
-                Return file type.
-
-                :param st_mode: file mode
-                '''
-
-                type_dict = {
-                    stat.S_ISREG: 'File',
-                    stat.S_ISDIR: 'Dir',
-                    stat.S_ISLNK: 'Link',
-                }
-                for check in type_dict:
-                    if check(st_mode):
-                        return type_dict[check]
-                return 'Unkn'
-
-            def _parse_perms(st_mode: int) -> str:
-                '''
-                Interpret the result of st_mode to permissions.
-
-                Return a Unix-like permission string.
-
-                :param st_mode: file mode
-                '''
-
-                perm_dict = {
-                    stat.S_IRUSR: 'r', stat.S_IWUSR: 'w', stat.S_IXUSR: 'x',
-                    stat.S_IRGRP: 'r', stat.S_IWGRP: 'w', stat.S_IXGRP: 'x',
-                    stat.S_IROTH: 'r', stat.S_IWOTH: 'w', stat.S_IXOTH: 'x',
-                }
-                perms = 'd' if stat.S_ISDIR(st_mode) else '-'
-                for perm in perm_dict:
-                    perms += perm_dict[perm] if st_mode & perm else '-'
-                return perms
-
-            if not resp:
-                return None
-            try:
-                file_name, st_size, st_mode, st_mtime, st_uid = resp.split(' ')
-                file_name = file_name.replace('%20', ' ')
-                file_size = _parse_size(int(st_size))
-                file_type = _parse_type(int(st_mode))
-                if file_type == 'Dir':
-                    file_size = ''
-                mod_time = (
-                    datetime.fromtimestamp(float(st_mtime))
-                    .strftime('%Y-%m-%d %H:%M:%S')
-                )
-                perms = _parse_perms(int(st_mode))
-                owner = st_uid
-            except (ValueError, TypeError) as e:
-                log('error', f'Invalid response: {resp}, error: {e}')
-                return None
-            else:
-                return file_name, file_size, file_type, mod_time, perms, owner
-
         def _print_info(info: Tuple[str, str, str, str, str, str]) -> None:
             '''
             Print information of a file or directory.
@@ -382,24 +654,6 @@ class ftp_client():
             except ValueError as e:
                 log('error', f'Invalid response: {info}, error: {e}')
 
-        def _to_dict(info: Tuple[str, str, str, str, str, str]) -> dict:
-            '''
-            Convert an information entry into key-value pairs in JSON syntax.
-
-            Return a dictionary version of info.
-
-            :param info: (file_name, file_size, file_type, mod_time, perms, owner)
-            '''
-
-            return {
-                'fileName': info[0],
-                'fileSize': info[1],
-                'fileType': info[2],
-                'modTime': info[3],
-                'perms': info[4],
-                'owner': info[5],
-            }
-
         if not self.ping():
             log('info', 'Please connect to server first.')
             return None
@@ -435,11 +689,11 @@ class ftp_client():
             else:
                 infos = []
                 for resp in resp_list:
-                    info = _parse_stat(resp)
+                    info = parse_stat(resp)
                     if info:
                         if self.cli_mode:
                             _print_info(info)
-                        info_dict = _to_dict(info)
+                        info_dict = to_dict(info)
                         infos.append(info_dict)
                 return infos
         except socket.error:
@@ -449,13 +703,157 @@ class ftp_client():
         finally:
             self.close_data_conn()
 
-    def retrieve(self, path: str) -> str:
+    def nlst(self, path: str = '.') -> List[str]:
+        '''
+        List names in a directory, or those matching a glob pattern.
+
+        Return the names, or None if failed.
+
+        :param path: server path to the directory, or a glob pattern
+                     such as 'logs/*.log'
+        '''
+
+        names = self.query_names(path)
+        if names is not None and self.cli_mode:
+            print('\n'.join(names))
+        return names
+
+    def query_names(self, path: str, files_only: bool = False) -> List[str]:
+        '''
+        List names in a directory, or those matching a glob pattern, without printing them.
+
+        Return the names, or None if failed.
+
+        :param path: server path to the directory, or a glob pattern
+        :param files_only: True to leave out directories, marked by the server
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        self.ctrl_conn.sendall(f'NLST {"-p " if files_only else ""}{path}\r\n'.encode('utf-8'))
+
+        expected, _, resp_msg = self.check_resp(150)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        self.open_data_conn()
+        if not self.check_resp(225)[0]:
+            self.close_data_conn()
+            return None
+
+        raw_resp = b''
+        try:
+            while True:
+                data = self.data_conn.recv(self.buffer_size)
+                if not data:
+                    break
+                raw_resp += data
+        except socket.error:
+            if self.cli_mode:
+                log('debug', 'Data connection closed.')
+            return None
+        finally:
+            self.close_data_conn()
+
+        return [
+            name.replace('%20', ' ')
+            for name in raw_resp.decode('utf-8').split('\r\n')
+            if name and not (files_only and name.endswith('/'))
+        ]
+
+    def run_multi(self, op: str, paths: List[str]) -> Dict[str, object]:
+        '''
+        Run an operation on many paths concurrently, and report a summary.
+
+        Return the summary.
+
+        :param op: 'retrieve' / 'store' / 'delete'
+        :param paths: paths to operate on
+        '''
+
+        if not paths:
+            log('info', 'No files matched.')
+            return None
+        summary = run_parallel(
+            self.new_session,
+            op,
+            paths,
+            self.cwd_path,
+            self.get_transfers().max_sessions,
+        )
+        if self.cli_mode:
+            print(
+                f'{summary["succeeded"]} succeeded, {len(summary["failed"])} failed, '
+                f'{format_size(summary["bytes"])} in {summary["elapsed"]:.2f}s, '
+                f'{format_size(summary["rate"])}/s'
+            )
+            for path in summary['failed']:
+                print(f'Failed: {path}')
+        return summary
+
+    def mget(self, pattern: str) -> Dict[str, object]:
+        '''
+        Retrieve files matching a glob pattern from server, in parallel.
+
+        Return a summary of the results, or None if failed.
+
+        :param pattern: server path to the files, with wildcards in the file name
+        '''
+
+        names = self.query_names(pattern, files_only=True)
+        if names is None:
+            return None
+        return self.run_multi('retrieve', names)
+
+    def mput(self, pattern: str) -> Dict[str, object]:
+        '''
+        Store local files matching a glob pattern to server, in parallel.
+
+        Return a summary of the results.
+
+        :param pattern: local path to the files, with wildcards
+        '''
+
+        paths = [
+            os.path.relpath(path, self.local_dir)
+            for path in glob.glob(self.get_client_path(pattern))
+            if os.path.isfile(path)
+        ]
+        return self.run_multi('store', paths)
+
+    def mdelete(self, pattern: str) -> Dict[str, object]:
+        '''
+        Delete files matching a glob pattern from server, in parallel.
+
+        Return a summary of the results, or None if failed.
+
+        :param pattern: server path to the files, with wildcards in the file name
+        '''
+
+        names = self.query_names(pattern, files_only=True)
+        if names is None:
+            return None
+        return self.run_multi('delete', names)
+
+    def retrieve(self, path: str, offset: int = 0, callback: Callable[[int], bool] = None) -> str:
         '''
         Retrieve a file from server.
 
         Return the location of the downloaded file if succeeded, otherwise return None.
 
+        The file is written under a partial name (see get_partial_path),
+        and renamed once finished. A new download has a partial file of its
+        own, so that concurrent downloads of the same file, e.g. by sessions
+        of the client handler, do not write over each other. The partial file
+        is kept if the download is aborted by the callback, so that it can be
+        resumed, and removed if failed otherwise.
+
         :param path: server path to the file
+        :param offset: resume a partial download from this offset
+        :param callback: called with the size of each received chunk,
+                         the transfer is aborted if it returns False
         '''
 
         if not self.ping():
@@ -463,8 +861,19 @@ class ftp_client():
             return None
 
         dst_path = self.get_client_path(os.path.basename(path))
+        part_path = self.get_partial_path(dst_path)
+        if offset and not os.path.isfile(part_path):  # nothing to resume
+            offset = 0
+        write_path = part_path if offset else self.get_partial_path(dst_path, uuid.uuid4().hex)
         log('info', f'Downloading file: {dst_path}')
 
+        if offset:
+            self.ctrl_conn.sendall(f'REST {offset}\r\n'.encode('utf-8'))
+            expected, _, resp_msg = self.check_resp(350)
+            if not expected:
+                log('warn', resp_msg)
+                return None
+
         self.ctrl_conn.sendall(f'RETR {path}\r\n'.encode('utf-8'))
 
         expected, _, resp_msg = self.check_resp(150)
@@ -476,13 +885,23 @@ class ftp_client():
             self.close_data_conn()
             return None
 
+        done, aborted = False, False
         try:
-            with open(dst_path, 'wb') as dst_file:
+            with open(write_path, 'r+b' if offset else 'wb') as dst_file:
+                dst_file.seek(offset)
+                dst_file.truncate()
                 while True:
                     data = self.data_conn.recv(self.buffer_size)
                     if not data:
                         break
                     dst_file.write(data)
+                    self.keep_alive()
+                    if callback and not callback(len(data)):
+                        log('info', 'Download aborted.')
+                        aborted = True
+                        return None
+            os.replace(write_path, dst_path)
+            done = True
         except OSError as e:
             log('warn', f'System error: {e}')
             return None
@@ -495,14 +914,185 @@ class ftp_client():
             return dst_path
         finally:
             self.close_data_conn()
+            try:
+                if aborted and write_path != part_path:
+                    os.replace(write_path, part_path)  # to be resumed
+                elif not done and not aborted:
+                    os.remove(write_path)
+            except OSError:
+                pass
+
+    def retrieve_stream(self, path: str, offset: int = 0, length: int = None) -> Iterator[bytes]:
+        '''
+        Retrieve a file from server as a stream, without saving it locally.
+
+        Return an iterator over chunks of the file if succeeded, otherwise return None.
+        The data connection is closed once the iterator is exhausted or closed.
+
+        :param path: server path to the file
+        :param offset: offset to start reading at
+        :param length: number of bytes to read, until the end of file if None
+        '''
+
+        def _stream() -> Iterator[bytes]:
+            remaining = length
+            try:
+                while remaining is None or remaining > 0:
+                    size = self.buffer_size if remaining is None else min(remaining, self.buffer_size)
+                    data = self.data_conn.recv(size)
+                    if not data:
+                        break
+                    if remaining is not None:
+                        remaining -= len(data)
+                    self.keep_alive()
+                    yield data
+            except socket.error:
+                if self.cli_mode:
+                    log('debug', 'Data connection closed.')
+            finally:
+                self.close_data_conn()
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        if offset:
+            self.ctrl_conn.sendall(f'REST {offset}\r\n'.encode('utf-8'))
+            expected, _, resp_msg = self.check_resp(350)
+            if not expected:
+                log('warn', resp_msg)
+                return None
+
+        self.ctrl_conn.sendall(f'RETR {path}\r\n'.encode('utf-8'))
+
+        expected, _, resp_msg = self.check_resp(150)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        self.open_data_conn()
+        if not self.check_resp(225)[0]:
+            self.close_data_conn()
+            return None
+        return _stream()
 
-    def store(self, path: str) -> bool:
+    def watch(self, path: str = '.') -> Iterator[Tuple[str, str, bool]]:
+        '''
+        Watch changes under a directory on server.
+
+        Return an iterator over change events if succeeded, otherwise return None.
+        Each event is (event_type, path, is_dir), where event_type is
+        'create' / 'modify' / 'delete', and path is relative to server root.
+        Empty events ('', '', False) are yielded on heartbeats, so that callers
+        get a chance to stop. Close the iterator to stop watching, after which
+        the session should be closed as well.
+
+        :param path: server path to the directory
+        '''
+
+        def _stream() -> Iterator[Tuple[str, str, bool]]:
+            buffer = b''
+            try:
+                while True:
+                    data = self.data_conn.recv(self.buffer_size)
+                    if not data:
+                        break
+                    buffer += data
+                    *lines, buffer = buffer.split(b'\r\n')
+                    for line in lines:
+                        try:
+                            event_type, is_dir, ev_path = line.decode('utf-8').split(None, 2)
+                        except ValueError:  # heartbeat
+                            yield '', '', False
+                            continue
+                        yield event_type, ev_path.replace('%20', ' '), is_dir == '1'
+            except socket.error:
+                if self.cli_mode:
+                    log('debug', 'Data connection closed.')
+            finally:
+                self.close_data_conn()
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        self.ctrl_conn.sendall(f'SITE WATCH {path}\r\n'.encode('utf-8'))
+
+        expected, _, resp_msg = self.check_resp(150)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        self.open_data_conn()
+        if not self.check_resp(225)[0]:
+            self.close_data_conn()
+            return None
+        return _stream()
+
+    def size(self, path: str) -> int:
+        '''
+        Get the size of a file.
+
+        Return the file size in bytes if succeeded, otherwise return None.
+
+        :param path: server path to the file
+        '''
+
+        size = self.query_size(path)
+        if size is not None and self.cli_mode:
+            print(size)
+        return size
+
+    def query_size(self, path: str) -> int:
+        '''
+        Get the size of a file without printing it.
+
+        Return the file size in bytes if succeeded, otherwise return None.
+
+        :param path: server path to the file
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        self.ctrl_conn.sendall(f'SIZE {path}\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(213)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        return int(resp_msg)
+
+    def mdtm(self, path: str) -> str:
+        '''
+        Get the last modified time of a file or directory.
+
+        Return the time in format YYYYMMDDHHMMSS.ffffff (UTC) if succeeded,
+        otherwise return None.
+
+        :param path: server path to the file or directory
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        self.ctrl_conn.sendall(f'MDTM {path}\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(213)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        if self.cli_mode:
+            print(resp_msg)
+        return resp_msg
+
+    def store(self, path: str, callback: Callable[[int], bool] = None) -> bool:
         '''
         Store a file to server.
 
         Return True if succeeded.
 
         :param path: local path to the file
+        :param callback: called with the size of each sent chunk,
+                         the transfer is aborted if it returns False
         '''
 
         if not self.ping():
@@ -515,6 +1105,12 @@ class ftp_client():
             return False
         log('info', f'Uploading file: {src_path}')
 
+        # Declare the size first, so that a quota is checked before sending
+        self.ctrl_conn.sendall(f'ALLO {os.path.getsize(src_path)}\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(200)
+        if not expected:
+            log('info', resp_msg)
+            return False
         self.ctrl_conn.sendall(f'STOR {path}\r\n'.encode('utf-8'))
 
         expected, _, resp_msg = self.check_resp(150)
@@ -533,6 +1129,12 @@ class ftp_client():
                     if not data:
                         break
                     self.data_conn.sendall(data)
+                    self.keep_alive()
+                    if callback and not callback(len(data)):
+                        log('info', 'Upload aborted.')
+                        self.close_data_conn(abort=True)  # discarded by server
+                        return False
+            self.close_data_conn(graceful=True)
         except OSError as e:
             log('warn', f'System error: {e}')
         except socket.error:
@@ -544,6 +1146,46 @@ class ftp_client():
         finally:
             self.close_data_conn()
 
+    def store_stream(self, path: str, chunks: Iterable[bytes]) -> bool:
+        '''
+        Store a stream of data to server as a file, without reading a local file.
+
+        Return True if succeeded.
+
+        :param path: server path to the file
+        :param chunks: an iterable over chunks of file content
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return False
+
+        self.ctrl_conn.sendall(f'STOR {path}\r\n'.encode('utf-8'))
+
+        expected, _, resp_msg = self.check_resp(150)
+        if not expected:
+            log('info', resp_msg)
+            return False
+        self.open_data_conn()
+        if not self.check_resp(225)[0]:
+            self.close_data_conn()
+            return False
+
+        try:
+            for data in chunks:
+                self.data_conn.sendall(data)
+                self.keep_alive()
+            self.close_data_conn(graceful=True)
+        except socket.error:
+            if self.cli_mode:
+                log('debug', 'Data connection closed.')
+            return False
+        else:
+            log('info', 'File successfully uploaded.')
+            return True
+        finally:
+            self.close_data_conn()
+
     def delete(self, path: str) -> bool:
         '''
         Delete a file from server.
@@ -565,6 +1207,62 @@ class ftp_client():
         log('info' if expected else 'warn', resp_msg)
         return expected
 
+    def move(self, from_cmd: str, to_cmd: str, src: str, dst: str) -> bool:
+        '''
+        Send a pair of commands which rename or copy on server.
+
+        Return True if succeeded.
+
+        :param from_cmd: command setting the source
+        :param to_cmd: command setting the target and running the operation
+        :param src: server path to the source
+        :param dst: server path to the target
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return False
+
+        self.ctrl_conn.sendall(f'{from_cmd} {src}\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(350)
+        if not expected:
+            log('warn', resp_msg)
+            return False
+
+        self.ctrl_conn.sendall(f'{to_cmd} {dst}\r\n'.encode('utf-8'))
+        self.ctrl_conn.settimeout(None)  # copying a large tree may take a while
+        try:
+            expected, _, resp_msg = self.check_resp(250)
+        finally:
+            if self.ctrl_conn:
+                self.ctrl_conn.settimeout(self.ctrl_timeout_duration)
+        log('info' if expected else 'warn', resp_msg)
+        return expected
+
+    def rename(self, src: str, dst: str) -> bool:
+        '''
+        Rename a file or directory on server.
+
+        Return True if succeeded.
+
+        :param src: server path to the file or directory
+        :param dst: server path to the new name
+        '''
+
+        return self.move('RNFR', 'RNTO', src, dst)
+
+    def copy(self, src: str, dst: str) -> bool:
+        '''
+        Copy a file or directory on server, recursively.
+
+        Return True if succeeded.
+
+        :param src: server path to the file or directory
+        :param dst: server path to the copy
+        '''
+
+        return self.move('SITE CPFR', 'SITE CPTO', src, dst)
+
     def cwd(self, path: str = '/') -> bool:
         '''
         Change working directory.
@@ -585,6 +1283,7 @@ class ftp_client():
             log('warn', resp_msg)
             return False
         else:
+            self.cwd_path = '/' + resp_msg.lstrip('/')
             log('info', f'Changed directory to: {resp_msg}')
             return True
 
@@ -658,6 +1357,210 @@ class ftp_client():
 
         return self.rmdir(path, recursive=True)
 
+    def find(self, text: str) -> List[dict]:
+        '''
+        Search files on server by name.
+
+        Return the matched files, or None if failed.
+
+        :param text: text contained in the file names
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        self.ctrl_conn.sendall(f'SITE FIND {text}\r\n'.encode('utf-8'))
+
+        expected, _, resp_msg = self.check_resp(150)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        self.open_data_conn()
+        if not self.check_resp(225)[0]:
+            self.close_data_conn()
+            return None
+
+        raw_resp = b''
+        try:
+            while True:
+                data = self.data_conn.recv(self.buffer_size)
+                if not data:
+                    break
+                raw_resp += data
+        except socket.error:
+            if self.cli_mode:
+                log('debug', 'Data connection closed.')
+            return None
+        finally:
+            self.close_data_conn()
+
+        results = []
+        for line in raw_resp.decode('utf-8').split('\r\n'):
+            try:
+                path, size, mtime, is_dir = line.split()
+            except ValueError:
+                continue
+            results.append({
+                'path': path.replace('%20', ' '),
+                'fileSize': int(size),
+                'fileType': 'Dir' if is_dir == '1' else 'File',
+                'modTime': datetime.fromtimestamp(float(mtime)).strftime('%Y-%m-%d %H:%M:%S'),
+            })
+        if self.cli_mode:
+            for info in results:
+                print(f'{info["modTime"]}  {info["fileType"]:4}  {info["fileSize"]:>12}  {info["path"]}')
+        return results
+
+    def rmstat(self, job_id: str = None) -> str:
+        '''
+        Show the progress of a recursive directory removal.
+
+        Return the status, or None if failed. With several server workers, a job
+        is only found on a connection to the worker which runs it.
+
+        :param job_id: job identifier, the latest one of the session by default
+        '''
+
+        if not self.ping():
+            log('info', 'Please connect to server first.')
+            return None
+
+        cmd = 'SITE RMSTAT' if job_id is None else f'SITE RMSTAT {job_id}'
+        self.ctrl_conn.sendall(f'{cmd}\r\n'.encode('utf-8'))
+        expected, _, resp_msg = self.check_resp(211)
+        if not expected:
+            log('warn', resp_msg)
+            return None
+        if self.cli_mode:
+            print(resp_msg)
+        return resp_msg
+
+    def queue_transfer(self, op: str, args: str) -> transfer_job:
+        '''
+        Queue a transfer in background.
+
+        Return the job, or None if failed.
+
+        :param op: 'retrieve' / 'store'
+        :param args: the path, optionally followed by a priority
+        '''
+
+        path, _, priority = args.rpartition(' ')
+        if not path or not priority.lstrip('-').isdigit():
+            path, priority = args, '0'
+        if op == 'retrieve':
+            if not self.ping():
+                log('info', 'Please connect to server first.')
+                return None
+            size = self.query_size(path)
+            if size is None:
+                return None
+        else:
+            src_path = self.get_client_path(path)
+            if not os.path.isfile(src_path):
+                log('info', 'File not found.')
+                return None
+            size = os.path.getsize(src_path)
+        job = self.get_transfers().submit(op, path, size, int(priority), self.cwd_path)
+        if self.cli_mode:
+            print(f'Job {job.job_id} queued.')
+        return job
+
+    def queue_retrieve(self, args: str) -> transfer_job:
+        '''
+        Queue a file to retrieve in background, with an optional priority.
+
+        Return the job, or None if failed.
+
+        :param args: server path to the file, optionally followed by a priority
+        '''
+
+        return self.queue_transfer('retrieve', args)
+
+    def queue_store(self, args: str) -> transfer_job:
+        '''
+        Queue a file to store in background, with an optional priority.
+
+        Return the job, or None if failed.
+
+        :param args: local path to the file, optionally followed by a priority
+        '''
+
+        return self.queue_transfer('store', args)
+
+    def jobs(self) -> dict:
+        '''
+        Show background transfers and their progress.
+
+        Return the aggregate progress.
+        '''
+
+        transfers = self.get_transfers()
+        progress = transfers.progress()
+        if self.cli_mode:
+            for job in list(transfers.jobs.values()):
+                done = job.done_bytes if job.state != 'done' else job.size or 0
+                percent = f'{done / job.size:.0%}' if job.size else '-'
+                op = 'GET' if job.op == 'retrieve' else 'PUT'
+                print(f'{job.job_id:>4} {op} {job.state:9} {percent:>4} {job.priority:>3} {job.path}')
+            eta = progress['eta']
+            print(
+                f'{progress["pending"]} pending, {progress["running"]} running, '
+                f'{format_size(progress["done_bytes"])} / {format_size(progress["total_bytes"])}, '
+                f'{format_size(progress["rate"])}/s, '
+                f'ETA {"-" if eta is None else f"{eta:.0f}s"}'
+            )
+        return progress
+
+    def job_control(self, action: Callable[[int], bool], job_id: str) -> bool:
+        '''
+        Pause, resume or cancel a background transfer.
+
+        Return True if succeeded.
+
+        :param action: the method of transfer manager
+        :param job_id: job identifier
+        '''
+
+        if not job_id.isdigit() or not action(int(job_id)):
+            log('info', f'Job {job_id} not found or not applicable.')
+            return False
+        return True
+
+    def pause(self, job_id: str) -> bool:
+        '''
+        Pause a background transfer.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        return self.job_control(self.get_transfers().pause, job_id)
+
+    def resume(self, job_id: str) -> bool:
+        '''
+        Resume a paused background transfer.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        return self.job_control(self.get_transfers().resume, job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        '''
+        Cancel a background transfer.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        return self.job_control(self.get_transfers().cancel, job_id)
+
     def router(self, raw_cmd: str) -> None:
         '''
         Route to the associated method based on user command.
@@ -668,12 +1571,17 @@ class ftp_client():
         method_dict = {
             'HELP': self.help,
             'OPEN': self.open,
+            'AUTH': self.auth,
+            'USER': lambda args: self.login(*shlex.split(args)),
             'QUIT': self.close,
             'EXIT': self.close,         # alias
             'LIST': self.ls,
             'LS': self.ls,              # alias
+            'NLST': self.nlst,
             'RETR': self.retrieve,
             'GET': self.retrieve,       # alias
+            'SIZE': self.size,
+            'MDTM': self.mdtm,
             'STOR': self.store,
             'PUT': self.store,          # alias
             'DELE': self.delete,
@@ -687,6 +1595,21 @@ class ftp_client():
             'RMD': self.rmdir,
             'RMDI': self.rmdir,         # alias
             'RMDA': self.rmdir_all,
+            'RMST': self.rmstat,
+            'FIND': self.find,
+            'QGET': self.queue_retrieve,
+            'QPUT': self.queue_store,
+            'JOBS': self.jobs,
+            'PAUS': self.pause,
+            'RESU': self.resume,
+            'CANC': self.cancel,
+            'MGET': self.mget,
+            'MPUT': self.mput,
+            'MDEL': self.mdelete,
+            'RENA': lambda args: self.rename(*shlex.split(args)),
+            'MV': lambda args: self.rename(*shlex.split(args)),    # alias
+            'COPY': lambda args: self.copy(*shlex.split(args)),
+            'CP': lambda args: self.copy(*shlex.split(args)),      # alias
         }
 
         try:
@@ -701,7 +1624,7 @@ class ftp_client():
                     method(cmd[1])
             else:
                 log('info', f'Invalid operation: {raw_cmd}')
-        except TypeError as e:
+        except (TypeError, ValueError) as e:  # wrong arguments, or unbalanced quotes
             log('info', f'Invalid operation: {raw_cmd}, error: {e}')
 
     def run(self) -> None:
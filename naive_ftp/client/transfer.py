@@ -0,0 +1,345 @@
+import heapq
+import itertools
+import os
+import sys
+import time
+from queue import Empty, Queue
+from threading import Condition, Lock, Thread
+from typing import Callable, Dict, Iterable, List, Tuple
+from naive_ftp.utils import log
+
+
+def format_size(size: float) -> str:
+    '''
+    Return a human readable size.
+
+    :param size: size in bytes
+    '''
+
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f'{size:.1f} {unit}'
+        size /= 1024
+
+
+def run_parallel(
+    session_factory: Callable[[], object],
+    op: str,
+    paths: Iterable[str],
+    cwd: str = '/',
+    max_sessions: int = 4,
+) -> Dict[str, object]:
+    '''
+    Run an operation on many paths concurrently, each session in its own thread.
+
+    Return a summary of the results, with throughput and failed paths.
+
+    :param session_factory: create an unopened ftp_client for a worker
+    :param op: 'retrieve' / 'store' / 'delete'
+    :param paths: server paths to retrieve or delete, or local paths to store
+    :param cwd: working directory on server to run the operations in
+    :param max_sessions: maximum number of concurrent sessions
+    '''
+
+    pending: Queue = Queue()
+    for path in paths:
+        pending.put(path)
+    total = pending.qsize()
+    lock = Lock()
+    failed: List[str] = []
+    moved = [0]
+
+    def _worker() -> None:
+        client = session_factory()
+        connected = client.open_ctrl_conn() and (cwd == '/' or client.cwd(cwd))
+        count = 0
+
+        def _callback(size: int) -> bool:
+            nonlocal count
+            count += size
+            return True
+
+        while True:
+            try:
+                path = pending.get_nowait()
+            except Empty:
+                break
+            if op == 'retrieve':
+                result = connected and client.retrieve(path, 0, _callback)
+            elif op == 'store':
+                result = connected and client.store(path, _callback)
+            else:
+                result = connected and getattr(client, op)(path)
+            if not result:
+                with lock:
+                    failed.append(path)
+        client.close_data_conn()
+        client.close_ctrl_conn()
+        with lock:
+            moved[0] += count
+
+    start = time.monotonic()
+    workers = [Thread(target=_worker, daemon=True) for _ in range(min(max_sessions, total))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - start
+    return {
+        'succeeded': total - len(failed),
+        'failed': failed,
+        'bytes': moved[0],
+        'elapsed': elapsed,
+        'rate': moved[0] / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+class transfer_job():
+    '''
+    A queued RETR / STOR job.
+    '''
+
+    def __init__(self, job_id: int, op: str, path: str, size: int, priority: int, cwd: str) -> None:
+        '''
+        Initialize transfer job.
+
+        :param job_id: job identifier
+        :param op: 'retrieve' / 'store'
+        :param path: server path to retrieve, or local path to store
+        :param size: file size in bytes, None if unknown
+        :param priority: jobs with higher priority are scheduled first
+        :param cwd: working directory on server when the job was queued
+        '''
+
+        # Properties
+        self.job_id: int = job_id
+        self.op: str = op
+        self.path: str = path
+        self.size: int = size
+        self.priority: int = priority
+        self.cwd: str = cwd
+
+        # Progress
+        self.state: str = 'queued'  # running / paused / done / failed / cancelled
+        self.done_bytes: int = 0    # resume offset of a paused download
+        self.moved_bytes: int = 0   # bytes transferred, including restarted parts
+        self.seq: int = 0           # sequence number of its latest queue entry
+
+    def sort_key(self) -> Tuple[int, int]:
+        '''
+        Return the scheduling key, higher priority first, then smaller files first.
+        '''
+
+        return -self.priority, sys.maxsize if self.size is None else self.size
+
+
+class transfer_manager():
+    '''
+    Run queued transfers in background, over a bounded pool of sessions.
+
+    Jobs are scheduled by priority, and then by size, as running small files
+    first minimizes the mean completion time. Running jobs can be paused,
+    after which a download resumes from where it stopped (using REST),
+    and an upload restarts from the beginning.
+    '''
+
+    def __init__(self, session_factory: Callable[[], object], max_sessions: int = 4) -> None:
+        '''
+        Initialize transfer manager. Sessions are opened on the first job.
+
+        :param session_factory: create an unopened ftp_client for a worker
+        :param max_sessions: maximum number of concurrent transfers
+        '''
+
+        # Properties
+        self.session_factory: Callable[[], object] = session_factory
+        self.max_sessions: int = max_sessions
+
+        # Jobs, and queued ones in a heap of (sort_key, seq, job)
+        self.cond: Condition = Condition()
+        self.jobs: Dict[int, transfer_job] = {}
+        self.heap: List[Tuple[Tuple[int, int], int, transfer_job]] = []
+        self.job_ids: itertools.count = itertools.count(1)
+        self.seqs: itertools.count = itertools.count()
+
+        # Workers, and the start of the current busy period for throughput
+        self.workers: List[Thread] = []
+        self.active: int = 0
+        self.busy_since: float = 0.0
+        self.busy_base: int = 0
+
+    def _push(self, job: transfer_job) -> None:
+        '''
+        Queue a job, the lock should be held.
+
+        :param job: the job
+        '''
+
+        job.state = 'queued'
+        job.seq = next(self.seqs)
+        heapq.heappush(self.heap, (job.sort_key(), job.seq, job))
+        self.cond.notify()
+
+    def submit(self, op: str, path: str, size: int, priority: int = 0, cwd: str = '/') -> transfer_job:
+        '''
+        Queue a transfer job, starting workers if not started.
+
+        Return the job.
+
+        :param op: 'retrieve' / 'store'
+        :param path: server path to retrieve, or local path to store
+        :param size: file size in bytes, None if unknown
+        :param priority: jobs with higher priority are scheduled first
+        :param cwd: working directory on server to run the job in
+        '''
+
+        with self.cond:
+            job = transfer_job(next(self.job_ids), op, path, size, priority, cwd)
+            self.jobs[job.job_id] = job
+            self._push(job)
+            while len(self.workers) < self.max_sessions:
+                worker = Thread(target=self._work, daemon=True)
+                self.workers.append(worker)
+                worker.start()
+        return job
+
+    def pause(self, job_id: int) -> bool:
+        '''
+        Pause a queued or running job.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if not job or job.state not in ('queued', 'running'):
+                return False
+            job.state = 'paused'  # stale queue entries are skipped
+            return True
+
+    def resume(self, job_id: int) -> bool:
+        '''
+        Queue a paused job again.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if not job or job.state != 'paused':
+                return False
+            self._push(job)
+            return True
+
+    def cancel(self, job_id: int) -> bool:
+        '''
+        Cancel a job which has not finished.
+
+        Return True if succeeded.
+
+        :param job_id: job identifier
+        '''
+
+        with self.cond:
+            job = self.jobs.get(job_id)
+            if not job or job.state not in ('queued', 'running', 'paused'):
+                return False
+            job.state = 'cancelled'
+            return True
+
+    def _next_job(self) -> transfer_job:
+        '''
+        Wait for the next queued job, and mark it running.
+        '''
+
+        with self.cond:
+            while True:
+                while self.heap:
+                    _, seq, job = heapq.heappop(self.heap)
+                    if job.state == 'queued' and job.seq == seq:
+                        if not self.active:
+                            self.busy_since = time.monotonic()
+                            self.busy_base = sum(j.moved_bytes for j in self.jobs.values())
+                        self.active += 1
+                        job.state = 'running'
+                        return job
+                self.cond.wait()
+
+    def _run(self, client, job: transfer_job) -> None:
+        '''
+        Run a job with a session, and update its state.
+
+        :param client: an ftp_client
+        :param job: the job
+        '''
+
+        def _callback(size: int) -> bool:
+            job.done_bytes += size
+            job.moved_bytes += size
+            return job.state == 'running'
+
+        if not client.ctrl_conn and not client.open_ctrl_conn():
+            result = None
+        else:
+            if client.cwd_path != job.cwd:
+                client.cwd(job.cwd)
+            if job.op == 'retrieve':
+                result = client.retrieve(job.path, job.done_bytes, _callback)
+            else:
+                job.done_bytes = 0
+                result = client.store(job.path, _callback)
+
+        with self.cond:
+            self.active -= 1
+            if result:
+                job.state = 'done'
+                log('info', f'Job {job.job_id} done: {job.path}')
+                return
+            if job.state == 'running':
+                job.state = 'failed'
+                log('warn', f'Job {job.job_id} failed: {job.path}')
+            state = job.state
+
+        # A cancelled upload is discarded by server, keeping the file it would replace
+        if state == 'cancelled' and job.op == 'retrieve':  # the local file is kept as well
+            try:
+                os.remove(client.get_partial_path(client.get_client_path(os.path.basename(job.path))))
+            except OSError:
+                pass
+
+    def _work(self) -> None:
+        '''
+        Main function for workers, each with its own session.
+        '''
+
+        client = self.session_factory()
+        while True:
+            self._run(client, self._next_job())
+
+    def progress(self) -> Dict[str, float]:
+        '''
+        Return aggregate progress of unfinished jobs, with throughput and ETA.
+        '''
+
+        with self.cond:
+            jobs = list(self.jobs.values())
+            active, busy_since, busy_base = self.active, self.busy_since, self.busy_base
+
+        pending = [j for j in jobs if j.state in ('queued', 'running', 'paused')]
+        done_bytes = sum(j.done_bytes for j in pending)
+        total_bytes = sum(j.size or 0 for j in pending)
+        elapsed = time.monotonic() - busy_since
+        moved = sum(j.moved_bytes for j in jobs) - busy_base
+        rate = moved / elapsed if active and elapsed > 0 else 0.0
+        return {
+            'pending': len(pending),
+            'running': active,
+            'done_bytes': done_bytes,
+            'total_bytes': total_bytes,
+            'rate': rate,
+            'eta': (total_bytes - done_bytes) / rate if rate else None,
+        }
@@ -0,0 +1,20 @@
+'''
+Naive-FTP asynchronous client handler, an ASGI variant of the client handler.
+
+Expose the same REST APIs, while talking to the server with non-blocking
+FTP sessions, so that in-flight FTP operations do not hold worker threads.
+'''
+
+from quart import Quart
+from quart_cors import cors
+from naive_ftp.client_handler.async_router import file_handler, dir_handler, pool
+
+app = cors(Quart(__name__))
+
+app.register_blueprint(file_handler, url_prefix='/api')
+app.register_blueprint(dir_handler, url_prefix='/api')
+
+
+@app.after_serving
+async def close_sessions() -> None:
+    await pool.close()
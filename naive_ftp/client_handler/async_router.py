@@ -0,0 +1,136 @@
+from naive_ftp.client.async_client import async_ftp_session, async_session_pool
+from quart import Blueprint, request
+
+file_handler = Blueprint('file_handler', __name__)
+dir_handler = Blueprint('dir_handler', __name__)
+
+pool = async_session_pool()
+
+
+def get_user() -> str:
+    '''
+    Return the identifier of the web user, whose working directory is kept.
+
+    Use the X-Naive-FTP-User header if provided, otherwise the remote address.
+    '''
+
+    return request.headers.get('X-Naive-FTP-User', request.remote_addr)
+
+
+@file_handler.route('/file', methods=['GET', 'PUT', 'DELETE'])
+async def file():
+    '''
+    Same as the synchronous client handler, see router.file.
+
+    ASGI has no custom reason phrases, so errors only carry status codes.
+    '''
+
+    async with pool.session(get_user()) as session:
+        if not session:
+            return '', 503
+        return await _file(session)
+
+
+async def _file(session: async_ftp_session):
+    '''
+    Handle a file request with a checked out session.
+
+    :param session: FTP session
+    '''
+
+    # RETR
+    if request.method == 'GET':
+        src_path: str = request.args.get('path', type=str)
+        if not src_path:
+            return '', 400
+        dst_path: str = await session.retrieve(src_path)
+        if not dst_path:
+            return '', 404
+        return {
+            'msg': dst_path,
+        }
+
+    data: dict = await request.get_json()
+    path: str = data.get('path')
+    if not path:
+        return '', 400
+
+    # STOR
+    if request.method == 'PUT':
+        if not await session.store(path):
+            return '', 404
+        return {
+            'msg': path,
+        }
+
+    # DELE
+    if request.method == 'DELETE':
+        if not await session.delete(path):
+            return '', 404
+        return {
+            'msg': path,
+        }
+
+
+@dir_handler.route('/dir', methods=['GET', 'POST', 'PUT', 'DELETE'])
+async def dir():
+    '''
+    Same as the synchronous client handler, see router.dir.
+
+    ASGI has no custom reason phrases, so errors only carry status codes.
+    '''
+
+    async with pool.session(get_user()) as session:
+        if not session:
+            return '', 503
+        return await _dir(session)
+
+
+async def _dir(session: async_ftp_session):
+    '''
+    Handle a directory request with a checked out session.
+
+    :param session: FTP session
+    '''
+
+    # LIST
+    if request.method == 'GET':
+        path: str = request.args.get('path', default='', type=str)
+        data: list[dict] = await session.ls(path)
+        if data is None:
+            return '', 404
+        return {
+            'data': data,
+        }
+
+    data: dict = await request.get_json()
+    path: str = data.get('path')
+
+    # CWD
+    if request.method == 'POST':
+        if not path:
+            path = '/'
+        if not await session.cwd(path):
+            return '', 404
+        return {
+            'msg': path,
+        }
+
+    if not path:
+        return '', 400
+
+    # MKD
+    if request.method == 'PUT':
+        if not await session.mkdir(path):
+            return '', 403
+        return {
+            'msg': path,
+        }
+
+    # RMDA
+    if request.method == 'DELETE':
+        if not await session.rmdir_all(path):
+            return '', 403
+        return {
+            'msg': path,
+        }
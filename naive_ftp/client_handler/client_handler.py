@@ -7,10 +7,15 @@ and send responses back to frontend in JSON format.
 
 from flask import Flask
 from flask_cors import CORS
-from naive_ftp.client_handler.router import file_handler, dir_handler
+from naive_ftp.client_handler.router import (
+    file_handler, dir_handler, batch_handler, event_handler, search_handler,
+)
 
 app = Flask(__name__)
 CORS(app)
 
 app.register_blueprint(file_handler, url_prefix='/api')
 app.register_blueprint(dir_handler, url_prefix='/api')
+app.register_blueprint(batch_handler, url_prefix='/api')
+app.register_blueprint(event_handler, url_prefix='/api')
+app.register_blueprint(search_handler, url_prefix='/api')
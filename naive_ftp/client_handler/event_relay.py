@@ -0,0 +1,123 @@
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+from typing import Callable, List, Set, Tuple
+from naive_ftp.client.client import ftp_client
+from naive_ftp.utils import log
+
+
+class event_relay(Thread):
+    '''
+    Relay change events from the FTP server to web subscribers.
+
+    A single dedicated session watches the whole server, and its events are
+    fanned out to all subscribers, so that an open page costs no FTP session.
+    The relay is started on the first subscription, and reconnects if the
+    session is lost.
+    '''
+
+    def __init__(
+        self,
+        max_subscribers: int = 64,
+        queue_size: int = 256,
+        retry_delay: float = 3.0,
+    ) -> None:
+        '''
+        Initialize event relay.
+
+        :param max_subscribers: maximum number of subscribers
+        :param queue_size: maximum number of pending events of a subscriber,
+                           newer events are dropped if exceeded
+        :param retry_delay: seconds to wait before reconnecting
+        '''
+
+        super().__init__(daemon=True)
+
+        # Properties
+        self.max_subscribers: int = max_subscribers
+        self.queue_size: int = queue_size
+        self.retry_delay: float = retry_delay
+
+        # Subscribers and callbacks
+        self.lock: Lock = Lock()
+        self.subscribers: Set[Queue] = set()
+        self.callbacks: List[Callable[[Tuple[str, str, bool]], None]] = []
+        self.stopped: Event = Event()
+
+    def on_event(self, callback: Callable[[Tuple[str, str, bool]], None]) -> None:
+        '''
+        Register a callback called on every event, in the relay thread.
+
+        :param callback: the callback, taking the event
+        '''
+
+        self.callbacks.append(callback)
+
+    def subscribe(self) -> Queue:
+        '''
+        Subscribe to all events, starting the relay if not started.
+
+        Return a queue receiving the events, or None if too many subscribers.
+        '''
+
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            q = Queue(self.queue_size)
+            self.subscribers.add(q)
+            if not self.is_alive() and not self.stopped.is_set():
+                self.start()
+        return q
+
+    def unsubscribe(self, q: Queue) -> None:
+        '''
+        Stop receiving events.
+
+        :param q: the queue returned by subscribe
+        '''
+
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, ev: Tuple[str, str, bool]) -> None:
+        '''
+        Send an event to all callbacks and subscribers.
+
+        :param ev: (event_type, path, is_dir)
+        '''
+
+        for callback in self.callbacks:
+            callback(ev)
+        with self.lock:
+            for q in self.subscribers:
+                try:
+                    q.put_nowait(ev)
+                except Full:  # slow subscriber
+                    pass
+
+    def run(self) -> None:
+        '''
+        Main function for event relay.
+        '''
+
+        while not self.stopped.is_set():
+            client = ftp_client(cli_mode=False)
+            stream = client.watch('/') if client.open() else None
+            if stream:
+                log('info', 'Event relay connected')
+                for ev in stream:
+                    if self.stopped.is_set():
+                        break
+                    if ev[0]:  # not heartbeat
+                        self.publish(ev)
+                stream.close()
+                log('warn', 'Event relay disconnected')
+            client.close_data_conn()
+            client.close_ctrl_conn()
+            self.stopped.wait(self.retry_delay)
+
+    def close(self) -> None:
+        '''
+        Stop the relay after the next event or heartbeat.
+        '''
+
+        self.stopped.set()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import posixpath
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Lock
+from typing import NamedTuple
+
+
+class listing_entry(NamedTuple):
+    '''
+    A cached directory listing
+    '''
+
+    data: list            # parsed file information list
+    etag: str             # digest of the listing
+    last_modified: datetime
+    expires: float        # monotonic time when the entry expires
+
+
+class listing_cache():
+    '''
+    A short-lived cache of directory listings, shared by all pooled sessions.
+
+    Listings are keyed by absolute server paths, so that users in different
+    working directories share entries of the same directory.
+    '''
+
+    def __init__(self, ttl: float = 2.0, max_entries: int = 1024) -> None:
+        '''
+        Initialize listing cache.
+
+        :param ttl: seconds before a listing is fetched again
+        :param max_entries: maximum number of cached listings
+        '''
+
+        # Properties
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+
+        # Cached listings
+        self.lock: Lock = Lock()
+        self.entries: OrderedDict[str, listing_entry] = OrderedDict()
+
+    @staticmethod
+    def key(cwd_path: str, path: str) -> str:
+        '''
+        Return the absolute server path as the cache key.
+
+        :param cwd_path: current working directory on server
+        :param path: requested path, relative to cwd_path if not absolute
+        '''
+
+        return posixpath.normpath(posixpath.join(cwd_path, path or '.'))
+
+    def get(self, key: str) -> listing_entry:
+        '''
+        Return a cached listing, or None if missing or expired.
+
+        :param key: absolute server path
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry.expires > time.monotonic():
+                self.entries.move_to_end(key)
+                return entry
+            return None
+
+    def put(self, key: str, data: list, mtime: str) -> listing_entry:
+        '''
+        Cache a listing.
+
+        Return the cached entry.
+
+        :param key: absolute server path
+        :param data: parsed file information list
+        :param mtime: last modified time of the directory from MDTM, or None
+        '''
+
+        digest = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8'))
+        try:
+            last_modified = (
+                datetime.strptime(mtime, '%Y%m%d%H%M%S.%f')
+                .replace(tzinfo=timezone.utc)
+            )
+        except (TypeError, ValueError):
+            last_modified = None
+        entry = listing_entry(
+            data, digest.hexdigest(), last_modified, time.monotonic() + self.ttl,
+        )
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        '''
+        Drop all cached listings, called after the directory tree is changed.
+        '''
+
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,184 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+from typing import Deque, Dict, Iterator, Tuple
+from naive_ftp.client.client import ftp_client
+from naive_ftp.utils import log
+
+
+class ftp_client_pool():
+    '''
+    A thread-safe pool of FTP sessions for the client handler.
+
+    Each web user has its own working directory, which is restored on
+    whichever session the user checks out.
+    '''
+
+    def __init__(
+        self,
+        max_size: int = 8,
+        idle_timeout: float = 60.0,
+        check_interval: float = 5.0,
+    ) -> None:
+        '''
+        Initialize FTP client pool.
+
+        :param max_size: maximum number of sessions
+        :param idle_timeout: seconds before an idle session is closed
+        :param check_interval: seconds of idle time before a session is
+                               pinged again on checkout
+        '''
+
+        # Properties
+        self.max_size: int = max_size
+        self.idle_timeout: float = idle_timeout
+        self.check_interval: float = check_interval
+
+        # Sessions, idle ones are stored with their last used time
+        self.cond: Condition = Condition()
+        self.idle: Deque[Tuple[ftp_client, float]] = deque()
+        self.size: int = 0
+
+        # Working directory of each user
+        self.user_cwd: Dict[str, str] = {}
+
+    def _connect(self) -> ftp_client:
+        '''
+        Create a new session.
+
+        Return the session, or None if failed to connect.
+        '''
+
+        client = ftp_client(cli_mode=False)
+        if client.open():
+            return client
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+        return None
+
+    def _close(self, client: ftp_client) -> None:
+        '''
+        Close a session without leaving the process.
+
+        :param client: the session
+        '''
+
+        client.close_data_conn()
+        client.close_ctrl_conn()
+
+    def get_cwd(self, user: str) -> str:
+        '''
+        Return the working directory of a user.
+
+        :param user: user identifier
+        '''
+
+        with self.cond:
+            return self.user_cwd.get(user, '/')
+
+    def evict_idle(self) -> None:
+        '''
+        Close sessions which have been idle for too long.
+        '''
+
+        expired = []
+        with self.cond:
+            now = time.monotonic()
+            while self.idle and now - self.idle[0][1] > self.idle_timeout:
+                expired.append(self.idle.popleft()[0])
+                self.size -= 1
+        for client in expired:
+            self._close(client)
+
+    def checkout(self, user: str, timeout: float = None) -> ftp_client:
+        '''
+        Check out a session for a user, with the user's working directory.
+
+        Return the session, or None if no session is available.
+
+        :param user: user identifier
+        :param timeout: seconds to wait for a free session, forever if None
+        '''
+
+        self.evict_idle()
+        client = None
+        with self.cond:
+            while not self.idle and self.size >= self.max_size:
+                if not self.cond.wait(timeout):
+                    return None
+            if self.idle:
+                client, last_used = self.idle.pop()  # most recently used
+            else:
+                self.size += 1
+
+        if not client:
+            client = self._connect()
+            if not client:
+                return None
+        elif time.monotonic() - last_used > self.check_interval and not client.open():
+            log('warn', 'Session lost and failed to reconnect')  # open() reconnects
+            self.discard(client)
+            return None
+
+        cwd = self.get_cwd(user)
+        if client.cwd_path != cwd and not client.cwd(cwd):
+            client.cwd('/')
+        return client
+
+    def checkin(self, client: ftp_client, user: str) -> None:
+        '''
+        Return a session to the pool, and remember the user's working directory.
+
+        :param client: the session
+        :param user: user identifier
+        '''
+
+        client.close_data_conn()
+        if not client.ctrl_conn:  # broken
+            self.discard(client)
+            return
+        with self.cond:
+            self.user_cwd[user] = client.cwd_path
+            self.idle.append((client, time.monotonic()))
+            self.cond.notify()
+
+    def discard(self, client: ftp_client) -> None:
+        '''
+        Close a checked out session instead of returning it to the pool.
+
+        :param client: the session
+        '''
+
+        self._close(client)
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def session(self, user: str, timeout: float = None) -> Iterator[ftp_client]:
+        '''
+        Check out a session for a with block, yielding None if unavailable.
+
+        :param user: user identifier
+        :param timeout: seconds to wait for a free session, forever if None
+        '''
+
+        client = self.checkout(user, timeout)
+        try:
+            yield client
+        finally:
+            if client:
+                self.checkin(client, user)
+
+    def close(self) -> None:
+        '''
+        Close all idle sessions.
+        '''
+
+        with self.cond:
+            idle, self.idle = self.idle, deque()
+            self.size -= len(idle)
+        for client, _ in idle:
+            self._close(client)
@@ -1,10 +1,80 @@
+import json
+import os
+import posixpath
+from queue import Empty, Queue
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterator
 from naive_ftp.client.client import ftp_client
-from flask import Blueprint, request
+from naive_ftp.client_handler.event_relay import event_relay
+from naive_ftp.client_handler.listing_cache import listing_cache, listing_entry
+from naive_ftp.client_handler.pool import ftp_client_pool
+from naive_ftp.utils import log
+from flask import Blueprint, Response, make_response, request
 
 file_handler = Blueprint('file_handler', __name__)
 dir_handler = Blueprint('dir_handler', __name__)
+batch_handler = Blueprint('batch_handler', __name__)
+event_handler = Blueprint('event_handler', __name__)
+search_handler = Blueprint('search_handler', __name__)
 
-client = ftp_client(cli_mode=False)
+# Event streams open at most, each holding a thread of the web server,
+# but no FTP session, so that they are limited apart from the pool
+max_event_subscribers: int = 16
+
+# Seconds between heartbeats of event streams
+event_heartbeat: float = 15.0
+
+pool = ftp_client_pool()
+listings = listing_cache()
+relay = event_relay(max_event_subscribers)
+relay.on_event(lambda _: listings.clear())  # also catches changes by others
+
+# Size of chunks read from request bodies
+chunk_size: int = 65536
+
+# Maximum number of sessions used by a batch request
+batch_concurrency: int = 4
+
+# Seconds a batch request waits for a free session, and for the next result
+batch_checkout_timeout: float = 30.0
+batch_result_timeout: float = 600.0
+
+# Operations supported by batch requests
+batch_ops: Dict[str, Callable[[ftp_client, str], object]] = {
+    'retrieve': ftp_client.retrieve,
+    'store': ftp_client.store,
+    'delete': ftp_client.delete,
+    'mkdir': ftp_client.mkdir,
+    'rmdir': ftp_client.rmdir_all,
+}
+
+
+def listing_response(entry: listing_entry) -> Response:
+    '''
+    Return a conditional response of a directory listing,
+    which is 304 Not Modified if the client already has it.
+
+    :param entry: cached directory listing
+    '''
+
+    resp = make_response({
+        'data': entry.data,
+    })
+    resp.set_etag(entry.etag)
+    if entry.last_modified:
+        resp.last_modified = entry.last_modified
+    resp.cache_control.no_cache = True  # always revalidate
+    return resp.make_conditional(request)
+
+
+def get_user() -> str:
+    '''
+    Return the identifier of the web user, whose working directory is kept.
+
+    Use the X-Naive-FTP-User header if provided, otherwise the remote address.
+    '''
+
+    return request.headers.get('X-Naive-FTP-User', request.remote_addr)
 
 
 @file_handler.route('/file', methods=['GET', 'PUT', 'DELETE'])
@@ -28,8 +98,18 @@ def file():
         resp: { msg: str }
     '''
 
-    if not client.open():
-        return '', '503 Server down'
+    with pool.session(get_user()) as client:
+        if not client:
+            return '', '503 Server down'
+        return _file(client)
+
+
+def _file(client: ftp_client):
+    '''
+    Handle a file request with a checked out session.
+
+    :param client: FTP session
+    '''
 
     # RETR
     if request.method == 'GET':
@@ -52,6 +132,7 @@ def file():
         status: bool = client.store(path)
         if not status:
             return '', '404 Failed to upload'
+        listings.clear()
         return {
             'msg': path,
         }
@@ -65,18 +146,98 @@ def file():
         status: bool = client.delete(path)
         if not status:
             return '', '404 Failed to delete'
+        listings.clear()
         return {
             'msg': path,
         }
 
 
+@file_handler.route('/file/content', methods=['GET', 'PUT'])
+def file_content():
+    '''
+    RETR <server_path>, streamed without saving to local files
+
+        req: GET /api/file/content?path=:server_path
+        req_header: Range: bytes=:start-:end (optional)
+        resp: file content
+
+    STOR <file_name>, streamed from request body without local files
+
+        req: PUT /api/file/content?path=:file_name
+        req_body: file content
+        resp: { msg: str }
+    '''
+
+    path: str = request.args.get('path', type=str)
+    if not path:
+        return '', '400 Bad Request'
+    user = get_user()
+    client = pool.checkout(user)
+    if not client:
+        return '', '503 Server down'
+
+    # STOR
+    if request.method == 'PUT':
+        try:
+            chunks = iter(lambda: request.stream.read(chunk_size), b'')
+            status: bool = client.store_stream(path, chunks)
+        finally:
+            pool.checkin(client, user)
+        if not status:
+            return '', '404 Failed to upload'
+        listings.clear()
+        return {
+            'msg': path,
+        }
+
+    # RETR
+    try:
+        size: int = client.size(path)
+        if size is None:
+            pool.checkin(client, user)
+            return '', '404 Failed to download'
+        status_code = 200
+        offset, length = 0, size
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f'attachment; filename="{os.path.basename(path)}"',
+        }
+        if request.range:
+            byte_range = request.range.range_for_length(size)
+            if not byte_range:
+                pool.checkin(client, user)
+                return '', '416 Range Not Satisfiable', {'Content-Range': f'bytes */{size}'}
+            start, stop = byte_range
+            status_code = 206
+            offset, length = start, stop - start
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(length)
+        stream = client.retrieve_stream(path, offset, length)
+        if stream is None:
+            pool.checkin(client, user)
+            return '', '404 Failed to download'
+    except Exception:
+        pool.checkin(client, user)
+        raise
+
+    resp = Response(stream, status_code, headers, mimetype='application/octet-stream')
+
+    @resp.call_on_close
+    def _checkin() -> None:
+        stream.close()
+        pool.checkin(client, user)
+
+    return resp
+
+
 @dir_handler.route('/dir', methods=['GET', 'POST', 'PUT', 'DELETE'])
 def dir():
     '''
     LIST <server_path>
 
         req: GET /api/dir?path=:server_path
-        resp: { data: list[dict] }
+        req_header: If-None-Match: :etag (optional)
+        resp: { data: list[dict] }, or 304 Not Modified if the ETag matches
 
     CWD <server_path>
 
@@ -97,8 +258,25 @@ def dir():
         resp: { msg: str }
     '''
 
-    if not client.open():
-        return '', '503 Server down'
+    user = get_user()
+    if request.method == 'GET':  # served from cache without a session if possible
+        path: str = request.args.get('path', default='', type=str)
+        entry = listings.get(listings.key(pool.get_cwd(user), path))
+        if entry:
+            return listing_response(entry)
+
+    with pool.session(user) as client:
+        if not client:
+            return '', '503 Server down'
+        return _dir(client)
+
+
+def _dir(client: ftp_client):
+    '''
+    Handle a directory request with a checked out session.
+
+    :param client: FTP session
+    '''
 
     # LIST
     if request.method == 'GET':
@@ -106,9 +284,8 @@ def dir():
         data: list[dict] = client.ls(path)
         if data == None:
             return '', '404 Not found'
-        return {
-            'data': data,
-        }
+        key = listings.key(client.cwd_path, path)
+        return listing_response(listings.put(key, data, client.mdtm(path)))
 
     # CWD
     if request.method == 'POST':
@@ -132,6 +309,7 @@ def dir():
         status: bool = client.mkdir(path)
         if not status:
             return '', '403 Failed to create directory'
+        listings.clear()
         return {
             'msg': path,
         }
@@ -145,6 +323,180 @@ def dir():
         status = client.rmdir_all(path)
         if not status:
             return '', '403 Failed to remove directory'
+        listings.clear()
         return {
             'msg': path,
         }
+
+
+@batch_handler.route('/batch', methods=['POST'])
+def batch():
+    '''
+    A batch of RETR / STOR / DELE / MKD / RMDA, executed concurrently
+
+        req: POST /api/batch
+        req_body: { ops: list[{ op: str, path: str }] }
+                  op: 'retrieve' | 'store' | 'delete' | 'mkdir' | 'rmdir'
+        resp: NDJSON, a line for each finished operation in completion order
+              { index: int, op: str, path: str, ok: bool, msg: str }
+    '''
+
+    data: dict = request.get_json(silent=True) or {}
+    ops: list = data.get('ops')
+    if not isinstance(ops, list) or not all(
+        isinstance(item, dict)
+        and item.get('op') in batch_ops
+        and isinstance(item.get('path'), str)
+        and item.get('path')
+        for item in ops
+    ):
+        return '', '400 Bad Request'
+
+    user = get_user()
+    pending: Queue = Queue()
+    results: Queue = Queue()
+    for index, item in enumerate(ops):
+        pending.put((index, item['op'], item['path']))
+
+    def _run(client: ftp_client) -> None:
+        '''
+        Execute pending operations one by one, each failed without a session.
+
+        :param client: the pooled session, or None if unavailable
+        '''
+
+        while True:
+            try:
+                index, op, path = pending.get_nowait()
+            except Empty:  # all taken
+                return
+            try:
+                result = batch_ops[op](client, path) if client else None
+            except Exception as e:  # reported as a failure, so that the response is finished
+                log('warn', f'Batch operation {op} {path} failed, error: {e}')
+                result = None
+            if result and op != 'retrieve':
+                listings.clear()
+            results.put({
+                'index': index,
+                'op': op,
+                'path': path,
+                'ok': bool(result),
+                'msg': result if isinstance(result, str) else path,
+            })
+
+    workers = min(batch_concurrency, len(ops))
+    lock = Lock()
+    unavailable = [0]  # workers without a session
+
+    def _worker() -> None:
+        '''
+        Execute pending operations with a pooled session.
+
+        Without a session, operations are left to the other workers,
+        and failed by the last worker once none of them has got one.
+        '''
+
+        try:
+            with pool.session(user, batch_checkout_timeout) as client:
+                if client:
+                    _run(client)
+                    return
+        except Exception as e:  # e.g. failed to connect
+            log('warn', f'Batch session failed, error: {e}')
+        with lock:
+            unavailable[0] += 1
+            last = unavailable[0] == workers
+        if last:
+            _run(None)
+
+    def _generate() -> Iterator[str]:
+        missing = set(range(len(ops)))
+        while missing:
+            try:
+                result = results.get(timeout=batch_result_timeout)
+            except Empty:  # a stuck operation, reported as failed
+                for index in sorted(missing):
+                    item = ops[index]
+                    yield json.dumps({
+                        'index': index,
+                        'op': item['op'],
+                        'path': item['path'],
+                        'ok': False,
+                        'msg': 'Timed out',
+                    }) + '\n'
+                return
+            missing.discard(result['index'])
+            yield json.dumps(result) + '\n'
+
+    for _ in range(workers):
+        Thread(target=_worker, daemon=True).start()
+    return Response(_generate(), mimetype='application/x-ndjson')
+
+
+@event_handler.route('/events', methods=['GET'])
+def watch():
+    '''
+    SITE WATCH <server_path>, pushed as server-sent events
+
+        req: GET /api/events?path=:server_path
+        resp: text/event-stream, an event for each change of a direct child
+              of the directory, where path is relative to server root
+              data: { type: 'create' | 'modify' | 'delete', path: str, isDir: bool }
+    '''
+
+    path: str = request.args.get('path', '/', type=str)
+    if not path.startswith('/'):
+        path = posixpath.join(pool.get_cwd(get_user()), path)
+    dir_path = posixpath.normpath('/' + path.strip('/'))
+
+    q = relay.subscribe()
+    if not q:
+        return '', '503 Too many subscribers'
+
+    def _generate() -> Iterator[str]:
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event_type, ev_path, is_dir = q.get(timeout=event_heartbeat)
+                except Empty:
+                    yield ': ping\n\n'  # keep the connection alive
+                    continue
+                if posixpath.dirname(ev_path) != dir_path:
+                    continue
+                yield 'data: ' + json.dumps({
+                    'type': event_type,
+                    'path': ev_path,
+                    'isDir': is_dir,
+                }) + '\n\n'
+        finally:
+            relay.unsubscribe(q)
+
+    resp = Response(_generate(), mimetype='text/event-stream')
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+@search_handler.route('/search', methods=['GET'])
+def search():
+    '''
+    SITE FIND <text>
+
+        req: GET /api/search?q=:text
+        resp: { data: list[{ path: str, fileSize: int, fileType: str, modTime: str }] }
+    '''
+
+    text: str = request.args.get('q', type=str)
+    if not text or not text.strip():
+        return '', '400 Bad Request'
+    with pool.session(get_user()) as client:
+        if not client:
+            return '', '503 Server down'
+        results = client.find(text.strip())
+    if results is None:
+        return '', '404 Failed to search'
+    return {
+        'data': results,
+    }
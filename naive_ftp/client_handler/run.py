@@ -1,5 +1,12 @@
 from waitress import serve
 from naive_ftp.client_handler import client_handler
+from naive_ftp.client_handler.router import pool, relay
 
 if __name__ == '__main__':
-    serve(client_handler.app, host='127.0.0.1', port=5000)
+    # One FTP session for each worker thread, plus one thread for each event stream
+    serve(
+        client_handler.app,
+        host='127.0.0.1',
+        port=5000,
+        threads=pool.max_size + relay.max_subscribers,
+    )
@@ -0,0 +1,9 @@
+import asyncio
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from naive_ftp.client_handler import async_handler
+
+if __name__ == '__main__':
+    config = Config()
+    config.bind = ['127.0.0.1:5000']
+    asyncio.run(serve(async_handler.app, config))
@@ -0,0 +1,264 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Tuple
+from naive_ftp.utils import log
+
+# Password hashes are 'pbkdf2_sha256$<iterations>$<salt>$<hash>', in base64
+kdf_iterations: int = 200000
+
+
+def hash_password(password: str, iterations: int = None) -> str:
+    '''
+    Return a salted hash of a password for the user database.
+
+    :param password: the password
+    :param iterations: number of PBKDF2 iterations, kdf_iterations by default
+    '''
+
+    iterations = iterations or kdf_iterations
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+    return 'pbkdf2_sha256${}${}${}'.format(
+        iterations,
+        base64.b64encode(salt).decode('ascii'),
+        base64.b64encode(digest).decode('ascii'),
+    )
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    '''
+    Check a password against its hash, with a full key derivation.
+
+    Return True if matched.
+
+    :param password: the password
+    :param password_hash: hash from hash_password
+    '''
+
+    try:
+        algorithm, iterations, salt, expected = password_hash.split('$')
+        if algorithm != 'pbkdf2_sha256':
+            return False
+        digest = hashlib.pbkdf2_hmac(
+            'sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations),
+        )
+    except (ValueError, TypeError):
+        log('warn', 'Invalid password hash in user database')
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+class user():
+    '''
+    A user of the server.
+    '''
+
+    def __init__(self, name: str, password_hash: str, root: str = '', quota: int = None) -> None:
+        '''
+        Initialize user.
+
+        :param name: user name
+        :param password_hash: hash from hash_password
+        :param root: home directory relative to server root, which is the
+                     root directory seen by the user, server root if empty
+        :param quota: maximum bytes stored under the home directory, None if unlimited
+        '''
+
+        # Properties
+        self.name: str = name
+        self.password_hash: str = password_hash
+        self.root: str = root.strip('/')
+        self.quota: int = quota
+
+    def to_dict(self) -> dict:
+        return {'password': self.password_hash, 'root': self.root, 'quota': self.quota}
+
+
+class user_db():
+    '''
+    Users in a JSON file, shared by worker processes.
+
+    The file is reloaded when changed, so that users added by the console of
+    the main process take effect in workers. Successful logins are remembered
+    as keyed digests of the password for cache_ttl seconds, so that repeated
+    logins, e.g. from scripts, cost an HMAC instead of a full key derivation.
+    Failed logins are never cached.
+    '''
+
+    def __init__(self, path: str, cache_size: int = 1024, cache_ttl: float = 600.0) -> None:
+        '''
+        Initialize user database, loading the file if exists.
+
+        :param path: path to the JSON file
+        :param cache_size: maximum number of remembered logins
+        :param cache_ttl: seconds a login is remembered
+        '''
+
+        # Properties
+        self.path: str = path
+        self.cache_size: int = cache_size
+        self.cache_ttl: float = cache_ttl
+
+        # Users, and the signature of the file they are loaded from
+        self.lock: Lock = Lock()
+        self.users: Dict[str, user] = {}
+        self.file_sig: Tuple[int, int] = None
+
+        # Remembered logins, keyed by (name, password_hash), of (digest, expiry),
+        # with a key only known to this process
+        self.cache: OrderedDict[Tuple[str, str], Tuple[bytes, float]] = OrderedDict()
+        self.cache_key: bytes = secrets.token_bytes(32)
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self.dummy_hash: str = hash_password('')
+
+        self.reload()
+
+    def reload(self) -> None:
+        '''
+        Load the file again if changed since the last load.
+        '''
+
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        sig = (st.st_mtime_ns, st.st_size) if st else None
+        with self.lock:
+            if sig == self.file_sig:
+                return
+        users = {}
+        if st:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    raw = json.load(f)
+                for name, info in raw.get('users', {}).items():
+                    users[name] = user(name, info['password'], info.get('root', ''), info.get('quota'))
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                log('warn', f'Failed to load user database {self.path}, error: {e}')
+                return
+        with self.lock:
+            self.users, self.file_sig = users, sig
+        log('info', f'Loaded {len(users)} users from {self.path}')
+
+    def save(self) -> None:
+        '''
+        Write all users to the file atomically.
+        '''
+
+        with self.lock:
+            raw = {'users': {name: u.to_dict() for name, u in self.users.items()}}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(raw, f, indent=2)
+        os.replace(tmp_path, self.path)
+        st = os.stat(self.path)
+        with self.lock:
+            self.file_sig = (st.st_mtime_ns, st.st_size)
+
+    def get(self, name: str) -> user:
+        '''
+        Return a user, or None if not found.
+
+        :param name: user name
+        '''
+
+        self.reload()
+        with self.lock:
+            return self.users.get(name)
+
+    def verify(self, name: str, password: str) -> user:
+        '''
+        Check the password of a user.
+
+        Return the user if matched, otherwise None.
+
+        :param name: user name
+        :param password: the password
+        '''
+
+        u = self.get(name)
+        if not u:
+            check_password(password, self.dummy_hash)  # not to tell missing users apart by time
+            return None
+
+        key = (u.name, u.password_hash)  # forgotten once the password is changed
+        digest = hmac.new(self.cache_key, password.encode('utf-8'), hashlib.sha256).digest()
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and cached[1] > now and hmac.compare_digest(cached[0], digest):
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                return u
+            self.cache_misses += 1
+
+        if not check_password(password, u.password_hash):
+            return None
+        with self.lock:
+            self.cache[key] = (digest, now + self.cache_ttl)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return u
+
+    def add(self, name: str, password: str, root: str = '', quota: int = None) -> None:
+        '''
+        Add a user, or replace an existing one, and save the file.
+
+        :param name: user name
+        :param password: the password
+        :param root: home directory relative to server root
+        :param quota: maximum bytes stored under the home directory, None if unlimited
+        '''
+
+        self.reload()
+        u = user(name, hash_password(password), root, quota)
+        with self.lock:
+            self.users[name] = u
+        self.save()
+
+    def remove(self, name: str) -> bool:
+        '''
+        Remove a user and save the file.
+
+        Return True if removed.
+
+        :param name: user name
+        '''
+
+        self.reload()
+        with self.lock:
+            if self.users.pop(name, None) is None:
+                return False
+        self.save()
+        return True
+
+    def list(self) -> List[user]:
+        '''
+        Return all users.
+        '''
+
+        self.reload()
+        with self.lock:
+            return list(self.users.values())
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Return the number of users and hits of the login cache.
+        '''
+
+        with self.lock:
+            return {
+                'users': len(self.users),
+                'cached_logins': len(self.cache),
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+            }
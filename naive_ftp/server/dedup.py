@@ -0,0 +1,469 @@
+import hashlib
+import hmac
+import os
+import random
+import struct
+import time
+import uuid
+from threading import Lock
+from typing import BinaryIO, Dict, List, Tuple
+from naive_ftp.server.storage import local_storage
+from naive_ftp.utils import log
+
+
+# Manifest layout: MAGIC, chunk count (uint32), then for each chunk its
+# SHA-256 digest and size (uint32), then an HMAC-SHA256 of all the above
+# keyed by a secret of the server, so that no uploaded content, e.g. a small
+# file stored as it is, can be taken as a manifest. The file is then extended
+# to the size of its content with a sparse tail, so that st_size is still correct.
+MAGIC: bytes = b'\x00NFTPMANIFEST\x02'
+HEADER: struct.Struct = struct.Struct('<I')
+ENTRY: struct.Struct = struct.Struct('<32sI')
+MAC_SIZE: int = 32
+
+
+class chunker():
+    '''
+    Content-defined chunking with a gear rolling hash.
+
+    A chunk ends where the hash of its last 32 bytes matches a mask, so that
+    an insertion only changes the chunks around it, and the rest of the
+    file is deduplicated still.
+    '''
+
+    def __init__(self, min_size: int = 2048, avg_bits: int = 13, max_size: int = 65536) -> None:
+        '''
+        Initialize chunker.
+
+        :param min_size: minimum chunk size in bytes
+        :param avg_bits: log2 of the average chunk size beyond the minimum
+        :param max_size: maximum chunk size in bytes
+        '''
+
+        # Properties
+        self.min_size: int = min_size
+        self.max_size: int = max_size
+        self.mask: int = ((1 << avg_bits) - 1) << (32 - avg_bits)  # high bits
+        rng = random.Random(0x6e667470)  # fixed, so that boundaries are stable
+        self.gear: List[int] = [rng.getrandbits(32) for _ in range(256)]
+
+    def cut(self, data: memoryview) -> int:
+        '''
+        Return the size of the first chunk in data.
+
+        :param data: data, at least max_size bytes unless at the end of file
+        '''
+
+        n = len(data)
+        if n <= self.min_size:
+            return n
+        end = min(n, self.max_size)
+        h, gear, mask, i = 0, self.gear, self.mask, self.min_size
+        for b in data[self.min_size:end]:
+            h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+            i += 1
+            if not h & mask:
+                return i
+        return end
+
+
+class dedup_writer():
+    '''
+    Write a file into a dedup_storage, chunking the content as it arrives.
+
+    The manifest is written to a hidden temporary file as chunks are stored,
+    each entry before its chunk, so that gc() keeps the chunks of uploads
+    in progress, and replaces the file once finished.
+    '''
+
+    def __init__(self, storage: 'dedup_storage', path: str) -> None:
+        '''
+        Initialize writer.
+
+        :param storage: the storage
+        :param path: real path of the file
+        '''
+
+        self.storage: dedup_storage = storage
+        self.path: str = path
+        self.buffer: bytearray = bytearray()
+        self.entries: List[Tuple[bytes, int]] = []
+        self.size: int = 0
+        self.closed: bool = False
+        self.discarded: bool = False  # stored chunks are left to gc
+
+        # Temporary file, opened once the content is too large to be stored as it is
+        dir_name, file_name = os.path.split(path)
+        self.tmp_path: str = os.path.join(dir_name, f'.{file_name}.{uuid.uuid4().hex}.tmp')  # hidden
+        self.journal: BinaryIO = None
+
+    def __enter__(self) -> 'dedup_writer':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _flush(self, final: bool = False) -> None:
+        '''
+        Store complete chunks in the buffer.
+
+        :param final: store the remainder as well if True
+        '''
+
+        if not self.journal:
+            self.journal = open(self.tmp_path, 'wb')
+            self.journal.write(bytes(len(MAGIC) + HEADER.size))  # header written on close
+        cut = self.storage.chunker.cut
+        max_size = self.storage.chunker.max_size
+        view = memoryview(self.buffer)
+        offset = 0
+        while len(view) - offset >= max_size or (final and offset < len(view)):
+            size = cut(view[offset:offset+max_size])
+            with view[offset:offset+size] as chunk:
+                digest = hashlib.sha256(chunk).digest()
+                self.journal.write(ENTRY.pack(digest, size))
+                self.journal.flush()  # seen by gc() before the chunk is stored or reused
+                self.entries.append((self.storage.put_chunk(chunk, digest), size))
+            offset += size
+        view.release()
+        del self.buffer[:offset]
+
+    def write(self, data: bytes) -> int:
+        '''
+        Write data to the file.
+
+        Return the size of data.
+
+        :param data: data to write
+        '''
+
+        self.buffer += data
+        self.size += len(data)
+        if self.size >= self.storage.inline_size:
+            self._flush()
+        return len(data)
+
+    def close(self) -> None:
+        '''
+        Finish the file, replacing the old one atomically.
+        '''
+
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.discarded:
+                if self.journal:
+                    self.journal.close()
+                    os.remove(self.tmp_path)
+                return
+            if not self.journal:  # too small to be worth it
+                with open(self.tmp_path, 'wb') as f:
+                    f.write(self.buffer)
+            else:
+                with self.journal as f:
+                    self._flush(final=True)
+                    manifest = MAGIC + HEADER.pack(len(self.entries))
+                    manifest += b''.join(ENTRY.pack(digest, size) for digest, size in self.entries)
+                    f.write(self.storage.sign(manifest))
+                    f.seek(0)
+                    f.write(manifest[:len(MAGIC) + HEADER.size])
+                    f.truncate(self.size)  # sparse tail
+            os.replace(self.tmp_path, self.path)
+        except OSError:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+            raise
+        self.storage.count(self.size)
+
+
+class manifest_reader():
+    '''
+    Read a file of a dedup_storage, reassembling its chunks on demand.
+    '''
+
+    def __init__(self, storage: 'dedup_storage', entries: List[Tuple[bytes, int]]) -> None:
+        '''
+        Initialize reader.
+
+        :param storage: the storage
+        :param entries: digests and sizes of chunks
+        '''
+
+        self.storage: dedup_storage = storage
+        self.entries: List[Tuple[bytes, int]] = entries
+        self.index: int = 0        # current chunk
+        self.chunk_offset: int = 0  # offset in current chunk
+        self.chunk: bytes = None
+
+    def __enter__(self) -> 'manifest_reader':
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def seek(self, offset: int) -> int:
+        '''
+        Move to an offset of the file.
+
+        Return the new offset.
+
+        :param offset: offset from the beginning of the file
+        '''
+
+        self.index, self.chunk, pos = 0, None, 0
+        while self.index < len(self.entries) and pos + self.entries[self.index][1] <= offset:
+            pos += self.entries[self.index][1]
+            self.index += 1
+        self.chunk_offset = offset - pos
+        return offset
+
+    def read(self, size: int = -1) -> bytes:
+        '''
+        Read up to size bytes from the current chunk.
+
+        Return the data, or b'' at the end of file.
+
+        :param size: maximum number of bytes
+        '''
+
+        if self.index >= len(self.entries):
+            return b''
+        if self.chunk is None:
+            self.chunk = self.storage.get_chunk(self.entries[self.index][0])
+        end = len(self.chunk) if size < 0 else self.chunk_offset + size
+        data = self.chunk[self.chunk_offset:end]
+        self.chunk_offset += len(data)
+        if self.chunk_offset >= len(self.chunk):
+            self.index, self.chunk_offset, self.chunk = self.index + 1, 0, None
+        return data
+
+    def close(self) -> None:
+        self.chunk = None
+
+
+class dedup_storage(local_storage):
+    '''
+    Deduplicate file content by content-defined chunks.
+
+    Unique chunks are stored once by their SHA-256 digest in the chunk
+    directory, and files under the server root become manifests listing
+    their chunks. Small files and files stored before are kept as they are.
+    Chunks no longer referenced are removed by gc().
+    '''
+
+    cacheable: bool = False
+
+    def __init__(self, chunk_dir: str, base_dir: str, inline_size: int = 65536) -> None:
+        '''
+        Initialize dedup storage.
+
+        :param chunk_dir: real path of the chunk directory, outside the server root
+        :param base_dir: real path of the server root, scanned by gc()
+        :param inline_size: files smaller than this are stored as they are
+        '''
+
+        # Properties
+        self.chunk_dir: str = chunk_dir
+        self.base_dir: str = base_dir
+        self.inline_size: int = inline_size
+        self.chunker: chunker = chunker()
+
+        # Secret for manifests, shared by all processes through the chunk directory
+        self.key_path: str = os.path.join(chunk_dir, '.manifest_key')
+        self.key: bytes = None
+
+        # Statistics since startup
+        self.lock: Lock = Lock()
+        self.logical_bytes: int = 0
+        self.new_bytes: int = 0
+        self.chunks: int = 0
+        self.new_chunks: int = 0
+
+    def sign(self, manifest: bytes) -> bytes:
+        '''
+        Return the HMAC of a manifest, creating the secret if not yet.
+
+        :param manifest: the manifest without its HMAC
+        '''
+
+        if not self.key:
+            os.makedirs(self.chunk_dir, exist_ok=True)
+            try:
+                fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(os.urandom(32))
+            except FileExistsError:  # created before, or by another process
+                pass
+            with open(self.key_path, 'rb') as f:
+                key = f.read()
+            if len(key) != 32:  # being written by another process
+                raise OSError(f'Manifest key not ready: {self.key_path}')
+            self.key = key
+        return hmac.new(self.key, manifest, hashlib.sha256).digest()
+
+    def chunk_path(self, digest: bytes) -> str:
+        '''
+        Return the path of a chunk.
+
+        :param digest: SHA-256 digest of the chunk
+        '''
+
+        name = digest.hex()
+        return os.path.join(self.chunk_dir, name[:2], name[2:4], name)
+
+    def put_chunk(self, data: memoryview, digest: bytes = None) -> bytes:
+        '''
+        Store a chunk if not stored yet.
+
+        Return its digest.
+
+        :param data: content of the chunk
+        :param digest: SHA-256 digest of the chunk, computed if None
+        '''
+
+        digest = digest or hashlib.sha256(data).digest()
+        path = self.chunk_path(digest)
+        try:
+            os.utime(path)  # in use again, so that gc() keeps it
+            new = False
+        except FileNotFoundError:
+            new = True
+        if new:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.chunks += 1
+            if new:
+                self.new_chunks += 1
+                self.new_bytes += len(data)
+        return digest
+
+    def get_chunk(self, digest: bytes) -> bytes:
+        '''
+        Return the content of a chunk.
+
+        :param digest: SHA-256 digest of the chunk
+        '''
+
+        with open(self.chunk_path(digest), 'rb') as f:
+            return f.read()
+
+    def count(self, size: int) -> None:
+        '''
+        Count a stored file in statistics.
+
+        :param size: content size of the file
+        '''
+
+        with self.lock:
+            self.logical_bytes += size
+
+    def read_manifest(self, f: BinaryIO) -> List[Tuple[bytes, int]]:
+        '''
+        Parse the manifest of an opened file.
+
+        Return digests and sizes of its chunks, or None if not a manifest.
+
+        :param f: the file opened in binary mode
+        '''
+
+        header = f.read(len(MAGIC) + HEADER.size)
+        if not header.startswith(MAGIC) or len(header) < len(MAGIC) + HEADER.size:
+            return None
+        (count,) = HEADER.unpack_from(header, len(MAGIC))
+        size = os.fstat(f.fileno()).st_size
+        if len(header) + count * ENTRY.size + MAC_SIZE > size:
+            return None
+        raw = f.read(count * ENTRY.size)
+        if not hmac.compare_digest(f.read(MAC_SIZE), self.sign(header + raw)):  # e.g. uploaded as it is
+            return None
+        entries = [ENTRY.unpack_from(raw, i * ENTRY.size) for i in range(count)]
+        if sum(chunk_size for _, chunk_size in entries) != size:
+            return None
+        return entries
+
+    def open_read(self, path: str, offset: int = 0) -> BinaryIO:
+        f = open(path, 'rb')
+        try:
+            entries = self.read_manifest(f)
+        except (OSError, struct.error):
+            entries = None
+        if entries is None:  # a plain file
+            f.seek(offset)
+            return f
+        f.close()
+        reader = manifest_reader(self, entries)
+        reader.seek(offset)
+        return reader
+
+    def open_write(self, path: str) -> dedup_writer:
+        return dedup_writer(self, path)
+
+    def gc(self) -> int:
+        '''
+        Remove chunks not referenced by any file under the server root.
+
+        Uploads in progress keep the chunks listed in their temporary files.
+        Chunks they store or reuse after those are read are newer than the start
+        of the collection, as put_chunk() refreshes the time of a chunk it reuses,
+        and only older chunks are removed. A chunk is moved aside and
+        checked again before removed, so that a chunk reused meanwhile is kept,
+        or stored again by put_chunk() if already moved.
+
+        Return the number of removed chunks.
+        '''
+
+        start = time.time()
+        referenced = set()
+        for dir_path, _, file_names in os.walk(self.base_dir):
+            for name in file_names:
+                try:
+                    with open(os.path.join(dir_path, name), 'rb') as f:
+                        if name.startswith('.') and name.endswith('.tmp'):  # an upload in progress
+                            raw = f.read()[len(MAGIC) + HEADER.size:]
+                            entries = [ENTRY.unpack_from(raw, i) for i in range(0, len(raw) - ENTRY.size + 1, ENTRY.size)]
+                        else:
+                            entries = self.read_manifest(f)
+                except (OSError, struct.error):
+                    continue
+                if entries:
+                    referenced.update(digest.hex() for digest, _ in entries)
+
+        removed = 0
+        for dir_path, _, file_names in os.walk(self.chunk_dir):
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if name in referenced or name.startswith('.') or name.endswith(('.tmp', '.gc')):  # or the key
+                    continue
+                try:
+                    if os.stat(path).st_mtime >= start:
+                        continue
+                    gc_path = f'{path}.{uuid.uuid4().hex}.gc'
+                    os.rename(path, gc_path)
+                    if os.stat(gc_path).st_mtime >= start:  # reused meanwhile
+                        os.replace(gc_path, path)
+                        continue
+                    os.remove(gc_path)
+                    removed += 1
+                except OSError:
+                    pass
+        log('info', f'Removed {removed} unreferenced chunks')
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        '''
+        Return deduplication statistics since startup.
+        '''
+
+        with self.lock:
+            return {
+                'logical_bytes': self.logical_bytes,
+                'new_bytes': self.new_bytes,
+                'chunks': self.chunks,
+                'new_chunks': self.new_chunks,
+                'dedup_ratio': self.logical_bytes / self.new_bytes if self.new_bytes else None,
+            }
@@ -0,0 +1,208 @@
+import os
+import time
+from queue import Queue
+from threading import Lock, Thread
+from typing import Dict, Set, Tuple
+from naive_ftp.utils import log
+
+# An event is (event_type, path, is_dir), where event_type is
+# 'create' / 'modify' / 'delete', and path is relative to server root
+event = Tuple[str, str, bool]
+
+
+class event_bus():
+    '''
+    Publish file change events to subscribers, thread-safe.
+    '''
+
+    def __init__(self, dedup_window: float = 0.5) -> None:
+        '''
+        Initialize event bus.
+
+        :param dedup_window: seconds within which an identical event is dropped,
+                             as an operation may be reported by several sources
+        '''
+
+        # Properties
+        self.dedup_window: float = dedup_window
+
+        # Subscribers and recently published events
+        self.lock: Lock = Lock()
+        self.subscribers: Set[Queue] = set()
+        self.recent: Dict[event, float] = {}
+
+    def subscribe(self) -> Queue:
+        '''
+        Subscribe to all events.
+
+        Return a queue receiving the events.
+        '''
+
+        q = Queue()
+        with self.lock:
+            self.subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: Queue) -> None:
+        '''
+        Stop receiving events.
+
+        :param q: the queue returned by subscribe
+        '''
+
+        with self.lock:
+            self.subscribers.discard(q)
+
+    def publish(self, event_type: str, path: str, is_dir: bool = False) -> None:
+        '''
+        Publish an event to all subscribers.
+
+        :param event_type: 'create' / 'modify' / 'delete'
+        :param path: path relative to server root, starting with '/'
+        :param is_dir: True if the path is a directory
+        '''
+
+        ev = (event_type, path, is_dir)
+        now = time.monotonic()
+        with self.lock:
+            if now - self.recent.get(ev, -self.dedup_window) < self.dedup_window:
+                return
+            self.recent[ev] = now
+            if len(self.recent) > 1024:
+                self.recent = {
+                    k: t for k, t in self.recent.items()
+                    if now - t < self.dedup_window
+                }
+            for q in self.subscribers:
+                q.put(ev)
+
+
+class inotify_watcher(Thread):
+    '''
+    Publish changes made outside the server, using inotify (Linux only).
+
+    Require the optional package inotify_simple. If watching fails,
+    e.g. events are lost on overflow, the whole tree is watched again.
+    '''
+
+    def __init__(self, base_dir: str, bus: event_bus, retry_delay: float = 5.0) -> None:
+        '''
+        Initialize inotify watcher.
+
+        :param base_dir: real path of the server root
+        :param bus: event bus to publish to
+        :param retry_delay: seconds to wait before watching again after a failure
+        '''
+
+        super().__init__(daemon=True)
+
+        from inotify_simple import INotify, flags  # raise ImportError if missing
+
+        self.new_inotify = INotify
+        self.flags = flags
+        self.mask: int = (
+            flags.CREATE | flags.CLOSE_WRITE | flags.DELETE
+            | flags.MOVED_FROM | flags.MOVED_TO
+        )
+        self.base_dir: str = base_dir
+        self.bus: event_bus = bus
+        self.retry_delay: float = retry_delay
+        self.inotify: INotify = None
+        self.watches: Dict[int, str] = {}
+        self.open()
+
+    def open(self) -> None:
+        '''
+        Open a new inotify instance watching the whole tree, closing the old one.
+        '''
+
+        if self.inotify:
+            self.inotify.close()
+        self.inotify = self.new_inotify()
+        self.watches = {}
+        self.add_tree(self.base_dir)
+
+    def add_tree(self, path: str) -> None:
+        '''
+        Watch a directory and all its subdirectories.
+
+        :param path: real path of the directory
+        '''
+
+        for dir_path, _, _ in os.walk(path):
+            try:
+                self.watches[self.inotify.add_watch(dir_path, self.mask)] = dir_path
+            except OSError as e:
+                log('warn', f'Failed to watch {dir_path}, error: {e}')
+
+    def run(self) -> None:
+        '''
+        Main function for inotify watcher, watching again after a failure.
+        '''
+
+        while True:
+            try:
+                self.watch()
+            except Exception as e:  # not to stop publishing for good
+                log('warn', f'inotify watcher failed, restarting in {self.retry_delay}s, error: {e}')
+            time.sleep(self.retry_delay)
+            try:
+                self.open()
+            except OSError as e:
+                log('warn', f'Failed to restart inotify, error: {e}')
+            else:
+                log('info', 'inotify watcher restarted')
+
+    def watch(self) -> None:
+        '''
+        Publish events until events are lost or reading fails.
+        '''
+
+        flags = self.flags
+        while True:
+            for ev in self.inotify.read():
+                if ev.mask & flags.Q_OVERFLOW:
+                    raise OSError('event queue overflowed')
+                if ev.mask & flags.IGNORED:
+                    self.watches.pop(ev.wd, None)
+                    continue
+                parent = self.watches.get(ev.wd)
+                if not parent or not ev.name:
+                    continue
+                path = os.path.join(parent, ev.name)
+                is_dir = bool(ev.mask & flags.ISDIR)
+                if ev.mask & (flags.CREATE | flags.MOVED_TO):
+                    event_type = 'create'
+                    if is_dir:
+                        self.add_tree(path)
+                elif ev.mask & flags.CLOSE_WRITE:
+                    event_type = 'modify'
+                else:
+                    event_type = 'delete'
+                rel_path = '/' + os.path.relpath(path, self.base_dir).replace(os.sep, '/')
+                self.bus.publish(event_type, rel_path, is_dir)
+
+
+def start_inotify(base_dir: str) -> inotify_watcher:
+    '''
+    Start an inotify watcher if supported.
+
+    Return the watcher, or None if unavailable.
+
+    :param base_dir: real path of the server root
+    '''
+
+    try:
+        watcher = inotify_watcher(base_dir, events)
+    except ImportError:
+        log('info', 'inotify_simple not installed, external changes will not be published')
+        return None
+    except OSError as e:
+        log('warn', f'Failed to start inotify, error: {e}')
+        return None
+    watcher.start()
+    return watcher
+
+
+# Shared by all sessions in the process
+events: event_bus = event_bus()
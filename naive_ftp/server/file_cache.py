@@ -0,0 +1,144 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Tuple
+
+
+class file_cache():
+    '''
+    An in-memory LRU cache for the content of small files, shared by all sessions.
+
+    Entries are validated against (inode, size, mtime) on every lookup,
+    so that files changed behind the server's back are never served stale.
+    '''
+
+    def __init__(self, max_file_size: int = 65536, max_bytes: int = 67108864) -> None:
+        '''
+        Initialize file cache.
+
+        :param max_file_size: files larger than this are never cached, in bytes
+        :param max_bytes: total size budget of cached content, in bytes
+        '''
+
+        # Properties
+        self.max_file_size: int = max_file_size
+        self.max_bytes: int = max_bytes
+
+        # Cached entries, path -> (signature, content)
+        self.lock: Lock = Lock()
+        self.entries: OrderedDict[str, Tuple[tuple, bytes]] = OrderedDict()
+        self.total_bytes: int = 0
+
+        # Statistics
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def configure(self, max_file_size: int, max_bytes: int) -> None:
+        '''
+        Change cache limits at runtime, evicting entries if necessary.
+
+        :param max_file_size: files larger than this are never cached, in bytes
+        :param max_bytes: total size budget of cached content, in bytes
+        '''
+
+        with self.lock:
+            self.max_file_size = max_file_size
+            self.max_bytes = max_bytes
+            for path in [p for p, (sig, _) in self.entries.items() if sig[1] > max_file_size]:
+                self._pop(path)
+            self._evict()
+
+    def _pop(self, path: str) -> None:
+        '''
+        Remove an entry, the lock should be held.
+
+        :param path: real path of the file
+        '''
+
+        entry = self.entries.pop(path, None)
+        if entry:
+            self.total_bytes -= len(entry[1])
+
+    def _evict(self) -> None:
+        '''
+        Evict least recently used entries until within budget, the lock should be held.
+        '''
+
+        while self.total_bytes > self.max_bytes and self.entries:
+            _, (_, content) = self.entries.popitem(last=False)
+            self.total_bytes -= len(content)
+
+    def get(self, path: str) -> memoryview:
+        '''
+        Get the content of a small file, loading it into the cache on a miss.
+
+        Return the content, or None if the file is too large to be cached.
+
+        :param path: real path of the file
+        '''
+
+        def _signature(st: os.stat_result) -> tuple:
+            return st.st_ino, st.st_size, st.st_mtime_ns
+
+        st = os.stat(path)
+        if st.st_size > self.max_file_size or st.st_size > self.max_bytes:
+            return None
+        sig = _signature(st)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == sig:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return memoryview(entry[1])
+            self.misses += 1
+
+        with open(path, 'rb') as f:
+            sig = _signature(os.fstat(f.fileno()))
+            content = f.read(sig[1] + 1)
+            if len(content) != sig[1] or _signature(os.fstat(f.fileno())) != sig:
+                return None  # modified while reading
+        with self.lock:
+            self._pop(path)
+            self.entries[path] = (sig, content)
+            self.total_bytes += len(content)
+            self._evict()
+        return memoryview(content)
+
+    def invalidate(self, path: str) -> None:
+        '''
+        Drop a file from the cache, called after it is changed or deleted.
+
+        :param path: real path of the file
+        '''
+
+        with self.lock:
+            self._pop(path)
+
+    def invalidate_tree(self, path: str) -> None:
+        '''
+        Drop all files under a directory from the cache.
+
+        :param path: real path of the directory
+        '''
+
+        prefix = path + os.sep
+        with self.lock:
+            for p in [p for p in self.entries if p.startswith(prefix)]:
+                self._pop(p)
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Return usage statistics of the cache.
+        '''
+
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Shared by all sessions in the process
+hot_files: file_cache = file_cache()
@@ -0,0 +1,193 @@
+import itertools
+import os
+import posixpath
+import stat
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+# Identity of a file, (st_dev, st_ino, file type), or None if not exists
+identity = Optional[Tuple[int, int, int]]
+
+# Generation of the directory tree, bumped whenever any session changes it,
+# so that paths cached by other sessions in this process are dropped as well
+_generations = itertools.count(1)
+generation: int = 0
+
+
+def invalidate_all() -> None:
+    '''
+    Drop cached paths of all resolvers in this process.
+    '''
+
+    global generation
+    generation = next(_generations)  # atomic in CPython
+
+
+class path_resolver():
+    '''
+    Per-session path resolver.
+
+    The current working directory is resolved once on change, so that a
+    request path only costs one lstat per component of its own, relative
+    to a directory file descriptor of the working directory where supported.
+    Resolved paths are cached until the directory tree is changed by any session
+    in the process. If other processes change the tree as well, a cached path
+    is only used while its parent directory and itself are the same files,
+    costing two lstat calls instead of one per component.
+    '''
+
+    def __init__(self, base_dir: str, cache_size: int = 256, validate: bool = False) -> None:
+        '''
+        Initialize path resolver, using base_dir as working directory.
+
+        :param base_dir: real path of the root directory
+        :param cache_size: maximum number of cached paths
+        :param validate: True to check cached paths before use, if the tree
+                         is changed by other processes, e.g. workers
+        '''
+
+        # Properties
+        self.base_dir: str = base_dir
+        self.cache_size: int = cache_size
+        self.validate: bool = validate
+        self.use_dir_fd: bool = os.lstat in os.supports_dir_fd
+
+        # Current working directory
+        self.cwd_real: str = base_dir
+        self.cwd_fd: int = None
+
+        # Resolved paths, keyed by (base, path), valid in the tree generation,
+        # with identities of their parent directories and themselves if validated
+        self.cache: OrderedDict[Tuple[str, str], Tuple[str, Optional[Tuple[identity, identity]]]] = OrderedDict()
+        self.generation: int = generation
+
+        self.chdir(base_dir)
+
+    def _lstat(self, path: str) -> os.stat_result:
+        '''
+        Call lstat, relative to the working directory file descriptor if possible.
+
+        :param path: real path of its parent directory joined with the name
+        '''
+
+        if self.cwd_fd is not None and path.startswith(self.cwd_real + os.sep):
+            return os.lstat(path[len(self.cwd_real)+1:], dir_fd=self.cwd_fd)
+        return os.lstat(path)
+
+    def _identify(self, real_path: str) -> Tuple[identity, identity]:
+        '''
+        Return identities of the parent directory of a real path and itself.
+
+        A link swapped in for any directory on the path changes the parent,
+        and one swapped in for the file itself changes its type.
+
+        :param real_path: real path of the file
+        '''
+
+        ids = []
+        for path in (os.path.dirname(real_path), real_path):
+            try:
+                st = self._lstat(path)
+            except OSError:
+                ids.append(None)
+            else:
+                ids.append((st.st_dev, st.st_ino, stat.S_IFMT(st.st_mode)))
+        return ids[0], ids[1]
+
+    def _resolve(self, base: str, path: str) -> str:
+        '''
+        Resolve a path relative to a real directory.
+
+        Behave the same as os.path.realpath(os.path.join(base, path)),
+        without resolving base again.
+
+        :param base: real path of the directory to start from
+        :param path: path to resolve
+        '''
+
+        parts = path.replace(os.sep, '/').split('/')
+        resolved = base
+        for i, name in enumerate(parts):
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                resolved = os.path.dirname(resolved)
+                continue
+            resolved = os.path.join(resolved, name)
+            try:
+                st = self._lstat(resolved)
+            except OSError:  # not exist yet, resolve lexically like realpath
+                continue
+            if stat.S_ISLNK(st.st_mode):  # rare, leave it to realpath
+                return os.path.realpath(os.path.join(resolved, *parts[i+1:]))
+        return resolved
+
+    def resolve(self, path: str, follow_symlinks: bool = True) -> str:
+        '''
+        Parse a client request path to its real path.
+
+        Absolute paths start from the root directory, and relative paths
+        start from the current working directory.
+
+        :param path: path extracted from client request
+        :param follow_symlinks: False to resolve only the parent directory,
+                                keeping a link as the last component itself
+        '''
+
+        if not follow_symlinks:
+            head, name = posixpath.split(path.replace(os.sep, '/').rstrip('/'))
+            if name not in ('', '.', '..'):
+                return os.path.join(self.resolve(head or ('/' if path.startswith('/') else '.')), name)
+
+        if self.generation != generation:
+            self.cache.clear()
+            self.generation = generation
+        base = self.base_dir if path.startswith('/') else self.cwd_real
+        key = (base, path)
+        hit = self.cache.get(key)
+        if hit is not None:
+            resolved, ids = hit
+            if not self.validate or self._identify(resolved) == ids:
+                self.cache.move_to_end(key)
+                return resolved
+        resolved = self._resolve(base, path)
+        self.cache[key] = resolved, self._identify(resolved) if self.validate else None
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return resolved
+
+    def chdir(self, real_path: str) -> None:
+        '''
+        Change the working directory and reopen its file descriptor.
+
+        :param real_path: real path of the new working directory
+        '''
+
+        self.close()
+        self.cwd_real = real_path
+        if self.use_dir_fd:
+            try:
+                self.cwd_fd = os.open(real_path, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                self.cwd_fd = None
+
+    def invalidate(self) -> None:
+        '''
+        Drop all cached paths, called after the directory tree is changed.
+
+        Resolvers of other sessions drop theirs on next use.
+        '''
+
+        invalidate_all()
+        self.cache.clear()
+        self.generation = generation
+
+    def close(self) -> None:
+        '''
+        Drop all cached paths and close the working directory file descriptor.
+        '''
+
+        self.cache.clear()
+        if self.cwd_fd is not None:
+            os.close(self.cwd_fd)
+            self.cwd_fd = None
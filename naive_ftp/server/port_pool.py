@@ -0,0 +1,184 @@
+import socket
+import time
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, List
+from naive_ftp.utils import log
+
+
+class port_pool():
+    '''
+    A pool of pre-bound listening sockets for passive data connections.
+
+    Sessions lease a socket for a transfer and return it afterwards,
+    so that data ports stay within a fixed range and are never rebound.
+    Ports that fail to bind, e.g. still held by a previous server process
+    on restart, are bound again once the pool runs out.
+    '''
+
+    def __init__(self, host: str, ports: range, backlog: int = 5) -> None:
+        '''
+        Initialize port pool, binding and listening on all ports.
+
+        :param host: host address to bind
+        :param ports: data port range
+        :param backlog: backlog of each listening socket
+        '''
+
+        # Properties
+        self.host: str = host
+        self.ports: range = ports
+        self.backlog: int = backlog
+
+        # Idle sockets
+        self.lock: Lock = Lock()
+        self.idle: Deque[socket.socket] = deque()
+        self.missing: List[int] = []
+        self.size: int = 0
+        self.closed: bool = False
+
+        # Statistics
+        self.leases: int = 0
+        self.exhausted: int = 0
+        self.lease_time: float = 0.0
+        self.max_lease_time: float = 0.0
+        self.release_time: float = 0.0
+
+        for port in ports:
+            s = self._bind(port)
+            if not s:
+                self.missing.append(port)
+                continue
+            self.idle.append(s)
+            self.size += 1
+        if self.missing:
+            log('warn', f'Failed to bind {len(self.missing)} data ports, retried once the pool runs out')
+        log('info', f'Data port pool ready, {self.size} ports in {ports}')
+
+    def _bind(self, port: int) -> socket.socket:
+        '''
+        Return a listening socket bound to a port, or None if failed.
+
+        :param port: data port
+        '''
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((self.host, port))
+            s.listen(self.backlog)
+        except OSError:
+            s.close()
+            return None
+        return s
+
+    def _bind_missing(self) -> None:
+        '''
+        Bind ports that failed to bind before, e.g. released by a previous server process.
+        Called with the lock held.
+        '''
+
+        missing = []
+        for port in self.missing:
+            s = self._bind(port)
+            if s:
+                self.idle.append(s)
+                self.size += 1
+            else:
+                missing.append(port)
+        if len(missing) < len(self.missing):
+            log('info', f'Data port pool grown to {self.size} ports')
+        self.missing = missing
+
+    def lease(self, timeout: float) -> socket.socket:
+        '''
+        Lease a listening socket from the pool, with an empty backlog.
+
+        Return the socket, or None if the pool is exhausted.
+
+        :param timeout: timeout for accepting data connections
+        '''
+
+        start = time.perf_counter()
+        with self.lock:
+            if not self.idle and self.missing and not self.closed:
+                self._bind_missing()
+            s = self.idle.popleft() if self.idle else None
+            elapsed = time.perf_counter() - start
+            if not s:
+                self.exhausted += 1
+            else:
+                self.leases += 1
+                self.lease_time += elapsed
+                self.max_lease_time = max(self.max_lease_time, elapsed)
+        if not s:
+            log('warn', f'Data port pool exhausted, all {self.size} ports in use')
+            return None
+        self._drop_pending(s)  # queued while idle, e.g. a late connection of the previous session
+        s.settimeout(timeout)
+        return s
+
+    def _drop_pending(self, s: socket.socket) -> None:
+        '''
+        Drop connections pending in the backlog of a socket.
+
+        :param s: the listening socket
+        '''
+
+        s.setblocking(False)
+        try:
+            while True:
+                conn, _ = s.accept()
+                conn.close()
+        except OSError:  # no pending connections
+            pass
+
+    def release(self, s: socket.socket) -> None:
+        '''
+        Return a socket to the pool.
+
+        Pending connections left in its backlog are dropped, and again
+        on the next lease, so that they cannot be accepted by the next session.
+
+        :param s: the leased socket
+        '''
+
+        start = time.perf_counter()
+        self._drop_pending(s)
+        with self.lock:
+            if self.closed:  # ports handed over to the next server process
+                s.close()
+                self.size -= 1
+                return
+            self.idle.append(s)
+            self.release_time += time.perf_counter() - start
+
+    def stats(self) -> Dict[str, float]:
+        '''
+        Return usage and latency statistics of the pool.
+        '''
+
+        with self.lock:
+            leases = self.leases or 1
+            return {
+                'size': self.size,
+                'in_use': self.size - len(self.idle),
+                'missing': len(self.missing),
+                'leases': self.leases,
+                'exhausted': self.exhausted,
+                'avg_lease_us': self.lease_time / leases * 1e6,
+                'max_lease_us': self.max_lease_time * 1e6,
+                'avg_release_us': self.release_time / leases * 1e6,
+            }
+
+    def close(self) -> None:
+        '''
+        Close all idle sockets, and those in use once released,
+        so that the next server process can bind their ports.
+        '''
+
+        with self.lock:
+            self.closed = True
+            while self.idle:
+                self.size -= 1
+                self.idle.popleft().close()
@@ -0,0 +1,258 @@
+import os
+import sqlite3
+import stat
+import time
+from threading import Thread, local
+from typing import Dict, List, Tuple
+from naive_ftp.server.storage import storage_backend
+from naive_ftp.utils import log
+
+# A quota is (path, quota, used), where path is relative to server root, '/' for all files
+entry = Tuple[str, int, int]
+
+schema: str = '''
+CREATE TABLE IF NOT EXISTS quotas (
+    path TEXT PRIMARY KEY,
+    quota INTEGER NOT NULL,
+    used INTEGER NOT NULL,
+    checked REAL NOT NULL
+);
+'''
+
+
+def tree_size(storage: storage_backend, real_path: str) -> int:
+    '''
+    Return the total size of files in a directory tree, or the size of a file.
+
+    Uploads in progress, in hidden temporary files, are not counted.
+
+    :param storage: storage of the files
+    :param real_path: real path of the directory or file
+    '''
+
+    if not storage.isdir(real_path):
+        return storage.stat(real_path).st_size
+    total = 0
+    dirs = [real_path]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            files = list(storage.list(dir_path))
+        except OSError:  # removed meanwhile
+            continue
+        for name, st in files:
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(os.path.join(dir_path, name))
+            elif not (name.startswith('.') and name.endswith('.tmp')):  # see open_replacing
+                total += st.st_size
+    return total
+
+
+class quota_index():
+    '''
+    Quotas of directories, e.g. home directories of users, in SQLite.
+
+    The bytes used under each directory are kept as a running total,
+    changed by each upload or removal, so that checking a quota costs
+    a query instead of a walk of the tree. All worker processes update
+    the same totals. Totals are reconciled with the storage by a walk
+    in background, every interval seconds, or soon after a change whose
+    size is not known, e.g. a copied tree.
+    '''
+
+    def __init__(self, db_path: str, base_dir: str, interval: float = 3600.0, poll: float = 10.0) -> None:
+        '''
+        Initialize quota index.
+
+        :param db_path: path to the database file
+        :param base_dir: real path of the server root
+        :param interval: seconds between reconciliations of a quota
+        :param poll: seconds between checks for quotas to reconcile
+        '''
+
+        # Properties
+        self.db_path: str = db_path
+        self.base_dir: str = base_dir
+        self.interval: float = interval
+        self.poll: float = poll
+
+        # Connections of each thread
+        self.conns: local = local()
+        self.reconciler: Thread = None
+
+    def _connect(self) -> sqlite3.Connection:
+        '''
+        Return the connection of the current thread, opening it if not yet.
+        '''
+
+        conn = getattr(self.conns, 'conn', None)
+        if not conn:
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(schema)
+            self.conns.conn = conn
+        return conn
+
+    def _select(self, path: str) -> List[entry]:
+        '''
+        Return the quotas of a path and of all its parent directories.
+
+        :param path: path relative to server root
+        '''
+
+        return self._connect().execute(
+            "SELECT path, quota, used FROM quotas WHERE path = '/' OR path = ? "
+            "OR substr(?, 1, length(path) + 1) = path || '/'",
+            (path, path),
+        ).fetchall()
+
+    def remaining(self, path: str) -> int:
+        '''
+        Return the bytes that can still be stored at a path, under all quotas
+        of its directories, or None if unlimited.
+
+        :param path: path relative to server root
+        '''
+
+        try:
+            rows = self._select(path)
+        except sqlite3.Error as e:
+            log('warn', f'Failed to read quotas, error: {e}')
+            return None
+        return min((quota - used for _, quota, used in rows), default=None)
+
+    def charge(self, path: str, delta: int) -> None:
+        '''
+        Add the change of size at a path to all quotas of its directories.
+
+        :param path: path relative to server root
+        :param delta: bytes added, or removed if negative
+        '''
+
+        if not delta:
+            return
+        try:
+            self._connect().execute(
+                "UPDATE quotas SET used = max(used + ?, 0) WHERE path = '/' OR path = ? "
+                "OR substr(?, 1, length(path) + 1) = path || '/'",
+                (delta, path, path),
+            )
+        except sqlite3.Error as e:
+            log('warn', f'Failed to update quotas, error: {e}')
+
+    def mark(self, path: str) -> None:
+        '''
+        Reconcile all quotas of a path soon, after a change of unknown size.
+
+        :param path: path relative to server root
+        '''
+
+        try:
+            self._connect().execute(
+                "UPDATE quotas SET checked = 0 WHERE path = '/' OR path = ? "
+                "OR substr(?, 1, length(path) + 1) = path || '/' "
+                "OR substr(path, 1, length(?) + 1) = ? || '/'",  # or under the path, e.g. a renamed tree
+                (path, path, path.rstrip('/'), path.rstrip('/')),
+            )
+        except sqlite3.Error as e:
+            log('warn', f'Failed to update quotas, error: {e}')
+
+    def set(self, path: str, quota: int, storage: storage_backend) -> None:
+        '''
+        Set the quota of a directory, counting its usage if new.
+
+        :param path: path relative to server root
+        :param quota: maximum bytes stored under the directory
+        :param storage: storage of the files
+        '''
+
+        path = '/' + path.strip('/')
+        try:
+            conn = self._connect()
+            if conn.execute('SELECT 1 FROM quotas WHERE path = ?', (path,)).fetchone():
+                conn.execute('UPDATE quotas SET quota = ? WHERE path = ?', (quota, path))
+                return
+            conn.execute('INSERT OR IGNORE INTO quotas VALUES (?, ?, 0, 0)', (path, quota))
+            self.reconcile(path, storage)
+        except sqlite3.Error as e:
+            log('warn', f'Failed to set quota of {path}, error: {e}')
+
+    def remove(self, path: str) -> bool:
+        '''
+        Remove the quota of a directory.
+
+        Return True if removed.
+
+        :param path: path relative to server root
+        '''
+
+        path = '/' + path.strip('/')
+        return self._connect().execute('DELETE FROM quotas WHERE path = ?', (path,)).rowcount > 0
+
+    def list(self) -> List[entry]:
+        '''
+        Return all quotas.
+        '''
+
+        return self._connect().execute('SELECT path, quota, used FROM quotas ORDER BY path').fetchall()
+
+    def reconcile(self, path: str, storage: storage_backend) -> None:
+        '''
+        Count the usage of a quota by a walk, keeping changes made meanwhile.
+
+        :param path: path of the quota, relative to server root
+        :param storage: storage of the files
+        '''
+
+        conn = self._connect()
+        row = conn.execute('SELECT used FROM quotas WHERE path = ?', (path,)).fetchone()
+        if not row:
+            return
+        start = time.monotonic()
+        real_path = os.path.join(self.base_dir, path.lstrip('/'))
+        try:
+            size = tree_size(storage, real_path)
+        except OSError:  # not made yet
+            size = 0
+        conn.execute(
+            'UPDATE quotas SET used = max(? + used - ?, 0), checked = ? WHERE path = ?',
+            (size, row[0], time.time(), path),
+        )
+        if size != row[0]:
+            log('info', f'Quota usage of {path} corrected from {row[0]} to {size} B')
+        log('debug', f'Reconciled quota of {path} in {time.monotonic() - start:.3f}s')
+
+    def start(self, storage: storage_backend) -> None:
+        '''
+        Start reconciling quotas in background, in a single process.
+
+        :param storage: storage of the files
+        '''
+
+        def _reconcile() -> None:
+            while True:
+                try:
+                    due = self._connect().execute(
+                        'SELECT path FROM quotas WHERE checked < ?',
+                        (time.time() - self.interval,),
+                    ).fetchall()
+                    for path, in due:
+                        self.reconcile(path, storage)
+                except sqlite3.Error as e:
+                    log('warn', f'Failed to reconcile quotas, error: {e}')
+                time.sleep(self.poll)
+
+        self.reconciler = Thread(target=_reconcile, daemon=True)
+        self.reconciler.start()
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Return the number of quotas and those over quota.
+        '''
+
+        rows = self.list()
+        return {
+            'quotas': len(rows),
+            'over_quota': sum(used > quota for _, quota, used in rows),
+        }
@@ -0,0 +1,254 @@
+import math
+import time
+from threading import Lock
+from typing import Dict, List, Set
+
+# Lowest rate in bytes per second, other than 0 for unlimited
+min_rate: float = 1.0
+
+# Longest sleep in seconds at a time, so that a cancelled session stops waiting
+max_sleep: float = 1.0
+
+
+def check_rate(rate: float) -> float:
+    '''
+    Validate a rate in bytes per second.
+
+    Return the rate, or raise ValueError if it is negative, not finite,
+    or lower than min_rate but not 0.
+
+    :param rate: rate in bytes per second, 0 for unlimited
+    '''
+
+    if not math.isfinite(rate) or rate < 0 or 0 < rate < min_rate:
+        raise ValueError(f'Invalid rate: {rate}')
+    return rate
+
+
+class token_bucket():
+    '''
+    A thread-safe token bucket, where a token stands for a byte.
+    '''
+
+    def __init__(self, rate: float = 0.0, burst: float = 0.0) -> None:
+        '''
+        Initialize token bucket.
+
+        :param rate: refill rate in bytes per second, 0 for unlimited
+        :param burst: capacity of the bucket in bytes,
+                      using one second of refill by default
+        '''
+
+        self.lock: Lock = Lock()
+        self.rate: float = 0.0
+        self.burst: float = 0.0
+        self.tokens: float = 0.0
+        self.last_time: float = time.monotonic()
+        self.configure(rate, burst)
+
+    def configure(self, rate: float, burst: float = 0.0) -> None:
+        '''
+        Change the refill rate of the bucket.
+
+        Raise ValueError if the rate is not valid, see check_rate.
+
+        :param rate: refill rate in bytes per second, 0 for unlimited
+        :param burst: capacity of the bucket in bytes,
+                      using one second of refill by default
+        '''
+
+        check_rate(rate)
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst > 0 else self.rate
+            self.tokens = min(self.tokens, self.burst) if self.tokens else self.burst
+
+    def reserve(self, size: int) -> float:
+        '''
+        Take tokens from the bucket, going into debt if necessary.
+
+        Return the seconds to wait before the tokens can be used.
+
+        :param size: number of tokens to take
+        '''
+
+        with self.lock:
+            if self.rate <= 0:
+                return 0.0
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.last_time) * self.rate,
+            )
+            self.last_time = now
+            self.tokens -= size
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class session_limiter():
+    '''
+    Rate limiter for the data channel of a single session.
+
+    Bytes are accounted in batches of quantum bytes, so that the buckets
+    are only consulted once per batch instead of once per chunk.
+    Batches are no larger than one second of the lowest rate.
+    '''
+
+    def __init__(self, limiter: 'rate_limiter', host: str, quantum: int) -> None:
+        '''
+        Initialize session limiter.
+
+        :param limiter: the rate limiter it belongs to
+        :param host: client host address
+        :param quantum: number of bytes accounted in a batch
+        '''
+
+        self.limiter: rate_limiter = limiter
+        self.host: str = host
+        self.quantum: int = quantum
+        self.pending: int = 0
+        self.bucket: token_bucket = token_bucket(limiter.session_rate)
+        self.closed: bool = False
+        self.cancelled: bool = False
+
+    def consume(self, size: int) -> None:
+        '''
+        Account transferred bytes, and sleep if any bucket runs out of tokens.
+
+        :param size: number of bytes transferred
+        '''
+
+        self.pending += size
+        if self.pending < min(self.quantum, self.limiter.batch):
+            return
+        size, self.pending = self.pending, 0
+        delay = max(b.reserve(size) for b in self.limiter.get_buckets(self))
+        while delay > 0 and not self.cancelled:
+            time.sleep(min(delay, max_sleep))
+            delay -= max_sleep
+
+    def cancel(self) -> None:
+        '''
+        Stop waiting for tokens from another thread, e.g. on shutdown.
+        '''
+
+        self.cancelled = True
+
+    def close(self) -> None:
+        '''
+        Release the session from its rate limiter.
+        '''
+
+        if not self.closed:
+            self.closed = True
+            self.limiter.close_session(self)
+
+
+class rate_limiter():
+    '''
+    Token bucket rate limiter, shaping bandwidth globally,
+    per client host and per session.
+    '''
+
+    def __init__(self) -> None:
+        '''
+        Initialize rate limiter, unlimited by default.
+        '''
+
+        # Properties
+        self.quantum: int = 16384
+        self.global_rate: float = 0.0
+        self.host_rate: float = 0.0
+        self.session_rate: float = 0.0
+        self.batch: float = math.inf  # lowest rate limited
+
+        # Buckets
+        self.lock: Lock = Lock()
+        self.global_bucket: token_bucket = token_bucket()
+        self.host_buckets: Dict[str, token_bucket] = {}
+        self.host_refs: Dict[str, int] = {}
+        self.sessions: Set[session_limiter] = set()
+
+    def configure(
+        self,
+        global_rate: float = None,
+        host_rate: float = None,
+        session_rate: float = None,
+    ) -> None:
+        '''
+        Change rate limits at runtime, applied to all active sessions.
+
+        Raise ValueError if any rate is not valid, see check_rate.
+
+        :param global_rate: bytes per second shared by all sessions, 0 for unlimited
+        :param host_rate: bytes per second shared by each client host, 0 for unlimited
+        :param session_rate: bytes per second for each session, 0 for unlimited
+        '''
+
+        for rate in (global_rate, host_rate, session_rate):
+            if rate is not None:
+                check_rate(rate)
+        with self.lock:
+            if global_rate is not None:
+                self.global_rate = global_rate
+                self.global_bucket.configure(global_rate)
+            if host_rate is not None:
+                self.host_rate = host_rate
+                for bucket in self.host_buckets.values():
+                    bucket.configure(host_rate)
+            if session_rate is not None:
+                self.session_rate = session_rate
+                for session in self.sessions:
+                    session.bucket.configure(session_rate)
+            rates = [r for r in (self.global_rate, self.host_rate, self.session_rate) if r > 0]
+            self.batch = min(rates, default=math.inf)
+
+    def open_session(self, host: str) -> session_limiter:
+        '''
+        Register a new session.
+
+        Return the session limiter.
+
+        :param host: client host address
+        '''
+
+        session = session_limiter(self, host, self.quantum)
+        with self.lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = token_bucket(self.host_rate)
+                self.host_refs[host] = 0
+            self.host_refs[host] += 1
+            self.sessions.add(session)
+        return session
+
+    def close_session(self, session: session_limiter) -> None:
+        '''
+        Unregister a session, dropping its host bucket if no longer used.
+
+        :param session: the session limiter
+        '''
+
+        with self.lock:
+            self.sessions.discard(session)
+            host = session.host
+            self.host_refs[host] -= 1
+            if not self.host_refs[host]:
+                del self.host_buckets[host]
+                del self.host_refs[host]
+
+    def get_buckets(self, session: session_limiter) -> List[token_bucket]:
+        '''
+        Return all buckets a session should take tokens from.
+
+        :param session: the session limiter
+        '''
+
+        return [
+            session.bucket,
+            self.host_buckets[session.host],
+            self.global_bucket,
+        ]
+
+
+# Shared by all sessions in the process
+limiter: rate_limiter = rate_limiter()
@@ -0,0 +1,273 @@
+import itertools
+import os
+import time
+import uuid
+from collections import OrderedDict
+from queue import Queue
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List
+from naive_ftp.utils import log
+
+
+class remove_job():
+    '''
+    A directory tree being removed in background.
+    '''
+
+    def __init__(self, job_id: str, path: str, on_unlink: Callable[[int], None] = None) -> None:
+        '''
+        Initialize remove job.
+
+        :param job_id: job identifier
+        :param path: path shown to the client
+        :param on_unlink: called with the bytes of files unlinked in each directory
+        '''
+
+        # Properties
+        self.job_id: str = job_id
+        self.path: str = path
+        self.on_unlink: Callable[[int], None] = on_unlink
+        self.start_time: float = time.monotonic()
+        self.end_time: float = None
+
+        # Progress
+        self.files: int = 0
+        self.dirs: int = 0
+        self.errors: int = 0
+        self.done: Event = Event()
+
+    def status(self) -> str:
+        '''
+        Return a one-line status of the job.
+        '''
+
+        elapsed = (self.end_time or time.monotonic()) - self.start_time
+        state = 'done' if self.done.is_set() else 'running'
+        return (
+            f'Job {self.job_id} {state}: {self.path}, {self.files} files and '
+            f'{self.dirs} directories removed, {self.errors} errors, {elapsed:.1f}s'
+        )
+
+
+class _dir_node():
+    '''
+    A directory to scan, removed after all its subdirectories are removed.
+    '''
+
+    def __init__(self, path: str, parent: '_dir_node') -> None:
+        self.path: str = path
+        self.parent: _dir_node = parent
+        self.pending: int = 1  # its own scan, plus one for each subdirectory
+
+
+class tree_remover():
+    '''
+    Remove directory trees in background with a pool of threads.
+
+    Directories of all jobs are scanned in parallel, and files are unlinked
+    relative to a file descriptor of their directory where supported.
+    A tree can be renamed into a trash directory first, so that it is gone
+    from the client's view at once.
+    '''
+
+    def __init__(self, trash_dir: str, workers: int = 4, max_jobs: int = 256) -> None:
+        '''
+        Initialize tree remover. Workers are started on the first job.
+
+        :param trash_dir: real path of the trash directory, which should be
+                          outside the server root but on the same file system
+        :param workers: number of worker threads
+        :param max_jobs: number of jobs kept for status queries
+        '''
+
+        # Properties
+        self.trash_dir: str = trash_dir
+        self.workers: int = workers
+        self.max_jobs: int = max_jobs
+        self.use_dir_fd: bool = os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+
+        # Jobs and directories to scan, with job identifiers prefixed by the
+        # worker index in multi-process mode, e.g. '2.17', to be unique across workers
+        self.lock: Lock = Lock()
+        self.jobs: OrderedDict[str, remove_job] = OrderedDict()
+        self.job_ids: itertools.count = itertools.count(1)
+        self.id_prefix: str = ''
+        self.queue: Queue = Queue()
+        self.threads: List[Thread] = []
+
+    def move_to_trash(self, path: str) -> str:
+        '''
+        Rename a directory into the trash directory.
+
+        Return the new path, or None if failed, e.g. across file systems.
+
+        :param path: real path of the directory
+        '''
+
+        dst_path = os.path.join(self.trash_dir, uuid.uuid4().hex)
+        try:
+            os.makedirs(self.trash_dir, exist_ok=True)
+            os.rename(path, dst_path)
+        except OSError as e:
+            log('info', f'Failed to move {path} to trash, error: {e}')
+            return None
+        return dst_path
+
+    def submit(
+        self, path: str, display_path: str = None, on_unlink: Callable[[int], None] = None,
+    ) -> remove_job:
+        '''
+        Remove a directory tree in background.
+
+        Return the job.
+
+        :param path: real path of the directory
+        :param display_path: path shown in the job status, path by default
+        :param on_unlink: called with the bytes of files unlinked in each directory,
+                          which are not counted if None
+        '''
+
+        with self.lock:
+            job = remove_job(f'{self.id_prefix}{next(self.job_ids)}', display_path or path, on_unlink)
+            self.jobs[job.job_id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self._work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+        self.queue.put((job, _dir_node(path, None)))
+        return job
+
+    def empty_trash(self) -> None:
+        '''
+        Remove everything left in the trash directory, e.g. after a crash.
+        '''
+
+        try:
+            names = os.listdir(self.trash_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.trash_dir, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                self.submit(path)
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                log('warn', f'Failed to remove {path} from trash, error: {e}')
+
+    def get_job(self, job_id: str) -> remove_job:
+        '''
+        Return a job, or None if not found.
+
+        :param job_id: job identifier
+        '''
+
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _scan(self, job: remove_job, node: _dir_node) -> None:
+        '''
+        Unlink all files in a directory, and queue its subdirectories.
+
+        :param job: the job
+        :param node: the directory
+        '''
+
+        subdirs = []
+        files = errors = size = 0
+        count_size = job.on_unlink is not None
+        try:
+            if self.use_dir_fd:
+                fd = os.open(node.path, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    with os.scandir(fd) as it:
+                        for entry in it:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(os.path.join(node.path, entry.name))
+                                continue
+                            try:
+                                file_size = entry.stat(follow_symlinks=False).st_size if count_size else 0
+                                os.unlink(entry.name, dir_fd=fd)
+                                files += 1
+                                size += file_size
+                            except OSError:
+                                errors += 1
+                finally:
+                    os.close(fd)
+            else:
+                with os.scandir(node.path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        try:
+                            file_size = entry.stat(follow_symlinks=False).st_size if count_size else 0
+                            os.unlink(entry.path)
+                            files += 1
+                            size += file_size
+                        except OSError:
+                            errors += 1
+        except OSError:
+            errors += 1
+
+        with self.lock:
+            job.files += files
+            job.errors += errors
+            node.pending += len(subdirs)
+        if size:
+            job.on_unlink(size)
+        for path in subdirs:
+            self.queue.put((job, _dir_node(path, node)))
+        self._finish(job, node)
+
+    def _finish(self, job: remove_job, node: _dir_node) -> None:
+        '''
+        Mark a scan or a subdirectory of a directory as finished,
+        and remove the directory if nothing is pending.
+
+        :param job: the job
+        :param node: the directory
+        '''
+
+        while node:
+            with self.lock:
+                node.pending -= 1
+                if node.pending:
+                    return
+            try:
+                os.rmdir(node.path)
+                removed, failed = 1, 0
+            except OSError:
+                removed, failed = 0, 1
+            with self.lock:
+                job.dirs += removed
+                job.errors += failed
+            node = node.parent
+
+        job.end_time = time.monotonic()
+        job.done.set()
+        log('info', job.status())
+
+    def _work(self) -> None:
+        '''
+        Main function for workers.
+        '''
+
+        while True:
+            job, node = self.queue.get()
+            self._scan(job, node)
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Return the number of running jobs and queued directories.
+        '''
+
+        with self.lock:
+            running = sum(not job.done.is_set() for job in self.jobs.values())
+        return {
+            'running': running,
+            'queued_dirs': self.queue.qsize(),
+        }
@@ -0,0 +1,338 @@
+import os
+import sqlite3
+import time
+from queue import Empty, Queue
+from threading import Lock, Thread, local
+from typing import Dict, List, Tuple
+from naive_ftp.server.events import event_bus
+from naive_ftp.utils import log
+
+# A search result is (path, size, mtime, is_dir), where path is relative to server root
+entry = Tuple[str, int, float, bool]
+
+schema: str = '''
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    is_dir INTEGER NOT NULL,
+    gen INTEGER NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(
+    name, content='files', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS files_insert AFTER INSERT ON files BEGIN
+    INSERT INTO names(rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS files_delete AFTER DELETE ON files BEGIN
+    INSERT INTO names(names, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+# Generation of changed rows, the latest one being built or finished,
+# read in the writing transaction, so that rows written by other processes
+# during a rebuild are not dropped when it finishes
+current_gen: str = "(SELECT COALESCE(MAX(value), 0) FROM meta WHERE key IN ('gen', 'building'))"
+
+
+class metadata_index():
+    '''
+    A persistent index of names and metadata of all files on server, in SQLite.
+
+    Names are indexed by FTS5 with trigrams, so that a substring search takes
+    milliseconds regardless of the number of files. The index is rebuilt by
+    a parallel scanner at startup, while searches are served from the previous
+    build, and kept current by change events. All writes go through a single
+    writer thread in batches; each searching thread has its own connection.
+    '''
+
+    def __init__(self, db_path: str, base_dir: str, scan_workers: int = 8, batch_size: int = 5000) -> None:
+        '''
+        Initialize metadata index.
+
+        :param db_path: path to the database file
+        :param base_dir: real path of the server root
+        :param scan_workers: number of threads scanning directories on rebuild
+        :param batch_size: maximum number of rows written in a transaction
+        '''
+
+        # Properties
+        self.db_path: str = db_path
+        self.base_dir: str = base_dir
+        self.scan_workers: int = scan_workers
+        self.batch_size: int = batch_size
+
+        # Writes, as ('rows', rows) / ('event', event) / ('finish', gen)
+        self.writes: Queue = Queue()
+        self.gen: int = 0
+        self.writer: Thread = None
+        self.available: bool = False
+
+        # Read connections of each thread
+        self.readers: local = local()
+
+        # Directories left to scan in the current rebuild
+        self.lock: Lock = Lock()
+        self.pending_dirs: int = 0
+        self.scan_start: float = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        '''
+        Open a connection to the database.
+        '''
+
+        conn = sqlite3.connect(self.db_path, timeout=30.0, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self, bus: event_bus = None) -> bool:
+        '''
+        Create the database if not exists, and start applying change events.
+
+        Return True if succeeded.
+
+        :param bus: event bus to subscribe to, or None to serve searches only,
+                    e.g. in a worker process whose changes are written by the supervisor
+        '''
+
+        try:
+            conn = self._connect()
+            conn.executescript(schema)
+            self.gen = conn.execute(f'SELECT {current_gen}').fetchone()[0]
+        except sqlite3.Error as e:  # e.g. FTS5 or trigram unavailable
+            log('warn', f'Failed to open metadata index, error: {e}')
+            return False
+        self.available = True
+        if not bus:
+            conn.close()
+            return True
+        events = bus.subscribe()
+
+        def _forward() -> None:
+            while True:
+                self.writes.put(('event', events.get()))
+
+        Thread(target=_forward, daemon=True).start()
+        self.writer = Thread(target=self._write, args=(conn,), daemon=True)
+        self.writer.start()
+        return True
+
+    def rebuild(self) -> None:
+        '''
+        Scan the whole server in background, replacing the index when finished.
+        '''
+
+        with self.lock:
+            if self.pending_dirs:  # already rebuilding
+                return
+            try:  # before scanning, so that later changes are written in the new generation
+                conn = self._connect()
+                with conn:
+                    self.gen = conn.execute(f'SELECT {current_gen}').fetchone()[0] + 1
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('building', ?)", (self.gen,))
+                conn.close()
+            except sqlite3.Error as e:
+                log('warn', f'Failed to rebuild metadata index, error: {e}')
+                return
+            self.pending_dirs = 1
+            self.scan_start = time.monotonic()
+        gen = self.gen
+        dirs: Queue = Queue()
+        dirs.put(self.base_dir)
+
+        def _scan() -> None:
+            while True:
+                try:
+                    path = dirs.get(timeout=1.0)
+                except Empty:
+                    with self.lock:
+                        if not self.pending_dirs:
+                            return
+                    continue
+                rows = []
+                try:
+                    with os.scandir(path) as it:
+                        for file in it:
+                            try:
+                                is_dir = file.is_dir(follow_symlinks=False)
+                                st = file.stat(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            rows.append(self._row(file.path, file.name, st, is_dir, gen))
+                            if is_dir:
+                                with self.lock:
+                                    self.pending_dirs += 1
+                                dirs.put(file.path)
+                except OSError as e:
+                    log('debug', f'Failed to scan {path}, error: {e}')
+                for i in range(0, len(rows), self.batch_size):
+                    self.writes.put(('rows', rows[i:i+self.batch_size]))
+                with self.lock:
+                    self.pending_dirs -= 1
+                    finished = not self.pending_dirs
+                if finished:
+                    self.writes.put(('finish', gen))
+
+        for _ in range(self.scan_workers):
+            Thread(target=_scan, daemon=True).start()
+
+    def _row(self, real_path: str, name: str, st: os.stat_result, is_dir: bool, gen: int) -> tuple:
+        '''
+        Return a row of the files table.
+
+        :param real_path: real path of the file
+        :param name: file name
+        :param st: stat_result of the file
+        :param is_dir: True if the file is a directory
+        :param gen: generation of the row, None for the current one
+        '''
+
+        path = '/' + os.path.relpath(real_path, self.base_dir).replace(os.sep, '/')
+        return path, name, 0 if is_dir else st.st_size, st.st_mtime, int(is_dir), gen
+
+    def _apply_event(self, conn: sqlite3.Connection, ev: tuple) -> None:
+        '''
+        Apply a change event to the index.
+
+        :param conn: the writer connection
+        :param ev: (event_type, path, is_dir)
+        '''
+
+        event_type, path, _ = ev
+        path = path.rstrip('/')
+        if not path:
+            return
+        if event_type == 'delete':
+            conn.execute(
+                'DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+                (path, path + '/', path + '0'),  # '0' follows '/'
+            )
+            return
+
+        real_path = os.path.join(self.base_dir, path.lstrip('/'))
+        try:
+            st = os.lstat(real_path)
+        except OSError:  # gone already
+            return
+        is_dir = os.path.isdir(real_path) and not os.path.islink(real_path)
+        rows = [self._row(real_path, os.path.basename(real_path), st, is_dir, None)]
+        if is_dir and event_type == 'create':  # e.g. renamed or copied trees
+            for dir_path, dir_names, file_names in os.walk(real_path):
+                for name in dir_names + file_names:
+                    file_path = os.path.join(dir_path, name)
+                    try:
+                        st = os.lstat(file_path)
+                    except OSError:
+                        continue
+                    rows.append(self._row(file_path, name, st, name in dir_names, None))
+        self._upsert(conn, rows)
+
+    def _upsert(self, conn: sqlite3.Connection, rows: List[tuple]) -> None:
+        '''
+        Insert or update rows.
+
+        :param conn: the writer connection
+        :param rows: rows of the files table
+        '''
+
+        conn.executemany(
+            'INSERT INTO files (path, name, size, mtime, is_dir, gen) '
+            f'VALUES (?, ?, ?, ?, ?, COALESCE(?, {current_gen})) '
+            'ON CONFLICT (path) DO UPDATE SET '
+            'size = excluded.size, mtime = excluded.mtime, is_dir = excluded.is_dir, '
+            'gen = MAX(excluded.gen, files.gen)',
+            rows,
+        )
+
+    def _write(self, conn: sqlite3.Connection) -> None:
+        '''
+        Main function for the writer, committing queued writes in batches.
+
+        :param conn: the writer connection
+        '''
+
+        while True:
+            items = [self.writes.get()]
+            while len(items) < 64:
+                try:
+                    items.append(self.writes.get_nowait())
+                except Empty:
+                    break
+            try:
+                with conn:  # a transaction
+                    for kind, value in items:
+                        if kind == 'rows':
+                            self._upsert(conn, value)
+                        elif kind == 'event':
+                            self._apply_event(conn, value)
+                        else:  # rebuild finished, drop what was not seen
+                            conn.execute('DELETE FROM files WHERE gen < ?', (value,))
+                            conn.execute(
+                                "INSERT OR REPLACE INTO meta (key, value) VALUES ('gen', ?)",
+                                (value,),
+                            )
+                            log('info', f'Metadata index rebuilt in {time.monotonic() - self.scan_start:.1f}s')
+            except sqlite3.Error as e:
+                log('warn', f'Failed to update metadata index, error: {e}')
+
+    def find(self, text: str, limit: int = 1000, prefix: str = '') -> List[entry]:
+        '''
+        Search files whose name contains the text, case-insensitively.
+
+        Return the matched entries, or None if the index is unavailable.
+
+        :param text: text to search for
+        :param limit: maximum number of results
+        :param prefix: only search under this directory, e.g. '/home/alice'
+        '''
+
+        if not self.available:
+            return None
+        conn = getattr(self.readers, 'conn', None)
+        if not conn:
+            conn = self.readers.conn = self._connect()
+        try:
+            low, high = (prefix + '/', prefix + '0') if prefix else ('', '\uffff')  # '0' follows '/'
+            if len(text) >= 3:  # a trigram at least
+                rows = conn.execute(
+                    'SELECT f.path, f.size, f.mtime, f.is_dir FROM names '
+                    'JOIN files AS f ON f.id = names.rowid WHERE names MATCH ? '
+                    'AND f.path >= ? AND f.path < ? LIMIT ?',
+                    ('"' + text.replace('"', '""') + '"', low, high, limit),
+                ).fetchall()
+            else:
+                pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                rows = conn.execute(
+                    "SELECT path, size, mtime, is_dir FROM files WHERE name LIKE ? ESCAPE '\\' "
+                    'AND path >= ? AND path < ? LIMIT ?',
+                    (f'%{pattern}%', low, high, limit),
+                ).fetchall()
+        except sqlite3.Error as e:
+            log('warn', f'Failed to search metadata index, error: {e}')
+            return None
+        return [(path, size, mtime, bool(is_dir)) for path, size, mtime, is_dir in rows]
+
+    def stats(self) -> Dict[str, int]:
+        '''
+        Return the number of indexed files and pending writes.
+        '''
+
+        count = None
+        if self.available:
+            conn = getattr(self.readers, 'conn', None) or self._connect()
+            self.readers.conn = conn
+            count = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        with self.lock:
+            rebuilding = bool(self.pending_dirs)
+        return {
+            'files': count,
+            'pending_writes': self.writes.qsize(),
+            'rebuilding': rebuilding,
+        }
@@ -1,16 +1,96 @@
-import shutil
+import argparse
+import fnmatch
+import io
+import mmap
+import select
+import selectors
+import signal
 import socket
+import sqlite3
+import ssl
+import stat
+import struct
+import subprocess
+import sys
 import os
-from threading import Thread
-from typing import Tuple, Type
-from naive_ftp.utils import log, is_safe_path
+import time
+from contextlib import nullcontext
+from multiprocessing.connection import Connection
+from queue import Empty
+from threading import Event, Lock, Semaphore, Thread
+from typing import BinaryIO, List, Tuple, Type
+from naive_ftp.utils import log, is_safe_path, set_keepalive
+from naive_ftp.server.events import events, start_inotify
+from naive_ftp.server.file_cache import hot_files
+from naive_ftp.server.path_resolver import path_resolver
+from naive_ftp.server.port_pool import port_pool
+from naive_ftp.server.quota import quota_index, tree_size
+from naive_ftp.server.rate_limit import check_rate, limiter, min_rate
+from naive_ftp.server.remover import remove_job, tree_remover
+from naive_ftp.server.search_index import metadata_index
+from naive_ftp.server.sessions import session_manager
+from naive_ftp.server.storage import discard, local_storage, memory_storage, object_storage, storage_backend
+from naive_ftp.server.auth import user, user_db
+from naive_ftp.server.dedup import dedup_storage
+from naive_ftp.server.supervisor import partition_ports, worker_supervisor
 
 # Control socket
 listen_host: str = socket.gethostname()
 listen_port: int = 2121
+listen_backlog: int = 5  # connections waiting to be accepted
 
+# Root directory of server files
+server_dir: str = os.path.realpath('server_files')
 
-class ftp_server(Thread):
+# Removes trees in background, after moving them into the trash directory
+# next to the server root, so that they disappear at once
+trash_dir: str = os.path.realpath('server_trash')
+remover: tree_remover = tree_remover(trash_dir)
+
+# Searchable index of all server files, shared by worker processes
+index_path: str = os.path.realpath('server_index.db')
+file_index: metadata_index = metadata_index(index_path, server_dir)
+
+# Quotas of directories, e.g. of users, with their usage, shared by worker processes
+quota_path: str = os.path.realpath('server_quotas.db')
+quotas: quota_index = quota_index(quota_path, server_dir)
+
+# Storage of files under the server root, chosen by --storage
+chunk_dir: str = os.path.realpath('server_chunks')     # for 'dedup'
+object_dir: str = os.path.realpath('server_objects')   # for 'object'
+storage: storage_backend = local_storage()
+
+# Users logging in with USER / PASS, or anonymous access to server root if None
+users: user_db = None
+login_delay: float = 1.0  # seconds to wait after a failed login
+
+# TLS context for AUTH TLS, which is not supported if None
+tls_context: ssl.SSLContext = None
+
+# Data port pool, using ephemeral ports if None
+data_pool: port_pool = None
+
+# True if other processes change the tree as well, i.e. in a worker process,
+# where cached request paths are checked before use, see path_resolver
+shared_tree: bool = False
+
+# Pipe to the supervisor in a worker process, to which changes made through
+# the worker are relayed, as inotify and the index writer run in the supervisor only
+supervisor_pipe: Connection = None
+supervisor_lock: Lock = Lock()
+
+# Sessions, parked without threads while idle, and evicted if idle for too long
+sessions: session_manager = session_manager()
+
+# Sessions streaming change events by SITE WATCH at most, each holding a thread
+watch_slots: Semaphore = Semaphore(64)
+
+# Graceful exit and restart, where the next process takes over the control port
+drain_timeout: float = 60.0  # seconds to wait for active sessions on exit
+ready_timeout: float = 30.0  # seconds to wait for the next process to accept connections
+
+
+class ftp_server():
     '''
     Naive-FTP server instance
     '''
@@ -20,20 +100,55 @@ class ftp_server(Thread):
         Initialize server instance.
         '''
 
-        super().__init__()
-
         # Properties
         self.buffer_size: int = 1024
+        self.max_cmd_size: int = 8192
         self.data_timeout_duration: float = 3.0
         self.max_allowed_conn: int = 5
-        self.server_dir: str = os.path.realpath('server_files')
+        self.watch_heartbeat: float = 1.0
+        self.public_ops: Tuple[str, ...] = ('PING', 'NOOP', 'AUTH', 'PBSZ', 'PROT', 'USER', 'PASS')
+
+        # Files larger than mmap_threshold are sent from memory maps
+        # of mmap_window bytes at a time, in slices of mmap_send_size
+        self.mmap_threshold: int = 256 * 1024
+        self.mmap_window: int = 16 * 1024 * 1024
+        self.mmap_send_size: int = 256 * 1024
+        self.server_dir: str = server_dir
+
+        # Restart offset for the next transfer
+        self.rest_offset: int = 0
+
+        # Size of the next upload, declared by ALLO, and bytes reserved
+        # in quotas at a time while uploading, seen by concurrent uploads
+        self.alloc_size: int = None
+        self.quota_step: int = 1024 * 1024
+
+        # Latest background RMDA of the session
+        self.remove_job: remove_job = None
+
+        # Source of the next RNTO / SITE CPTO
+        self.rename_from: str = None
+        self.copy_from: str = None
 
         # Current working directory
         self.cwd_path: str = '.'
+        self.resolver: path_resolver = path_resolver(self.server_dir, validate=shared_tree)
 
-        # Control connection
+        # Logged in user, whose home directory is the root seen by the session
+        self.user: user = None
+        self.user_name: str = None     # given by USER, waiting for PASS
+        self.root_prefix: str = ''     # of the home directory, in server paths
+        self.logged_in: bool = users is None
+
+        # Control connection, and received bytes of incomplete commands
         self.ctrl_conn: socket.socket = ctrl_conn
         self.client_addr: Tuple[str, int] = client_addr
+        self.ctrl_buffer: bytes = b''
+
+        # Lifecycle, in time.monotonic, and True if aborted on shutdown
+        self.start_time: float = time.monotonic()
+        self.last_active: float = self.start_time
+        self.aborted: bool = False
 
         # Data connection
         self.data_sock: socket.socket = None
@@ -41,6 +156,13 @@ class ftp_server(Thread):
         self.data_conn: socket.socket = None
         self.data_addr: Tuple[str, int] = None
 
+        # TLS, where data connections are protected after PROT P
+        self.pbsz_set: bool = False
+        self.protect_data: bool = False
+
+        # Bandwidth shaping
+        self.throttle = limiter.open_session(client_addr[0])
+
     def send_status(self, status_code: int, *args) -> None:
         '''
         Send a response based on status code.
@@ -69,16 +191,30 @@ class ftp_server(Thread):
 
         status_dict = {
             150: '150 File status okay; about to open data connection.\r\n',
+            200: '200 Command okay.\r\n',
+            211: '211 {}\r\n'.format(args[0] if len(args) else None),
+            213: '213 {}\r\n'.format(args[0] if len(args) else None),
             220: '220 Service ready for new user.\r\n',
+            421: '421 Service not available, closing control connection.\r\n',
             221: '221 Service closing control connection.\r\n',
             225: '225 Data connection open; no transfer in progress.\r\n',
             226: '226 Closing data connection. Requested file action successful.\r\n',
             227: '227 Entering Passive Mode {}.\r\n'.format(_parsed_addr(self.data_sock_name)),
+            230: '230 User logged in, proceed.\r\n',
+            234: '234 Security data exchange complete; starting TLS.\r\n',
             250: '250 Requested file action okay, completed.\r\n',
             257: '257 {}\r\n'.format(args[0] if len(args) else None),
+            331: '331 User name okay, need password.\r\n',
+            350: '350 Requested file action pending further information.\r\n',
+            425: '425 Can\'t open data connection. No data port available.\r\n',
             450: '450 Requested file action not taken.\r\n',
             501: '501 Syntax error in parameters or arguments.\r\n',
+            503: '503 Bad sequence of commands.\r\n',
+            502: '502 Command not implemented.\r\n',
+            504: '504 Command not implemented for that parameter.\r\n',
+            530: '530 Not logged in.\r\n',
             550: '550 Requested action not taken. File unavailable.\r\n',
+            552: '552 Requested file action aborted. Exceeded storage allocation.\r\n',
             553: '553 Requested action not taken. File name not allowed.\r\n',
         }
 
@@ -90,32 +226,55 @@ class ftp_server(Thread):
 
     def open_data_conn(self) -> None:
         '''
-        Open data connection.
+        Open data connection, accepting only the host of control connection.
         '''
 
         if self.data_conn:
             self.close_data_conn()
-        self.data_conn, self.data_addr = self.data_sock.accept()
+        deadline = time.monotonic() + self.data_timeout_duration
+        while True:
+            conn, addr = self.data_sock.accept()
+            if addr[0] == self.client_addr[0]:
+                break
+            log('warn', f'Data connection rejected, not from client {self.client_addr}: {addr}')
+            conn.close()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('no data connection from client')
+            self.data_sock.settimeout(remaining)
+        self.data_conn, self.data_addr = conn, addr
         self.data_conn.settimeout(self.data_timeout_duration)
+        if self.protect_data:  # resuming the session of control connection
+            self.data_conn = tls_context.wrap_socket(self.data_conn, server_side=True)
+            log('debug', f'Data connection secured, session reused: {self.data_conn.session_reused}')
         log('info', f'Data connection opened: {self.data_addr}')
         self.send_status(225)
 
-    def open_data_sock(self) -> None:
+    def open_data_sock(self) -> bool:
         '''
-        Open data socket.
+        Open data socket, leased from the data port pool if configured.
+
+        Return True if succeeded.
         '''
 
         if self.data_sock:
             self.close_data_sock()
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.settimeout(self.data_timeout_duration)
-        s.bind((listen_host, 0))
-        s.listen(self.max_allowed_conn)
+        if data_pool:
+            s = data_pool.lease(self.data_timeout_duration)
+            if not s:
+                self.send_status(425)
+                return False
+        else:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.settimeout(self.data_timeout_duration)
+            s.bind((listen_host, 0))
+            s.listen(self.max_allowed_conn)
         self.data_sock = s
         self.data_sock_name = s.getsockname()
         log('info', f'Data server started, listening at {self.data_sock_name}')
         self.send_status(227)
+        return True
 
     def close_data_conn(self) -> None:
         '''
@@ -133,7 +292,10 @@ class ftp_server(Thread):
 
         self.close_data_conn()
         if self.data_sock:
-            self.data_sock.close()
+            if data_pool:
+                data_pool.release(self.data_sock)
+            else:
+                self.data_sock.close()
             self.data_sock = None
 
     def close_ctrl_conn(self) -> None:
@@ -152,6 +314,46 @@ class ftp_server(Thread):
 
         self.close_data_sock()
         self.close_ctrl_conn()
+        self.throttle.close()
+        self.resolver.close()
+        sessions.remove(self)
+
+    def evict(self) -> None:
+        '''
+        Close an idle session, telling the client why.
+        '''
+
+        log('info', f'Evicting idle session: {self.client_addr}')
+        try:
+            self.send_status(421)
+        except OSError:
+            pass
+        self.close()
+
+    def abort(self) -> None:
+        '''
+        Interrupt the session from another thread, e.g. a transfer still running
+        on shutdown. The transfer stops after its current chunk, and its data
+        connection is reset, so that the client does not take it as complete.
+        '''
+
+        log('info', f'Aborting session: {self.client_addr}')
+        self.aborted = True
+        self.throttle.cancel()
+        try:
+            self.data_conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except (AttributeError, OSError):
+            pass
+        # Wake up blocking calls, bypassing TLS shutdown, after which data would be sent in clear
+        for sock, how in (
+            (self.data_conn, socket.SHUT_RD),
+            (self.data_sock, socket.SHUT_RDWR),
+            (self.ctrl_conn, socket.SHUT_RDWR),
+        ):
+            try:
+                socket.socket.shutdown(sock, how)
+            except (TypeError, OSError):  # not opened, or closed meanwhile
+                pass
 
     def pong(self) -> None:
         '''
@@ -160,6 +362,126 @@ class ftp_server(Thread):
 
         self.send_status(220)
 
+    def noop(self) -> None:
+        '''
+        Do nothing, as sent by clients to keep the control connection alive.
+        '''
+
+        self.send_status(200)
+
+    def auth(self, mechanism: str) -> None:
+        '''
+        Secure the control connection with TLS. Nothing received in clear
+        is kept across the upgrade, and the connection is closed if commands
+        follow AUTH before the handshake.
+
+        :param mechanism: 'TLS' (or 'TLS-C' / 'SSL', treated the same)
+        '''
+
+        if mechanism.upper() not in ('TLS', 'TLS-C', 'SSL'):
+            self.send_status(504)
+            return
+        if not tls_context or isinstance(self.ctrl_conn, ssl.SSLSocket):
+            self.send_status(503 if tls_context else 502)
+            return
+        if self.ctrl_buffer:  # sent in clear after AUTH, e.g. injected by a man in the middle
+            log('warn', f'Commands pipelined after AUTH, closing: {self.client_addr}')
+            self.send_status(421)
+            self.close_ctrl_conn()
+            return
+        self.send_status(234)
+        self.ctrl_buffer = b''
+        try:
+            self.ctrl_conn = tls_context.wrap_socket(self.ctrl_conn, server_side=True)
+        except (ssl.SSLError, OSError) as e:
+            log('warn', f'TLS handshake failed: {self.client_addr}, error: {e}')
+            self.close_ctrl_conn()
+            return
+        log('info', f'Control connection secured: {self.client_addr}, {self.ctrl_conn.version()}')
+
+    def pbsz(self, size: str) -> None:
+        '''
+        Set the protection buffer size, which is always 0 for TLS.
+
+        :param size: buffer size
+        '''
+
+        if not isinstance(self.ctrl_conn, ssl.SSLSocket):
+            self.send_status(503)
+            return
+        self.pbsz_set = True
+        self.send_status(200)
+
+    def prot(self, level: str) -> None:
+        '''
+        Set the protection level of data connections.
+
+        :param level: 'C' for clear, or 'P' for private
+        '''
+
+        if not self.pbsz_set:
+            self.send_status(503)
+            return
+        if level.upper() not in ('C', 'P'):
+            self.send_status(504)
+            return
+        self.protect_data = level.upper() == 'P'
+        self.send_status(200)
+
+    def login_user(self, name: str) -> None:
+        '''
+        Set the user name to log in with by the next PASS.
+
+        :param name: user name
+        '''
+
+        if users is None:  # anonymous access
+            self.send_status(230)
+            return
+        self.user_name = name
+        self.send_status(331)
+
+    def login_pass(self, password: str = '') -> None:
+        '''
+        Log in as the user set by USER, and jail the session in its home directory.
+
+        :param password: the password
+        '''
+
+        name, self.user_name = self.user_name, None
+        if users is None:
+            self.send_status(230)
+            return
+        if name is None:
+            self.send_status(503)
+            return
+
+        u = users.verify(name, password)
+        root_dir = os.path.realpath(os.path.join(server_dir, u.root)) if u else None
+        if not u or not is_safe_path(root_dir, server_dir, allow_base=True, resolved=True):
+            log('warn', f'Failed login as {name}: {self.client_addr}')
+            time.sleep(login_delay)
+            self.send_status(530)
+            return
+        try:
+            if not storage.isdir(root_dir):
+                storage.mkdir(root_dir)
+        except OSError as e:
+            log('warn', f'Failed to make home directory {root_dir}, error: {e}')
+            self.send_status(550)
+            return
+
+        self.user, self.logged_in = u, True
+        self.server_dir = root_dir  # checked by is_safe_path on every request
+        self.root_prefix = self.to_server_path(root_dir).rstrip('/')
+        if u.quota is not None:
+            quotas.set(self.root_prefix, u.quota, storage)
+        self.resolver.close()
+        self.resolver = path_resolver(root_dir, validate=shared_tree)
+        self.cwd_path = '/'
+        log('info', f'Logged in as {name}: {self.client_addr}')
+        self.send_status(230)
+
     def get_server_path(self, path: str) -> str:
         '''
         Parse the client request path to its real path on server.
@@ -167,12 +489,55 @@ class ftp_server(Thread):
         :param path: path extracted from client request
         '''
 
-        if path.startswith('/'):
-            server_path = os.path.join(self.server_dir, path[1:])
-        else:
-            cwd_path = '' if self.cwd_path == '/' else self.cwd_path
-            server_path = os.path.join(self.server_dir, cwd_path, path)
-        return os.path.realpath(server_path)
+        return self.resolver.resolve(path)
+
+    def to_client_path(self, real_path: str) -> str:
+        '''
+        Return the path seen by clients of a real path on server, starting with '/'.
+
+        :param real_path: real path on server
+        '''
+
+        rel_path = os.path.relpath(real_path, self.server_dir)
+        return '/' if rel_path == '.' else '/' + rel_path.replace(os.sep, '/')
+
+    def to_server_path(self, real_path: str) -> str:
+        '''
+        Return the path relative to server root of a real path, starting with '/',
+        which is the same for all users, as in change events and the search index.
+
+        :param real_path: real path on server
+        '''
+
+        rel_path = os.path.relpath(real_path, server_dir)
+        return '/' if rel_path == '.' else '/' + rel_path.replace(os.sep, '/')
+
+    def from_server_path(self, path: str) -> str:
+        '''
+        Return the path seen by the client of a path relative to server root.
+
+        :param path: path relative to server root, under the home directory
+        '''
+
+        return path[len(self.root_prefix):] or '/'
+
+    def publish(self, event_type: str, real_path: str, is_dir: bool = False) -> None:
+        '''
+        Publish a change event of a path on server.
+
+        :param event_type: 'create' / 'modify' / 'delete'
+        :param real_path: real path on server
+        :param is_dir: True if the path is a directory
+        '''
+
+        server_path = self.to_server_path(real_path)
+        events.publish(event_type, server_path, is_dir)
+        if supervisor_pipe:  # to the index, and to sessions of other workers
+            try:
+                with supervisor_lock:
+                    supervisor_pipe.send(['event', event_type, server_path, is_dir])
+            except OSError:
+                log('warn', f'Failed to relay change event of {server_path}')
 
     def ls(self, path: str = '.') -> None:
         '''
@@ -209,30 +574,28 @@ class ftp_server(Thread):
 
         src_path = self.get_server_path(path)
         log('debug', f'Listing information of {src_path}')
-        if not is_safe_path(src_path, self.server_dir, allow_base=True):
+        if not is_safe_path(src_path, self.server_dir, allow_base=True, resolved=True):
             self.send_status(553)
             return
-        if not os.path.exists(src_path):
+        if not storage.exists(src_path):
             self.send_status(550)
             return
 
         try:
             self.send_status(150)
-            if not self.data_sock:
-                self.open_data_sock()
+            if not self.data_sock and not self.open_data_sock():
+                return
             self.open_data_conn()
-            if os.path.isdir(src_path):
-                with os.scandir(src_path) as it:
-                    for file in it:
-                        if not file.name.startswith('.'):
-                            file_name = file.name.replace(' ', '%20')
-                            info = _parse_stat(file.stat())
-                            _send_info(file_name, info)
+            if storage.isdir(src_path):
+                for file_name, raw_stat in storage.list(src_path):
+                    if not file_name.startswith('.'):
+                        info = _parse_stat(raw_stat)
+                        _send_info(file_name.replace(' ', '%20'), info)
             else:
                 file_name = os.path.basename(src_path)
                 if not file_name.startswith('.'):
                     file_name = file_name.replace(' ', '%20')
-                    info = _parse_stat(os.stat(src_path))
+                    info = _parse_stat(storage.stat(src_path))
                     _send_info(file_name, info)
             log('info', f'Finished listing information of {src_path}')
         except OSError as e:
@@ -246,6 +609,68 @@ class ftp_server(Thread):
         finally:
             self.close_data_sock()
 
+    def nlst(self, path: str = '.') -> None:
+        '''
+        List names in a directory, or those matching a glob pattern.
+
+        Wildcards are only expanded in the last path component, and names are
+        sent prefixed with the directory part of the request path, so that
+        they can be used as request paths directly. With '-p' before the path,
+        a '/' is appended to names of directories, as by ls -p.
+
+        :param path: server path to the directory, or a glob pattern
+        '''
+
+        mark_dirs = path == '-p' or path.startswith('-p ')
+        if mark_dirs:
+            path = path[3:].lstrip() or '.'
+        dir_part, _, pattern = path.rpartition('/')
+        if any(c in pattern for c in '*?['):
+            src_path = self.get_server_path(dir_part or ('/' if path.startswith('/') else '.'))
+            prefix = dir_part + '/' if path.startswith('/') or dir_part else ''
+        else:
+            src_path = self.get_server_path(path)
+            pattern = None
+            prefix = '' if path in ('', '.', './') else path.rstrip('/') + '/'
+        log('debug', f'Listing names in {src_path}, pattern: {pattern}')
+        if not is_safe_path(src_path, self.server_dir, allow_base=True, resolved=True):
+            self.send_status(553)
+            return
+        if not storage.exists(src_path):
+            self.send_status(550)
+            return
+
+        try:
+            if storage.isdir(src_path):
+                names = [
+                    name + ('/' if mark_dirs and stat.S_ISDIR(st.st_mode) else '')
+                    for name, st in storage.list(src_path)
+                    if (pattern and fnmatch.fnmatchcase(name, pattern))
+                    or (not pattern and not name.startswith('.'))
+                ]
+                if pattern and not pattern.startswith('.'):
+                    names = [name for name in names if not name.startswith('.')]
+                names = [prefix + name for name in names]
+            else:
+                names = [path]
+        except OSError as e:
+            log('warn', f'System error: {e}')
+            self.send_status(550)
+            return
+
+        try:
+            self.send_status(150)
+            if not self.data_sock and not self.open_data_sock():
+                return
+            self.open_data_conn()
+            for name in names:
+                self.data_conn.sendall(f'{name.replace(" ", "%20")}\r\n'.encode('utf-8'))
+            log('info', f'Finished listing names in {src_path}')
+        except (socket.timeout, socket.error):
+            log('warn', f'Data connection failed: {self.data_addr}')
+        finally:
+            self.close_data_sock()
+
     def retrieve(self, path: str) -> None:
         '''
         Retrieve a file from server.
@@ -253,27 +678,44 @@ class ftp_server(Thread):
         :param path: server path to the file
         '''
 
+        offset, self.rest_offset = self.rest_offset, 0
         src_path = self.get_server_path(path)
         log('debug', f'Sending file: {src_path}')
-        if not is_safe_path(src_path, self.server_dir):
+        if not is_safe_path(src_path, self.server_dir, resolved=True):
             self.send_status(553)
             return
-        if not os.path.exists(src_path):
+        if not storage.exists(src_path):
             self.send_status(550)
             return
 
         try:
-            with open(src_path, 'rb') as src_file:
+            content = hot_files.get(src_path) if storage.cacheable else None
+            with nullcontext() if content is not None else storage.open_read(src_path, offset) as src_file:
                 self.send_status(150)
-                if not self.data_sock:
-                    self.open_data_sock()
+                if not self.data_sock and not self.open_data_sock():
+                    return
                 self.open_data_conn()
-                while True:
-                    data = src_file.read(self.buffer_size)
-                    if not data:
-                        break
-                    self.data_conn.sendall(data)
+                if content is not None:  # served from memory
+                    for i in range(offset, len(content), self.buffer_size):
+                        data = content[i:i+self.buffer_size]
+                        self.data_conn.sendall(data)
+                        self.throttle.consume(len(data))
+                        if self.aborted:
+                            raise ConnectionAbortedError
+                elif not self.send_mapped(src_file):
+                    while True:
+                        data = src_file.read(self.buffer_size)
+                        if not data:
+                            break
+                        self.data_conn.sendall(data)
+                        self.throttle.consume(len(data))
+                        if self.aborted:
+                            raise ConnectionAbortedError
             log('info', f'Sent file {src_path}')
+        except (BrokenPipeError, ConnectionResetError):  # e.g. a ranged read
+            log('info', f'Data connection closed by client: {self.data_addr}')
+        except ConnectionAbortedError:  # see abort
+            log('info', f'Transfer aborted: {src_path}')
         except OSError as e:
             log('warn', f'System error: {e}')
             self.send_status(550)
@@ -285,37 +727,119 @@ class ftp_server(Thread):
         finally:
             self.close_data_sock()
 
+    def send_mapped(self, src_file: BinaryIO) -> bool:
+        '''
+        Send a file from its current offset through data connection, by memory
+        mapping a window of it at a time and sending slices of the map, so that
+        no bytes objects are created, and concurrent downloads of the same file
+        share its pages in the page cache.
+
+        Return False if not sent, e.g. not a regular file or too small.
+
+        :param src_file: the opened file
+        '''
+
+        try:
+            fd = src_file.fileno()
+            size = os.fstat(fd).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):  # e.g. in memory
+            return False
+        offset = src_file.tell()
+        if size - offset < self.mmap_threshold:
+            return False
+
+        while offset < size:
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            length = min(self.mmap_window, size - start)
+            with mmap.mmap(fd, length, offset=start, access=mmap.ACCESS_READ) as m:
+                if hasattr(m, 'madvise'):  # read ahead aggressively, drop behind
+                    m.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(m) as view:
+                    for i in range(offset - start, length, self.mmap_send_size):
+                        with view[i:i+self.mmap_send_size] as data:
+                            self.data_conn.sendall(data)
+                            self.throttle.consume(len(data))
+                            if self.aborted:
+                                raise ConnectionAbortedError
+            offset = start + length
+        return True
+
     def store(self, path: str) -> None:
         '''
         Store a file to server.
 
+        An upload which exceeds the quota is rejected before it starts
+        if its size is declared by ALLO, otherwise discarded once exceeded,
+        resetting the data connection. So is an upload aborted on shutdown,
+        or one whose data connection is reset by the client, e.g. cancelled.
+        Received bytes are reserved in the quota as they arrive, so that
+        concurrent uploads share the room left.
+
         :param path: local path to the file
         '''
 
+        self.rest_offset = 0
+        alloc_size, self.alloc_size = self.alloc_size, None
         dst_path = self.get_server_path(os.path.basename(path))
         log('debug', f'Storing file: {dst_path}')
-        if not is_safe_path(dst_path, self.server_dir):
+        if not is_safe_path(dst_path, self.server_dir, resolved=True):
             self.send_status(553)
             return
         dir_name, file_name = dst_path.rsplit(os.sep, 1)
-        if not os.path.isdir(dir_name):
+        if not storage.isdir(dir_name):
             if not self.mkdir(dir_name, is_client=False):  # failed to make directory
                 return
         if not file_name:  # make directory only
             return
 
+        existed = storage.exists(dst_path)
+        server_path = self.to_server_path(dst_path)
+        old_size = storage.stat(dst_path).st_size if storage.isfile(dst_path) else 0
+        room = quotas.remaining(server_path)  # for the new content, None if unlimited
+        if room is not None:
+            room += old_size
+            if room < (alloc_size or 1):
+                log('info', f'Upload rejected, {room} B left in quota: {dst_path}')
+                self.send_status(552)
+                return
+
+        received, reserved, opened, discarded = 0, 0, False, False
         try:
-            with open(dst_path, 'wb') as dst_file:
+            with storage.open_write(dst_path) as dst_file:
+                opened = True
                 self.send_status(150)
-                if not self.data_sock:
-                    self.open_data_sock()
+                if not self.data_sock and not self.open_data_sock():
+                    return
                 self.open_data_conn()
                 while self.data_conn:
-                    data = self.data_conn.recv(self.buffer_size)
+                    try:
+                        data = self.data_conn.recv(self.buffer_size)
+                    except OSError:  # incomplete, keep the old content
+                        discard(dst_file)
+                        discarded = True
+                        raise
+                    received += len(data)
+                    if room is not None and received > reserved:  # reserve ahead, then check the room left
+                        step = max(received - reserved, self.quota_step)
+                        quotas.charge(server_path, step)
+                        reserved += step
+                        left = quotas.remaining(server_path)
+                        room = None if left is None else left + old_size + reserved
+                    if self.aborted or room is not None and received > room:
+                        discard(dst_file)
+                        discarded = True
+                        log('info', f'Upload discarded, {"aborted" if self.aborted else "quota exceeded"}: {dst_path}')
+                        # Reset instead of a reply, which the client does not wait for after STOR
+                        self.data_conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                        return
                     if not data:
                         break
                     dst_file.write(data)
+                    self.throttle.consume(len(data))
+            self.publish('modify' if existed else 'create', dst_path)
             log('info', f'Stored file: {dst_path}')
+        except ConnectionResetError:  # not replied, as after a discarded upload
+            log('info', f'Upload discarded, reset by client: {dst_path}')
         except OSError as e:
             log('warn', f'System error: {e}')
             self.send_status(550)
@@ -325,8 +849,31 @@ class ftp_server(Thread):
         except socket.error:
             pass
         finally:
+            if opened and not discarded:  # replaced, even if partly received
+                quotas.charge(server_path, received - reserved - old_size)
+            else:
+                quotas.charge(server_path, -reserved)
+            hot_files.invalidate(dst_path)
             self.close_data_sock()
 
+    def allocate(self, size: str) -> None:
+        '''
+        Declare the size of the next upload, so that it is checked against
+        the quota before any data is sent.
+
+        :param size: size in bytes
+        '''
+
+        try:
+            self.alloc_size = int(size.split()[0])
+            if self.alloc_size < 0:
+                raise ValueError
+        except (ValueError, IndexError):
+            self.alloc_size = None
+            self.send_status(501)
+            return
+        self.send_status(200)
+
     def delete(self, path: str) -> None:
         '''
         Delete a file from server.
@@ -336,15 +883,20 @@ class ftp_server(Thread):
 
         src_path = self.get_server_path(path)
         log('debug', f'Deleting file: {src_path}')
-        if not is_safe_path(src_path, self.server_dir):
+        if not is_safe_path(src_path, self.server_dir, resolved=True):
             self.send_status(553)
             return
-        if not os.path.isfile(src_path):
+        if not storage.isfile(src_path):
             self.send_status(550)
             return
 
         try:
-            os.remove(src_path)
+            size = storage.stat(src_path).st_size
+            storage.delete(src_path)
+            quotas.charge(self.to_server_path(src_path), -size)
+            self.resolver.invalidate()
+            hot_files.invalidate(src_path)
+            self.publish('delete', src_path)
             log('info', f'Deleted file: {src_path}')
             self.send_status(250)
         except OSError:
@@ -361,11 +913,12 @@ class ftp_server(Thread):
 
         dst_path = self.get_server_path(path)
         log('debug', f'Changing working directory to {dst_path}')
-        if not is_safe_path(dst_path, self.server_dir, allow_base=True):
+        if not is_safe_path(dst_path, self.server_dir, allow_base=True, resolved=True):
             self.send_status(553)
             return
 
-        if os.path.isdir(dst_path):
+        if storage.isdir(dst_path):
+            self.resolver.chdir(dst_path)
             self.cwd_path = dst_path[len(self.server_dir)+1:]
             if not self.cwd_path:
                 self.cwd_path = '/'
@@ -374,6 +927,226 @@ class ftp_server(Thread):
         else:
             self.send_status(550)
 
+    def rest(self, offset: str) -> None:
+        '''
+        Set the offset to restart the next file transfer at.
+
+        :param offset: offset in bytes
+        '''
+
+        try:
+            self.rest_offset = int(offset)
+            if self.rest_offset < 0:
+                raise ValueError
+        except ValueError:
+            self.rest_offset = 0
+            self.send_status(501)
+            return
+        self.send_status(350)
+
+    def size(self, path: str) -> None:
+        '''
+        Return the size of a file.
+
+        :param path: server path to the file
+        '''
+
+        src_path = self.get_server_path(path)
+        if not is_safe_path(src_path, self.server_dir, resolved=True):
+            self.send_status(553)
+            return
+        if not storage.isfile(src_path):
+            self.send_status(550)
+            return
+        self.send_status(213, storage.stat(src_path).st_size)
+
+    def mdtm(self, path: str) -> None:
+        '''
+        Return the last modified time of a file or directory.
+
+        Format: YYYYMMDDHHMMSS.ffffff in UTC
+
+        :param path: server path to the file or directory
+        '''
+
+        src_path = self.get_server_path(path)
+        if not is_safe_path(src_path, self.server_dir, allow_base=True, resolved=True):
+            self.send_status(553)
+            return
+        try:
+            mtime_ns = storage.stat(src_path).st_mtime_ns
+        except OSError:
+            self.send_status(550)
+            return
+        seconds, ns = divmod(mtime_ns, 10**9)
+        timestamp = time.strftime('%Y%m%d%H%M%S', time.gmtime(seconds))
+        self.send_status(213, f'{timestamp}.{ns // 1000:06d}')
+
+    def get_source_path(self, path: str) -> str:
+        '''
+        Resolve the source of a rename or copy, not following a link
+        as the last component, so that the link itself is renamed or copied.
+
+        Return its real path, or None if not allowed, in which case
+        the status is sent.
+
+        :param path: server path to the file or directory
+        '''
+
+        src_path = self.resolver.resolve(path, follow_symlinks=False)
+        if not is_safe_path(src_path, self.server_dir, resolved=True):
+            self.send_status(553)
+            return None
+        if not storage.exists(src_path):
+            self.send_status(550)
+            return None
+        return src_path
+
+    def get_target_path(self, src_path: str, path: str) -> str:
+        '''
+        Resolve the target of a rename or copy, creating its parent directories.
+
+        Return its real path, or None if not allowed, in which case
+        the status is sent.
+
+        :param src_path: real path of the source
+        :param path: server path to the target
+        '''
+
+        dst_path = self.get_server_path(path)
+        if (
+            not is_safe_path(dst_path, self.server_dir, resolved=True)
+            or is_safe_path(dst_path, src_path, allow_base=True, resolved=True)
+        ):  # not into itself
+            self.send_status(553)
+            return None
+        dir_name = os.path.dirname(dst_path)
+        if not storage.isdir(dir_name) and not self.mkdir(dir_name, is_client=False):
+            return None
+        return dst_path
+
+    def invalidate(self, *paths: str) -> None:
+        '''
+        Drop cached paths and file contents after files are moved or replaced.
+
+        :param paths: real paths of the changed files or directories
+        '''
+
+        self.resolver.invalidate()
+        for path in paths:
+            hot_files.invalidate(path)
+            hot_files.invalidate_tree(path)
+
+    def rnfr(self, path: str) -> None:
+        '''
+        Set the file or directory to rename by the next RNTO.
+
+        :param path: server path to the file or directory
+        '''
+
+        self.rename_from = self.get_source_path(path)
+        if self.rename_from:
+            self.send_status(350)
+
+    def rnto(self, path: str) -> None:
+        '''
+        Rename the file or directory set by RNFR, replacing an existing file.
+
+        :param path: server path to the new name
+        '''
+
+        src_path, self.rename_from = self.rename_from, None
+        if not src_path:
+            self.send_status(503)
+            return
+        dst_path = self.get_target_path(src_path, path)
+        if not dst_path:
+            return
+
+        try:
+            is_dir = storage.isdir(src_path)
+            size = 0 if is_dir else storage.stat(src_path).st_size
+            old_size = storage.stat(dst_path).st_size if storage.isfile(dst_path) else 0
+            storage.rename(src_path, dst_path)
+        except OSError as e:
+            log('warn', f'Failed to rename {src_path}, error: {e}')
+            self.send_status(550)
+            return
+        if is_dir:  # size not known without a walk
+            quotas.mark(self.to_server_path(src_path))
+            quotas.mark(self.to_server_path(dst_path))
+        else:
+            quotas.charge(self.to_server_path(src_path), -size)
+            quotas.charge(self.to_server_path(dst_path), size - old_size)
+        self.invalidate(src_path, dst_path)
+        self.publish('delete', src_path, is_dir)
+        self.publish('create', dst_path, is_dir)
+        log('info', f'Renamed {src_path} to {dst_path}')
+        self.send_status(250)
+
+    def cpfr(self, path: str) -> None:
+        '''
+        Set the file or directory to copy by the next SITE CPTO.
+
+        :param path: server path to the file or directory
+        '''
+
+        self.copy_from = self.get_source_path(path)
+        if self.copy_from:
+            self.send_status(350)
+
+    def cpto(self, path: str) -> None:
+        '''
+        Copy the file or directory set by SITE CPFR on server, recursively.
+
+        An existing file is replaced, while an existing directory is not.
+
+        :param path: server path to the copy
+        '''
+
+        src_path, self.copy_from = self.copy_from, None
+        if not src_path:
+            self.send_status(503)
+            return
+        dst_path = self.get_target_path(src_path, path)
+        if not dst_path:
+            return
+        server_path = self.to_server_path(dst_path)
+        try:
+            is_dir = storage.isdir(src_path)
+            old_size = storage.stat(dst_path).st_size if storage.isfile(dst_path) else 0
+            limited = quotas.remaining(server_path) is not None
+            size = tree_size(storage, src_path) if limited or not is_dir else 0
+        except OSError as e:
+            log('warn', f'Failed to copy {src_path}, error: {e}')
+            self.send_status(550)
+            return
+        if limited:  # reserved before copying, so that concurrent uploads see it
+            quotas.charge(server_path, size - old_size)
+            left = quotas.remaining(server_path)
+            if left is not None and left < 0:
+                quotas.charge(server_path, old_size - size)
+                log('info', f'Copy rejected, {left + size - old_size} B left in quota: {dst_path}')
+                self.send_status(552)
+                return
+
+        try:
+            count = storage.copy(src_path, dst_path)
+        except OSError as e:
+            log('warn', f'Failed to copy {src_path}, error: {e}')
+            quotas.mark(server_path)  # partly copied
+            self.invalidate(dst_path)
+            self.send_status(550)
+            return
+        if is_dir:  # changed meanwhile, or not counted without a quota
+            quotas.mark(server_path)
+        elif not limited:
+            quotas.charge(server_path, size - old_size)
+        self.invalidate(dst_path)
+        self.publish('create', dst_path, is_dir)
+        log('info', f'Copied {count} files from {src_path} to {dst_path}')
+        self.send_status(250)
+
     def pwd(self) -> None:
         '''
         Print working directory.
@@ -393,13 +1166,14 @@ class ftp_server(Thread):
 
         dst_path = self.get_server_path(path) if is_client else path
         log('debug', f'Creating directory: {dst_path}')
-        if not is_safe_path(dst_path, self.server_dir):
+        if not is_safe_path(dst_path, self.server_dir, resolved=True):
             self.send_status(553)
             return False
         try:
-            if not os.path.exists(dst_path):
-                os.makedirs(dst_path)
-            if os.path.isdir(dst_path):
+            if not storage.exists(dst_path):
+                storage.mkdir(dst_path)
+                self.publish('create', dst_path, is_dir=True)
+            if storage.isdir(dst_path):
                 log('info', f'Created directory: {dst_path}')
                 if is_client:
                     dir_path = dst_path[len(self.server_dir)+1:]
@@ -416,26 +1190,49 @@ class ftp_server(Thread):
         '''
         Remove a directory.
 
+        A recursive removal is replied at once, and runs in background,
+        whose progress is reported by SITE RMSTAT. If the directory cannot be
+        moved to the trash, it is removed in place before replying.
+
         :param path: server path to the directory
         :param recursive: remove recursively if True
         '''
 
         src_path = self.get_server_path(path)
         log('debug', f'Removing directory: {src_path}')
-        if not is_safe_path(src_path, self.server_dir):
+        if not is_safe_path(src_path, self.server_dir, resolved=True):
             self.send_status(553)
             return
+        server_path = self.to_server_path(src_path)
         try:
-            if os.path.isdir(src_path):
-                if recursive:
-                    shutil.rmtree(src_path)
+            if storage.isdir(src_path):
+                trash_path = remover.move_to_trash(src_path) if recursive and storage.on_disk else None
+                if trash_path:
+                    self.remove_job = remover.submit(
+                        trash_path,
+                        self.to_client_path(src_path),
+                        lambda size: quotas.charge(server_path, -size),  # as files are unlinked
+                    )
+                elif recursive:  # e.g. the trash on another file system
+                    size = tree_size(storage, src_path)
+                    storage.remove_tree(src_path)
+                    quotas.charge(server_path, -size)
                 else:
-                    os.rmdir(src_path)
+                    storage.rmdir(src_path)
+                self.resolver.invalidate()
+                hot_files.invalidate_tree(src_path)
+                self.publish('delete', src_path, is_dir=True)
                 log('info', f'Removed directory: {src_path}')
                 self.send_status(250)
             else:
-                os.remove(src_path)
+                size = storage.stat(src_path).st_size
+                storage.delete(src_path)
+                quotas.charge(server_path, -size)
+                self.resolver.invalidate()
+                hot_files.invalidate(src_path)
+                self.publish('delete', src_path)
                 log('info', f'Deleted file: {src_path}')
+                self.send_status(250)
         except OSError:
             log('warn', f'Failed to remove directory: {src_path}')
             self.send_status(550)
@@ -449,6 +1246,133 @@ class ftp_server(Thread):
 
         self.rmdir(path, recursive=True)
 
+    def rmstat(self, job_id: str = None) -> None:
+        '''
+        Report the progress of a background RMDA.
+
+        In multi-process mode, a job is only found by the worker which runs it,
+        i.e. on a connection served by the same worker as the one which removed it.
+
+        :param job_id: job identifier, the latest job of the session by default
+        '''
+
+        if job_id is None:
+            job = self.remove_job
+        elif job_id.replace('.', '', 1).isdigit():
+            job = remover.get_job(job_id)
+        else:
+            self.send_status(501)
+            return
+        if not job:
+            self.send_status(550)
+            return
+        self.send_status(211, job.status())
+
+    def find(self, text: str) -> None:
+        '''
+        Search files on server by name, through data connection.
+
+        Format: 'path size mtime is_dir' for each line, where path is
+        relative to server root.
+
+        :param text: text contained in the file names
+        '''
+
+        log('debug', f'Searching files: {text}')
+        results = file_index.find(text, prefix=self.root_prefix)
+        if results is None:
+            self.send_status(502)
+            return
+
+        try:
+            self.send_status(150)
+            if not self.data_sock and not self.open_data_sock():
+                return
+            self.open_data_conn()
+            lines = [
+                f'{self.from_server_path(path).replace(" ", "%20")} {size} {mtime} {int(is_dir)}\r\n'
+                for path, size, mtime, is_dir in results
+            ]
+            self.data_conn.sendall(''.join(lines).encode('utf-8'))
+            log('info', f'Found {len(results)} files: {text}')
+        except (socket.timeout, socket.error):
+            log('warn', f'Data connection failed: {self.data_addr}')
+        finally:
+            self.close_data_sock()
+
+    def watch(self, path: str = '/') -> None:
+        '''
+        Stream change events under a directory through data connection,
+        until the client closes it.
+
+        Format: 'event_type is_dir path' for each line, and an empty line
+        as heartbeat, where path is relative to server root.
+        Replied with 450 if too many sessions are watching.
+
+        :param path: server path to the directory
+        '''
+
+        src_path = self.get_server_path(path)
+        log('debug', f'Watching directory: {src_path}')
+        if not is_safe_path(src_path, self.server_dir, allow_base=True, resolved=True):
+            self.send_status(553)
+            return
+        if not storage.isdir(src_path):
+            self.send_status(550)
+            return
+
+        if not watch_slots.acquire(blocking=False):
+            log('info', f'Too many sessions watching, rejected: {self.client_addr}')
+            self.send_status(450)
+            return
+        prefix = self.to_server_path(src_path).rstrip('/') + '/'
+        q = events.subscribe()
+        try:
+            self.send_status(150)
+            if not self.data_sock and not self.open_data_sock():
+                return
+            self.open_data_conn()
+            while True:
+                try:
+                    event_type, ev_path, is_dir = q.get(timeout=self.watch_heartbeat)
+                except Empty:
+                    self.data_conn.sendall(b'\r\n')
+                    continue
+                if ev_path.startswith(prefix):
+                    ev_path = self.from_server_path(ev_path).replace(' ', '%20')
+                    line = f'{event_type} {int(is_dir)} {ev_path}\r\n'
+                    self.data_conn.sendall(line.encode('utf-8'))
+        except OSError:  # closed by client
+            log('info', f'Stopped watching directory: {src_path}')
+        finally:
+            events.unsubscribe(q)
+            watch_slots.release()
+            self.close_data_sock()
+
+    def site(self, args: str) -> None:
+        '''
+        Run a site specific command.
+
+        Supported: WATCH / CPFR / CPTO <server_path>, RMSTAT [job_id], FIND <text>
+
+        :param args: subcommand and its arguments
+        '''
+
+        site_dict = {
+            'WATCH': self.watch,
+            'CPFR': self.cpfr,
+            'CPTO': self.cpto,
+            'RMSTAT': self.rmstat,
+            'FIND': self.find,
+        }
+
+        sub_cmd = args.split(None, 1)
+        method = site_dict.get(sub_cmd[0].upper())
+        if not method:
+            self.send_status(502)
+            return
+        method(*sub_cmd[1:])
+
     def router(self, raw_cmd: str) -> None:
         '''
         Route to the associated method based on client command.
@@ -458,24 +1382,40 @@ class ftp_server(Thread):
 
         method_dict = {
             'PING': self.pong,
+            'NOOP': self.noop,
+            'AUTH': self.auth,
+            'PBSZ': self.pbsz,
+            'PROT': self.prot,
+            'USER': self.login_user,
+            'PASS': self.login_pass,
             'LIST': self.ls,
+            'NLST': self.nlst,
             'RETR': self.retrieve,
             'STOR': self.store,
+            'ALLO': self.allocate,
+            'REST': self.rest,
+            'SIZE': self.size,
+            'MDTM': self.mdtm,
             'DELE': self.delete,
             'CWD': self.cwd,
             'PWD': self.pwd,
             'MKD': self.mkdir,
             'RMD': self.rmdir,
             'RMDA': self.rmdir_all,
+            'RNFR': self.rnfr,
+            'RNTO': self.rnto,
+            'SITE': self.site,
         }
 
         try:
-            log('debug', f'Operation: {raw_cmd}')
+            log('debug', f'Operation: {"PASS ***" if raw_cmd[:4].upper() == "PASS" else raw_cmd}')
             cmd = raw_cmd.split(None, 1)
             cmd_len = len(cmd)
             op = cmd[0]
             method = method_dict.get(op[:4].upper())
-            if method:
+            if method and not self.logged_in and op[:4].upper() not in self.public_ops:
+                self.send_status(530)
+            elif method:
                 if cmd_len == 1:
                     method()
                 else:
@@ -486,29 +1426,105 @@ class ftp_server(Thread):
             log('warn', f'Invalid client operation: {raw_cmd}, error: {e}')
             self.send_status(501)
 
+    def read_cmd(self, wait: float) -> str:
+        '''
+        Return the next command line from control connection, where commands
+        sent together are split by line.
+
+        Return '' if the connection is closed, or None if no command is received
+        within the waiting time.
+
+        :param wait: seconds to wait for a command
+        '''
+
+        while True:
+            while b'\n' not in self.ctrl_buffer:
+                if len(self.ctrl_buffer) > self.max_cmd_size:
+                    log('warn', f'Command too long: {self.client_addr}')
+                    return ''
+                timeout = self.ctrl_conn.gettimeout()
+                self.ctrl_conn.settimeout(wait)
+                try:
+                    data = self.ctrl_conn.recv(self.buffer_size)
+                except socket.timeout:
+                    return None
+                finally:
+                    self.ctrl_conn.settimeout(timeout)
+                if not data:
+                    return ''
+                self.ctrl_buffer += data
+            line, _, self.ctrl_buffer = self.ctrl_buffer.partition(b'\n')
+            raw_cmd = line.decode('utf-8').strip('\r\n')
+            if raw_cmd:  # not an empty line
+                return raw_cmd
+
+    def start(self) -> None:
+        '''
+        Greet the client, and serve it in a new thread.
+        '''
+
+        sessions.add(self)
+        try:
+            self.send_status(220)
+        except OSError:
+            self.close()
+            return
+        Thread(target=self.run).start()
+
+    def resume(self) -> None:
+        '''
+        Serve a parked session in a new thread, once a command arrives.
+        '''
+
+        Thread(target=self.run).start()
+
     def run(self) -> None:
         '''
         Main function for server.
 
-        Receive a command from client and send it to router.
+        Receive a command from client and send it to router, until
+        no command is received for a while, when the session is parked.
+        While draining, the session is closed before its next command.
         '''
 
+        parked = False
         try:
-            self.send_status(220)
             while self.ctrl_conn:
-                raw_cmd = (
-                    self.ctrl_conn
-                    .recv(self.buffer_size)
-                    .decode('utf-8')
-                    .strip('\r\n')
-                )
+                raw_cmd = self.read_cmd(sessions.park_after)
+                if raw_cmd is None:  # idle, waiting without a thread
+                    sessions.park(self)
+                    parked = True
+                    return
                 if not raw_cmd:  # connection closed
                     break
+                self.last_active = time.monotonic()
+                if sessions.draining:  # shutting down, the client reconnects to the next process
+                    self.send_status(421)
+                    break
                 self.router(raw_cmd)
+                self.last_active = time.monotonic()  # idle from the end of a transfer
         except (socket.timeout, socket.error):
             pass
         finally:
-            self.close()
+            if not parked:
+                self.close()
+
+
+def open_listen_sock(backlog: int, reuse_port: bool = False) -> socket.socket:
+    '''
+    Open a socket listening at the control port.
+
+    :param backlog: maximum number of connections waiting to be accepted
+    :param reuse_port: True to share the control port with other sockets by SO_REUSEPORT
+    '''
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((listen_host, listen_port))
+    s.listen(backlog)
+    return s
 
 
 class server_listener(Thread):
@@ -516,16 +1532,21 @@ class server_listener(Thread):
     Naive-FTP server listener
     '''
 
-    def __init__(self) -> None:
+    def __init__(self, sock_fd: int = None) -> None:
         '''
         Initialize server listener.
+
+        :param sock_fd: control socket inherited from a previous server process,
+                        or from the supervisor, or None to open a new one
         '''
 
         super().__init__()
 
         # Properties
         self.ctrl_timeout_duration: float = 30.0
-        self.max_allowed_conn: int = 5
+        self.max_allowed_conn: int = listen_backlog
+        self.poll_interval: float = 0.5
+        self.sock_fd: int = sock_fd
 
         # Control connection
         self.ctrl_sock: socket.socket = None
@@ -533,6 +1554,11 @@ class server_listener(Thread):
         self.ctrl_conn: socket.socket = None
         self.client_addr: Tuple[str, int] = None
 
+        # Connections are accepted while accepting is set, under accept_lock
+        self.ready: Event = Event()
+        self.accepting: Event = Event()
+        self.accept_lock: Lock = Lock()
+
     def open_ctrl_conn(self) -> None:
         '''
         Open control connection.
@@ -540,19 +1566,21 @@ class server_listener(Thread):
 
         self.ctrl_conn, self.client_addr = self.ctrl_sock.accept()
         self.ctrl_conn.settimeout(self.ctrl_timeout_duration)
+        set_keepalive(self.ctrl_conn)
         log('info', f'Accept connection: {self.client_addr}')
 
     def open_ctrl_sock(self) -> None:
         '''
-        Open control socket.
+        Open control socket, or take over the one inherited.
         '''
 
         if self.ctrl_sock:
             self.close_ctrl_sock()
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((listen_host, listen_port))
-        s.listen(self.max_allowed_conn)
+        if self.sock_fd is not None:
+            s = socket.socket(fileno=self.sock_fd)
+            self.sock_fd = None
+        else:
+            s = open_listen_sock(self.max_allowed_conn)
         self.ctrl_sock = s
         self.ctrl_sock_name = s.getsockname()
         log('info', f'Server started, listening at {self.ctrl_sock_name}')
@@ -566,46 +1594,602 @@ class server_listener(Thread):
             self.ctrl_sock.close()
             self.ctrl_sock = None
 
+    def wait_ready(self, timeout: float) -> bool:
+        '''
+        Wait until connections are accepted.
+
+        Return True if ready within timeout.
+
+        :param timeout: seconds to wait
+        '''
+
+        return self.ready.wait(timeout)
+
+    def pause(self) -> None:
+        '''
+        Stop accepting connections, keeping the control socket open,
+        so that connections wait in its backlog, e.g. for the next server process.
+        '''
+
+        self.accepting.clear()
+        with self.accept_lock:  # the connection being accepted, if any, is served
+            pass
+
+    def resume(self) -> None:
+        '''
+        Accept connections again after paused.
+        '''
+
+        self.accepting.set()
+
     def close(self) -> None:
         '''
         Close all sockets.
         '''
 
+        self.pause()
         self.close_ctrl_sock()
 
+    def drain(self, timeout: float) -> None:
+        '''
+        Stop gracefully: close all sockets, and wait for sessions
+        to finish their current commands.
+
+        :param timeout: seconds to wait before active sessions are aborted
+        '''
+
+        self.close()
+        if data_pool:
+            data_pool.close()
+        sessions.drain(timeout)
+
     def run(self) -> None:
         '''
         Main function for server listener.
         '''
 
-        self.open_ctrl_sock()
+        if not self.ctrl_sock:
+            self.open_ctrl_sock()
+        selector = selectors.DefaultSelector()
+        selector.register(self.ctrl_sock, selectors.EVENT_READ)
+        self.accepting.set()
+        self.ready.set()
         server: Type[ftp_server] = None
         try:
             while self.ctrl_sock:
-                self.open_ctrl_conn()
+                with self.accept_lock:
+                    accepted = self.accepting.is_set() and selector.select(self.poll_interval)
+                    if accepted:
+                        self.open_ctrl_conn()
+                if not accepted:
+                    self.accepting.wait(self.poll_interval)
+                    continue
                 server = ftp_server(self.ctrl_conn, self.client_addr)
                 server.start()
         except (socket.timeout, socket.error):
             if server:
                 server.close()
             self.close()
+        finally:
+            selector.close()
 
 
-def main() -> None:
-    print('Welcome to Naive-FTP server! Press q to exit.')
+def set_rate(args: List[str]) -> None:
+    '''
+    Change a bandwidth limit at runtime.
+
+    Usage: rate <global|host|session> <bytes_per_second>
+
+    In multi-process mode, the global rate is split among workers, while host
+    and session rates apply in each worker, see split_rate.
+
+    :param args: command arguments
+    '''
+
+    try:
+        scope, rate = args
+        if scope not in ('global', 'host', 'session'):
+            raise ValueError
+        limiter.configure(**{f'{scope}_rate': float(rate)})
+        log('info', f'Rate limit changed: {scope} {rate} B/s')
+    except ValueError:
+        log('warn', f'Usage: rate <global|host|session> <bytes_per_second>, 0 or at least {min_rate:g}; '
+                    'with workers, a host gets up to its rate in each worker serving it')
+
+
+def split_rate(args: List[str], workers: int) -> List[str]:
+    '''
+    Split the global rate evenly among worker processes, each of which
+    shapes only its own connections.
+
+    Host and session rates are kept: connections of a host are spread among
+    workers by the kernel, so a host may get up to its rate in each worker
+    serving it, rather than a share which would starve a host whose
+    connections all land on one worker.
+
+    Return the arguments of the rate command for each worker.
+
+    :param args: command arguments
+    :param workers: number of worker processes
+    '''
+
+    try:
+        scope, rate = args
+        rate = check_rate(float(rate))
+    except ValueError:  # reported by workers
+        return args
+    if scope == 'global' and rate:
+        rate = max(rate / workers, min_rate)
+    return [scope, str(rate)]
+
+
+def set_cache(args: List[str]) -> None:
+    '''
+    Change the limits of the hot file cache at runtime, or show its statistics.
+
+    Usage: cache [<max_file_size> <max_bytes>]
+
+    :param args: command arguments
+    '''
+
+    try:
+        if args:
+            max_file_size, max_bytes = (int(i) for i in args)
+            hot_files.configure(max_file_size, max_bytes)
+            log('info', f'Cache limits changed: {max_file_size} B per file, {max_bytes} B in total')
+        log('info', f'Hot file cache: {hot_files.stats()}')
+    except ValueError:
+        log('warn', 'Usage: cache [<max_file_size> <max_bytes>]')
+
+
+def manage_users(args: List[str]) -> None:
+    '''
+    Add or remove a user, or list all users.
+
+    Usage: user [add <name> <password> [root] [quota] | del <name>]
+
+    :param args: command arguments
+    '''
+
+    if users is None:
+        log('warn', 'User database not enabled, start with --users <file>')
+        return
+    try:
+        if args[:1] == ['add'] and 3 <= len(args) <= 5:
+            name, password, root, quota = (args[1:] + ['', None])[:4]
+            users.add(name, password, root, int(quota) if quota else None)
+            log('info', f'User added: {name}')
+        elif args[:1] == ['del'] and len(args) == 2:
+            if not users.remove(args[1]):
+                log('warn', f'User not found: {args[1]}')
+        elif args:
+            raise ValueError
+    except ValueError:
+        log('warn', 'Usage: user [add <name> <password> [root] [quota] | del <name>]')
+        return
+    except OSError as e:
+        log('warn', f'Failed to save user database, error: {e}')
+        return
+    for u in users.list():
+        log('info', f'User {u.name}: root /{u.root}, quota {u.quota}')
+    log('info', f'Users: {users.stats()}')
+
+
+def manage_quotas(args: List[str]) -> None:
+    '''
+    Set or remove the quota of a directory, or list all quotas with their usage.
+
+    Usage: quota [set <path> <bytes> | del <path> | check]
+
+    :param args: command arguments
+    '''
+
+    try:
+        if args[:1] == ['set'] and len(args) == 3:
+            quotas.set(args[1], int(args[2]), storage)
+        elif args[:1] == ['del'] and len(args) == 2:
+            if not quotas.remove(args[1]):
+                log('warn', f'Quota not found: {args[1]}')
+        elif args == ['check']:
+            for path, _, _ in quotas.list():
+                quotas.reconcile(path, storage)
+        elif args:
+            raise ValueError
+        for path, quota, used in quotas.list():
+            log('info', f'Quota of {path}: {used} / {quota} B')
+    except ValueError:
+        log('warn', 'Usage: quota [set <path> <bytes> | del <path> | check]')
+    except sqlite3.Error as e:
+        log('warn', f'Failed to access quotas, error: {e}')
+
+
+def handle_command(cmd: List[str]) -> None:
+    '''
+    Handle a console command other than exiting.
+
+    :param cmd: console command
+    '''
+
+    op = cmd[0].lower()
+    if op == 'rate':
+        set_rate(cmd[1:])
+    elif op == 'cache':
+        set_cache(cmd[1:])
+    elif op == 'pool':
+        log('info', f'Data port pool: {data_pool.stats() if data_pool else None}')
+    elif op == 'sessions':
+        log('info', f'Sessions: {sessions.stats()}')
+    elif op == 'trash':
+        log('info', f'Background removal: {remover.stats()}')
+    elif op == 'storage':
+        if cmd[1:] == ['gc'] and isinstance(storage, dedup_storage):
+            storage.gc()
+        log('info', f'Storage: {type(storage).__name__} {getattr(storage, "stats", dict)()}')
+    elif op == 'user':
+        manage_users(cmd[1:])
+    elif op == 'quota':
+        manage_quotas(cmd[1:])
+    elif op == 'index':
+        if cmd[1:] == ['rebuild']:
+            file_index.rebuild()
+        log('info', f'Metadata index: {file_index.stats()}')
+    else:
+        log('warn', f'Invalid command: {" ".join(cmd)}')
+
+
+def use_storage(name: str) -> None:
+    '''
+    Choose the storage of server files.
+
+    :param name: 'local' / 'dedup' / 'memory' / 'object'
+    '''
+
+    global storage
+    if name == 'dedup':
+        storage = dedup_storage(chunk_dir, server_dir)
+        log('info', f'Deduplicating storage, chunks in {chunk_dir}')
+    elif name == 'memory':
+        storage = memory_storage(server_dir)
+        log('info', 'Memory storage, files are lost on exit')
+    elif name == 'object':
+        storage = object_storage(object_dir, server_dir)
+        log('info', f'Object storage, objects in {object_dir}')
+
+
+def use_users(path: str) -> None:
+    '''
+    Require USER / PASS, with users in a JSON file.
+
+    :param path: path to the user database
+    '''
 
-    listener = server_listener()
+    global users
+    users = user_db(os.path.realpath(path))
+
+
+def use_tls(cert_file: str, key_file: str, ktls: bool = False) -> None:
+    '''
+    Enable AUTH TLS with a certificate.
+
+    :param cert_file: path to the certificate chain in PEM
+    :param key_file: path to the private key in PEM, or None if in cert_file
+    :param ktls: True to offload encryption to the kernel where supported
+    '''
+
+    global tls_context
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    if ktls:
+        op = getattr(ssl, 'OP_ENABLE_KTLS', 0)  # Python 3.12+, with OpenSSL 3
+        if op:
+            context.options |= op
+        else:
+            log('warn', 'Kernel TLS not supported by this Python, ignored')
+    tls_context = context
+    log('info', f'TLS enabled, certificate: {cert_file}')
+
+
+def restart(listener: server_listener) -> bool:
+    '''
+    Start the next server process with the same arguments, and wait until
+    it accepts connections. The control socket is handed over, with connections
+    waiting in its backlog meanwhile. With workers, the listening socket of each
+    worker is handed over, and old workers accept connections until they drain.
+
+    Return True if the next process is ready, when this one should drain and exit.
+
+    :param listener: server listener, or worker supervisor
+    '''
+
+    if os.name == 'nt':
+        log('warn', 'Restart not supported on Windows')
+        return False
+    ready_r, ready_w = os.pipe()
+    env = dict(os.environ, NAIVE_FTP_READY_FD=str(ready_w))
+    fds = [ready_w]
+    ctrl_sock = getattr(listener, 'ctrl_sock', None)
+    if ctrl_sock:
+        listener.pause()
+    socks = [ctrl_sock] if ctrl_sock else getattr(listener, 'socks', [])
+    if socks:
+        env['NAIVE_FTP_LISTEN_FD'] = ','.join(str(s.fileno()) for s in socks)
+        fds += [s.fileno() for s in socks]
+    args = sys.orig_argv[1:] if hasattr(sys, 'orig_argv') else sys.argv  # Python 3.10+ keeps -m
+    start = time.monotonic()
+    ready = False
+    try:
+        proc = subprocess.Popen([sys.executable, *args], pass_fds=fds, env=env, start_new_session=True)
+    except OSError as e:
+        log('warn', f'Failed to start the next server process, error: {e}')
+        proc = None
+    finally:
+        os.close(ready_w)
+    if proc:
+        readable, _, _ = select.select([ready_r], [], [], ready_timeout)
+        ready = bool(readable) and os.read(ready_r, 1) == b'1'  # empty if exited
+    os.close(ready_r)
+    if not ready:
+        if proc and proc.poll() is None:
+            proc.terminate()
+        log('warn', 'Next server process not ready, restart cancelled')
+        if ctrl_sock:
+            listener.resume()
+        return False
+    log('info', f'Next server process ready in {time.monotonic() - start:.2f}s, pid: {proc.pid}')
+    return True
+
+
+def empty_trash_after(pid: int) -> None:
+    '''
+    Empty the trash once the previous process has exited after a restart,
+    abandoning the removals it had not finished.
+
+    :param pid: process ID of the previous process, the parent of this one
+    '''
+
+    while os.getppid() == pid:
+        time.sleep(1.0)
+    remover.empty_trash()
+
+
+def relay_events(supervisor: worker_supervisor) -> None:
+    '''
+    Send change events of the supervisor process, from workers and inotify,
+    to all workers, for their sessions watching directories.
+
+    :param supervisor: the worker supervisor
+    '''
+
+    q = events.subscribe()
+    while True:
+        event_type, path, is_dir = q.get()
+        supervisor.broadcast(['event', event_type, path, is_dir])
+
+
+def on_worker_message(msg: list) -> None:
+    '''
+    Handle a message from a worker process.
+
+    :param msg: the message, ['event', event_type, path, is_dir] for a change
+    '''
+
+    if msg[0] == 'event':
+        events.publish(*msg[1:])
+
+
+def run_worker(
+    pipe: Connection,
+    index: int,
+    ctrl_sock: socket.socket,
+    ports: range,
+    storage_name: str = 'local',
+    tls: Tuple[str, str, bool] = None,
+    users_path: str = None,
+) -> None:
+    '''
+    Main function for a worker process in multi-process mode.
+
+    :param pipe: command pipe from the supervisor
+    :param index: index of the worker
+    :param ctrl_sock: listening socket of the worker, kept open by the supervisor as well
+    :param ports: data ports assigned to the worker
+    :param storage_name: storage of server files
+    :param tls: arguments of use_tls, or None to disable TLS
+    :param users_path: path to the user database, or None for anonymous access
+    '''
+
+    global data_pool, shared_tree, supervisor_pipe
+    shared_tree = True
+    supervisor_pipe = pipe
+    remover.id_prefix = f'{index}.'
+    if ports:
+        data_pool = port_pool(listen_host, ports)
+    use_storage(storage_name)
+    if tls:
+        use_tls(*tls)
+    if users_path:
+        use_users(users_path)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # handled by supervisor
+    listener = server_listener(sock_fd=ctrl_sock.detach())
+    listener.open_ctrl_sock()
+    pipe.send('ready')
+
+    def _recv_commands() -> None:
+        '''
+        Apply console commands broadcast by the supervisor, until drained.
+        '''
+
+        try:
+            while True:
+                cmd = pipe.recv()
+                if cmd[0] == 'drain':
+                    listener.drain(float(cmd[1]))
+                    return
+                if cmd[0] == 'event':
+                    events.publish(*cmd[1:])
+                else:
+                    handle_command(cmd)
+        except (EOFError, OSError):
+            pass
+
+    Thread(target=_recv_commands, daemon=True).start()
+    if storage.on_disk:
+        file_index.start()  # written by the supervisor process
+    log('info', f'Worker {index} serving, data ports: {ports}')
+    listener.run()
+
+
+def parse_args() -> argparse.Namespace:
+    '''
+    Parse command line arguments.
+    '''
+
+    def _port_range(value: str) -> Tuple[int, int]:
+        first, last = (int(p) for p in value.split('-'))
+        if not 0 < first <= last < 65536:
+            raise ValueError
+        return first, last
+
+    parser = argparse.ArgumentParser(description='Naive-FTP server')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='number of worker processes sharing the control port (default: 1)',
+    )
+    parser.add_argument(
+        '-d', '--data-ports', type=_port_range, default=None, metavar='FIRST-LAST',
+        help='passive data port range, split among workers (default: ephemeral)',
+    )
+    parser.add_argument(
+        '-s', '--storage', choices=('local', 'dedup', 'memory', 'object'), default='local',
+        help='storage of server files: plain files, deduplicated chunks, '
+             'in memory, or objects in a local object store stand-in (default: local)',
+    )
+    parser.add_argument(
+        '--cert', default=None, metavar='FILE',
+        help='certificate chain in PEM, enabling AUTH TLS',
+    )
+    parser.add_argument(
+        '--key', default=None, metavar='FILE',
+        help='private key in PEM, if not in the certificate file',
+    )
+    parser.add_argument(
+        '-u', '--users', default=None, metavar='FILE',
+        help='user database in JSON, requiring login (default: anonymous access)',
+    )
+    parser.add_argument(
+        '--ktls', action='store_true',
+        help='offload TLS encryption to the kernel where supported',
+    )
+    parser.add_argument(
+        '--drain-timeout', type=float, default=drain_timeout, metavar='SECONDS',
+        help='seconds to wait for active transfers on exit or restart (default: %(default)s)',
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    global data_pool, drain_timeout
+    args = parse_args()
+    drain_timeout = args.drain_timeout
+    # Set by the previous process on restart, see restart()
+    sock_fds = os.environ.pop('NAIVE_FTP_LISTEN_FD', None)
+    inherited = [int(fd) for fd in sock_fds.split(',')] if sock_fds else []
+    ready_fd = os.environ.pop('NAIVE_FTP_READY_FD', None)
+    console = ready_fd is None  # kept by the terminal of the previous process otherwise
+    if console:
+        print('Welcome to Naive-FTP server! Press q to exit.')
+        remover.empty_trash()
+    else:  # still being emptied by the previous process
+        Thread(target=empty_trash_after, args=(os.getppid(),), daemon=True).start()
+    use_storage(args.storage)
+    tls = (args.cert, args.key, args.ktls) if args.cert else None
+    if tls:
+        use_tls(*tls)
+    if args.users:
+        use_users(args.users)
+    if storage.on_disk and file_index.start(events):  # otherwise FIND is not supported
+        file_index.rebuild()
+    quotas.start(storage)  # reconciled by this process only
+
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        log('warn', 'SO_REUSEPORT not supported, using a single process')
+        args.workers = 1
+    if args.workers > 1 and args.storage == 'memory':
+        log('warn', 'Memory storage is not shared by processes, using a single process')
+        args.workers = 1
+
+    if args.workers > 1:
+        port_range = args.data_ports
+        ctrl_socks = [socket.socket(fileno=fd) for fd in inherited[:args.workers]]
+        ctrl_socks += [open_listen_sock(listen_backlog, reuse_port=True) for _ in range(args.workers - len(ctrl_socks))]
+        listener = worker_supervisor(
+            args.workers,
+            run_worker,
+            lambda i: (
+                ctrl_socks[i],
+                partition_ports(port_range, args.workers, i) if port_range else None,
+                args.storage, tls, args.users,
+            ),
+            on_message=on_worker_message,
+            socks=ctrl_socks,
+        )
+        Thread(target=relay_events, args=(listener,), daemon=True).start()
+    else:
+        if args.data_ports:
+            data_pool = port_pool(listen_host, partition_ports(args.data_ports, 1, 0))
+        listener = server_listener(sock_fd=inherited[0] if inherited else None)
+    start_inotify(server_dir)
     listener.start()
+    if ready_fd:
+        if listener.wait_ready(ready_timeout):
+            os.write(int(ready_fd), b'1')
+        os.close(int(ready_fd))
+
+    def _on_restart(*_) -> None:
+        if restart(listener):
+            raise SystemExit
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, _on_restart)
 
     try:
-        while True:
-            if input().lower() == 'q':
+        while console:
+            try:
+                cmd = input().split()
+            except EOFError:  # e.g. run by a service manager
+                console = False
+                break
+            if not cmd:
+                continue
+            op = cmd[0].lower()
+            if op == 'q':
                 print('Bye!')
                 break
+            if op == 'restart':
+                if restart(listener):
+                    break
+                continue
+            # The index is rebuilt, chunks are collected, and users and quotas are saved by this process
+            if op == 'rate' and args.workers > 1:
+                listener.broadcast(cmd[:1] + split_rate(cmd[1:], args.workers))
+            elif args.workers > 1 and op not in ('index', 'user', 'quota') and cmd[1:] != ['gc']:
+                listener.broadcast(cmd)
+            else:
+                handle_command(cmd)
+        if not console:
+            log('info', f'Serving without console, pid: {os.getpid()}, SIGTERM to exit, SIGUSR2 to restart')
+            while True:
+                time.sleep(3600)
     except KeyboardInterrupt:
         print('\nInterrupted.')
     finally:
-        listener.close()
+        log('info', f'Draining sessions, for up to {drain_timeout}s')
+        try:
+            listener.drain(drain_timeout)
+        except KeyboardInterrupt:  # interrupted again
+            listener.drain(0)
         log('info', 'Server stopped.')
 
 
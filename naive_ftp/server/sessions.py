@@ -0,0 +1,234 @@
+import selectors
+import socket
+import time
+from threading import Lock, Thread
+from typing import Dict, Set
+from naive_ftp.utils import log
+
+
+class session_manager():
+    '''
+    Keep idle sessions without threads, and evict those idle for too long.
+
+    A session waiting for its next command longer than park_after seconds
+    is parked: its thread exits, and its control connection is watched by
+    a single selector thread, which starts a thread for the session again
+    once a command arrives. So threads follow active sessions, not connected
+    ones. Parked sessions are evicted after the idle timeout, which shrinks
+    from max_idle to min_idle as connected sessions approach max_sessions.
+
+    On shutdown, sessions are drained: parked ones are closed at once,
+    and active ones once their current commands finish.
+    '''
+
+    def __init__(
+        self,
+        park_after: float = 1.0,
+        max_idle: float = 300.0,
+        min_idle: float = 15.0,
+        max_sessions: int = 1000,
+        reap_interval: float = 5.0,
+    ) -> None:
+        '''
+        Initialize session manager. The selector thread is started on the first park.
+
+        :param park_after: seconds a session waits for a command before parked
+        :param max_idle: seconds a parked session is kept under low load
+        :param min_idle: seconds a parked session is kept under full load
+        :param max_sessions: number of connected sessions at full load
+        :param reap_interval: seconds between checks for idle sessions
+        '''
+
+        # Properties
+        self.park_after: float = park_after
+        self.max_idle: float = max_idle
+        self.min_idle: float = min_idle
+        self.max_sessions: int = max_sessions
+        self.reap_interval: float = reap_interval
+
+        # Connected and parked sessions, where parked ones are owned by the selector thread
+        self.lock: Lock = Lock()
+        self.sessions: Set[object] = set()
+        self.parked: Set[object] = set()
+        self.evicted: int = 0
+        self.resumed: int = 0
+        self.draining: bool = False
+
+        # Selector, woken up by a byte on wakeup_w when a session is parked
+        self.selector: selectors.BaseSelector = selectors.DefaultSelector()
+        self.wakeup_r: socket.socket = None
+        self.wakeup_w: socket.socket = None
+        self.thread: Thread = None
+
+    def add(self, session: object) -> None:
+        '''
+        Count a connected session.
+
+        :param session: the session, with ctrl_conn, start_time, last_active,
+                        resume(), evict() and abort()
+        '''
+
+        with self.lock:
+            self.sessions.add(session)
+
+    def remove(self, session: object) -> None:
+        '''
+        Forget a closed session.
+
+        :param session: the session
+        '''
+
+        with self.lock:
+            self.sessions.discard(session)
+
+    def park(self, session: object) -> None:
+        '''
+        Watch an idle session without a thread, until a command arrives.
+
+        :param session: the session
+        '''
+
+        with self.lock:
+            draining = self.draining
+            if not draining:
+                if not self.thread:
+                    self.wakeup_r, self.wakeup_w = socket.socketpair()
+                    self.wakeup_r.setblocking(False)
+                    self.wakeup_w.setblocking(False)
+                    self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+                    self.thread = Thread(target=self._run, daemon=True)
+                    self.thread.start()
+                self.selector.register(session.ctrl_conn, selectors.EVENT_READ, session)
+                self.parked.add(session)
+        if draining:  # shutting down, closed instead
+            session.evict()
+            return
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:  # woken up already
+            pass
+
+    def idle_timeout(self) -> float:
+        '''
+        Return the seconds a parked session is kept under the current load.
+        '''
+
+        with self.lock:
+            load = min(len(self.sessions) / self.max_sessions, 1.0)
+        return self.max_idle - (self.max_idle - self.min_idle) * load
+
+    def _unpark(self, session: object) -> bool:
+        '''
+        Stop watching a parked session.
+
+        Return True if it was parked.
+
+        :param session: the session
+        '''
+
+        with self.lock:
+            if session not in self.parked:
+                return False
+            self.parked.discard(session)
+            try:
+                self.selector.unregister(session.ctrl_conn)
+            except (KeyError, ValueError):  # closed meanwhile
+                pass
+        return True
+
+    def reap(self) -> int:
+        '''
+        Evict parked sessions idle longer than the idle timeout.
+
+        Return the number of evicted sessions.
+        '''
+
+        deadline = time.monotonic() - self.idle_timeout()
+        with self.lock:
+            idle = [s for s in self.parked if s.last_active < deadline]
+        count = 0
+        for session in idle:
+            if self._unpark(session):
+                session.evict()
+                count += 1
+        if count:
+            with self.lock:
+                self.evicted += count
+            log('info', f'Evicted {count} idle sessions')
+        return count
+
+    def drain(self, timeout: float) -> bool:
+        '''
+        Close parked sessions, and wait for active ones to close after their
+        current commands. Sessions still active after timeout are aborted.
+
+        Return True if all sessions closed in time.
+
+        :param timeout: seconds to wait for active sessions
+        '''
+
+        with self.lock:
+            self.draining = True
+            parked = list(self.parked)
+        for session in parked:
+            if self._unpark(session):
+                session.evict()
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                active = list(self.sessions)
+            if not active:
+                return True
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+        log('warn', f'Aborting {len(active)} sessions still active after {timeout}s')
+        for session in active:
+            session.abort()
+        return False
+
+    def _run(self) -> None:
+        '''
+        Main function for the selector thread.
+        '''
+
+        next_reap = time.monotonic() + self.reap_interval
+        while True:
+            for key, _ in self.selector.select(max(next_reap - time.monotonic(), 0)):
+                if key.fileobj is self.wakeup_r:
+                    try:
+                        while self.wakeup_r.recv(1024):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif self._unpark(key.data):  # a command, or closed by client
+                    with self.lock:
+                        self.resumed += 1
+                    key.data.resume()
+            if time.monotonic() >= next_reap:
+                self.reap()
+                next_reap = time.monotonic() + self.reap_interval
+
+    def stats(self) -> Dict[str, float]:
+        '''
+        Return the number of sessions, their ages and idle times in seconds.
+        '''
+
+        now = time.monotonic()
+        with self.lock:
+            ages = [now - s.start_time for s in self.sessions]
+            idle = [now - s.last_active for s in self.parked]
+            connected, parked = len(self.sessions), len(self.parked)
+            evicted, resumed = self.evicted, self.resumed
+        return {
+            'connected': connected,
+            'active': connected - parked,
+            'parked': parked,
+            'resumed': resumed,
+            'evicted': evicted,
+            'idle_timeout': round(self.idle_timeout(), 1),
+            'avg_age': round(sum(ages) / len(ages), 1) if ages else 0.0,
+            'max_age': round(max(ages, default=0.0), 1),
+            'avg_idle': round(sum(idle) / len(idle), 1) if idle else 0.0,
+            'max_idle': round(max(idle, default=0.0), 1),
+        }
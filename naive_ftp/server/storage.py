@@ -0,0 +1,644 @@
+import io
+import os
+import shutil
+import stat
+import time
+import uuid
+from threading import Lock
+from typing import BinaryIO, Dict, Iterator, Tuple
+from urllib.parse import quote, unquote
+from naive_ftp.server.tree_copy import copy_tree
+
+
+class _replacing_writer(io.FileIO):
+    '''
+    A file written under a temporary name, replacing the target on close.
+
+    Readers, including memory maps, keep seeing the old content meanwhile,
+    as the old file is never truncated.
+    '''
+
+    def __init__(self, tmp_path: str, path: str) -> None:
+        super().__init__(tmp_path, 'wb')
+        self.path: str = path
+        self.discarded: bool = False
+
+    def close(self) -> None:
+        if not self.closed:
+            super().close()
+            if self.discarded:
+                os.remove(self.name)
+            else:
+                os.replace(self.name, self.path)
+        super().close()
+
+
+def open_replacing(path: str, tmp_dir: str = None) -> BinaryIO:
+    '''
+    Open a file for buffered writing, which replaces the file atomically on close.
+
+    :param path: path of the file
+    :param tmp_dir: directory of the temporary file, on the same file system,
+                    the directory of the file by default, as a hidden file
+    '''
+
+    dir_name, file_name = os.path.split(path)
+    tmp_name = f'.{file_name}.{uuid.uuid4().hex}.tmp'
+    return io.BufferedWriter(_replacing_writer(os.path.join(tmp_dir or dir_name, tmp_name), path))
+
+
+def discard(f: BinaryIO) -> None:
+    '''
+    Make a file opened by open_write keep its old content on close,
+    dropping what has been written, e.g. when an upload is aborted.
+
+    :param f: the file being written
+    '''
+
+    getattr(f, 'raw', f).discarded = True
+
+
+def make_stat(is_dir: bool, size: int, mtime: float, ino: int = 0) -> os.stat_result:
+    '''
+    Return a stat_result for a file or directory not in the file system.
+
+    :param is_dir: True if a directory
+    :param size: content size in bytes
+    :param mtime: last modified time
+    :param ino: inode number, which changes when the content is replaced
+    '''
+
+    mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o644
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.stat_result(
+        (mode, ino, 0, 1, uid, uid, size, mtime, mtime, mtime),
+        {'st_mtime_ns': int(mtime * 1e9)},
+    )
+
+
+class storage_backend():
+    '''
+    Storage of files and directories under the server root.
+
+    Paths are real paths under the server root, as resolved by the session,
+    so that path checks work the same for every storage. Errors are raised
+    as OSError, like the os module does.
+    '''
+
+    # Whether paths are real files, so that the trash directory, tree_copy,
+    # inotify and the metadata index work on them
+    on_disk: bool = False
+
+    # Whether file content can be cached by path, as in hot_files
+    cacheable: bool = False
+
+    def stat(self, path: str) -> os.stat_result:
+        '''
+        Return the stat_result of a file or directory, whose st_size is its content size.
+
+        :param path: real path of the file or directory
+        '''
+
+        raise NotImplementedError
+
+    def list(self, path: str) -> Iterator[Tuple[str, os.stat_result]]:
+        '''
+        List names and stat_results in a directory.
+
+        :param path: real path of the directory
+        '''
+
+        raise NotImplementedError
+
+    def open_read(self, path: str, offset: int = 0) -> BinaryIO:
+        '''
+        Open a file for reading from an offset, which supports read and seek.
+
+        :param path: real path of the file
+        :param offset: offset to start reading at
+        '''
+
+        raise NotImplementedError
+
+    def open_write(self, path: str) -> BinaryIO:
+        '''
+        Open a file for writing, replacing existing content on close,
+        unless discarded by discard.
+
+        :param path: real path of the file, whose directory should exist
+        '''
+
+        raise NotImplementedError
+
+    def delete(self, path: str) -> None:
+        '''
+        Delete a file.
+
+        :param path: real path of the file
+        '''
+
+        raise NotImplementedError
+
+    def mkdir(self, path: str) -> None:
+        '''
+        Make a directory and its missing parents.
+
+        :param path: real path of the directory, which should not exist
+        '''
+
+        raise NotImplementedError
+
+    def rmdir(self, path: str) -> None:
+        '''
+        Remove an empty directory.
+
+        :param path: real path of the directory
+        '''
+
+        raise NotImplementedError
+
+    def rename(self, src_path: str, dst_path: str) -> None:
+        '''
+        Rename a file or directory, replacing an existing file.
+
+        :param src_path: real path of the source
+        :param dst_path: real path of the destination, whose directory should exist
+        '''
+
+        raise NotImplementedError
+
+    def exists(self, path: str) -> bool:
+        '''
+        Return True if a file or directory exists.
+
+        :param path: real path of the file or directory
+        '''
+
+        try:
+            self.stat(path)
+        except OSError:
+            return False
+        return True
+
+    def isdir(self, path: str) -> bool:
+        '''
+        Return True if a directory exists.
+
+        :param path: real path of the directory
+        '''
+
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def isfile(self, path: str) -> bool:
+        '''
+        Return True if a regular file exists.
+
+        :param path: real path of the file
+        '''
+
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except OSError:
+            return False
+
+    def copy(self, src_path: str, dst_path: str) -> int:
+        '''
+        Copy a file or a directory tree, through open_read and open_write.
+
+        Return the number of copied files.
+
+        :param src_path: real path of the source
+        :param dst_path: real path of the destination, which should not exist
+                         if the source is a directory
+        '''
+
+        if not self.isdir(src_path):
+            with self.open_read(src_path) as src_file, self.open_write(dst_path) as dst_file:
+                shutil.copyfileobj(src_file, dst_file)
+            return 1
+        self.mkdir(dst_path)
+        return sum(
+            self.copy(os.path.join(src_path, name), os.path.join(dst_path, name))
+            for name, _ in list(self.list(src_path))
+        )
+
+    def remove_tree(self, path: str) -> None:
+        '''
+        Remove a directory tree.
+
+        :param path: real path of the directory
+        '''
+
+        for name, st in list(self.list(path)):
+            file_path = os.path.join(path, name)
+            if stat.S_ISDIR(st.st_mode):
+                self.remove_tree(file_path)
+            else:
+                self.delete(file_path)
+        self.rmdir(path)
+
+
+class local_storage(storage_backend):
+    '''
+    Store files as they are under the server root. The default storage.
+    '''
+
+    on_disk: bool = True
+    cacheable: bool = True
+
+    def stat(self, path: str) -> os.stat_result:
+        return os.stat(path)
+
+    def exists(self, path: str) -> bool:
+        return os.path.lexists(path)  # including broken links, which can be removed
+
+    def list(self, path: str) -> Iterator[Tuple[str, os.stat_result]]:
+        with os.scandir(path) as it:
+            for file in it:
+                yield file.name, file.stat()
+
+    def open_read(self, path: str, offset: int = 0) -> BinaryIO:
+        f = open(path, 'rb')
+        if offset:
+            f.seek(offset)
+        return f
+
+    def open_write(self, path: str) -> BinaryIO:
+        return open_replacing(path)
+
+    def delete(self, path: str) -> None:
+        os.remove(path)
+
+    def mkdir(self, path: str) -> None:
+        os.makedirs(path)
+
+    def rmdir(self, path: str) -> None:
+        os.rmdir(path)
+
+    def rename(self, src_path: str, dst_path: str) -> None:
+        os.replace(src_path, dst_path)
+
+    def copy(self, src_path: str, dst_path: str) -> int:
+        return copy_tree(src_path, dst_path)  # in kernel where possible
+
+    def remove_tree(self, path: str) -> None:
+        shutil.rmtree(path)
+
+
+class _mem_node():
+    '''
+    A file or directory of a memory_storage.
+    '''
+
+    def __init__(self, is_dir: bool, ino: int) -> None:
+        self.is_dir: bool = is_dir
+        self.ino: int = ino
+        self.data: bytes = b''
+        self.children: Dict[str, _mem_node] = {}
+        self.mtime: float = time.time()
+
+
+class _mem_writer(io.BytesIO):
+    '''
+    A file being written into a memory_storage, replacing the old content on close.
+    '''
+
+    def __init__(self, storage: 'memory_storage', path: str) -> None:
+        super().__init__()
+        self.storage: memory_storage = storage
+        self.path: str = path
+        self.discarded: bool = False
+
+    def close(self) -> None:
+        if not self.closed and not self.discarded:
+            self.storage._commit(self.path, self.getvalue())
+        super().close()
+
+
+class memory_storage(storage_backend):
+    '''
+    Keep all files in memory, lost on exit.
+
+    Transfers then never touch the disk, so that the protocol layer can be
+    benchmarked by itself. Readers see the content at the time of opening,
+    and a written file is replaced as a whole on close.
+    '''
+
+    def __init__(self, base_dir: str) -> None:
+        '''
+        Initialize memory storage, with an empty root directory.
+
+        :param base_dir: real path of the server root
+        '''
+
+        # Properties
+        self.base_dir: str = base_dir
+        self.lock: Lock = Lock()
+        self.next_ino: int = 1
+        self.root: _mem_node = self._new_node(is_dir=True)
+
+    def _new_node(self, is_dir: bool) -> _mem_node:
+        '''
+        Return a new node, the lock should be held except in __init__.
+
+        :param is_dir: True if a directory
+        '''
+
+        self.next_ino += 1
+        return _mem_node(is_dir, self.next_ino)
+
+    def _split(self, path: str) -> Tuple[str, ...]:
+        '''
+        Return the names from the server root to a path.
+
+        :param path: real path under the server root
+        '''
+
+        rel_path = os.path.relpath(path, self.base_dir)
+        if rel_path == '.':
+            return ()
+        if rel_path.startswith('..'):
+            raise PermissionError(f'Outside of server root: {path}')
+        return tuple(rel_path.split(os.sep))
+
+    def _lookup(self, path: str) -> _mem_node:
+        '''
+        Return the node of a path, the lock should be held.
+
+        :param path: real path under the server root
+        '''
+
+        node = self.root
+        for name in self._split(path):
+            node = node.children.get(name) if node.is_dir else None
+            if node is None:
+                raise FileNotFoundError(path)
+        return node
+
+    def _lookup_parent(self, path: str) -> Tuple[_mem_node, str]:
+        '''
+        Return the node of the parent directory and the name of a path,
+        the lock should be held.
+
+        :param path: real path under the server root
+        '''
+
+        names = self._split(path)
+        if not names:
+            raise PermissionError(f'Server root: {path}')
+        parent = self._lookup(os.path.dirname(path))
+        if not parent.is_dir:
+            raise NotADirectoryError(path)
+        return parent, names[-1]
+
+    def _commit(self, path: str, data: bytes) -> None:
+        '''
+        Replace the content of a file, creating it if not exists.
+
+        :param path: real path of the file
+        :param data: new content
+        '''
+
+        with self.lock:
+            parent, name = self._lookup_parent(path)
+            node = parent.children.get(name)
+            if node and node.is_dir:
+                raise IsADirectoryError(path)
+            node = self._new_node(is_dir=False)  # a new inode, so caches see the change
+            node.data = data
+            parent.children[name] = node
+            parent.mtime = node.mtime
+
+    def stat(self, path: str) -> os.stat_result:
+        with self.lock:
+            node = self._lookup(path)
+            return make_stat(node.is_dir, len(node.data), node.mtime, node.ino)
+
+    def list(self, path: str) -> Iterator[Tuple[str, os.stat_result]]:
+        with self.lock:
+            node = self._lookup(path)
+            if not node.is_dir:
+                raise NotADirectoryError(path)
+            entries = [
+                (name, make_stat(child.is_dir, len(child.data), child.mtime, child.ino))
+                for name, child in node.children.items()
+            ]
+        return iter(entries)
+
+    def open_read(self, path: str, offset: int = 0) -> BinaryIO:
+        with self.lock:
+            node = self._lookup(path)
+        if node.is_dir:
+            raise IsADirectoryError(path)
+        f = io.BytesIO(node.data)  # shares the immutable content until written
+        f.seek(offset)
+        return f
+
+    def open_write(self, path: str) -> BinaryIO:
+        with self.lock:
+            parent, name = self._lookup_parent(path)
+            node = parent.children.get(name)
+            if node and node.is_dir:
+                raise IsADirectoryError(path)
+        return _mem_writer(self, path)
+
+    def delete(self, path: str) -> None:
+        with self.lock:
+            parent, name = self._lookup_parent(path)
+            node = parent.children.get(name)
+            if node is None:
+                raise FileNotFoundError(path)
+            if node.is_dir:
+                raise IsADirectoryError(path)
+            del parent.children[name]
+            parent.mtime = time.time()
+
+    def mkdir(self, path: str) -> None:
+        with self.lock:
+            node = self.root
+            created = False
+            for name in self._split(path):
+                child = node.children.get(name)
+                if child is None:
+                    child = node.children[name] = self._new_node(is_dir=True)
+                    node.mtime = child.mtime
+                    created = True
+                elif not child.is_dir:
+                    raise NotADirectoryError(path)
+                node = child
+            if not created:
+                raise FileExistsError(path)
+
+    def rmdir(self, path: str) -> None:
+        with self.lock:
+            parent, name = self._lookup_parent(path)
+            node = parent.children.get(name)
+            if node is None:
+                raise FileNotFoundError(path)
+            if not node.is_dir:
+                raise NotADirectoryError(path)
+            if node.children:
+                raise OSError(f'Directory not empty: {path}')
+            del parent.children[name]
+            parent.mtime = time.time()
+
+    def rename(self, src_path: str, dst_path: str) -> None:
+        with self.lock:
+            src_parent, src_name = self._lookup_parent(src_path)
+            dst_parent, dst_name = self._lookup_parent(dst_path)
+            node = src_parent.children.get(src_name)
+            if node is None:
+                raise FileNotFoundError(src_path)
+            target = dst_parent.children.get(dst_name)
+            if target is not None and (target.is_dir or node.is_dir):
+                raise FileExistsError(dst_path)
+            del src_parent.children[src_name]
+            dst_parent.children[dst_name] = node
+            src_parent.mtime = dst_parent.mtime = time.time()
+
+    def remove_tree(self, path: str) -> None:
+        with self.lock:
+            parent, name = self._lookup_parent(path)
+            node = parent.children.get(name)
+            if node is None or not node.is_dir:
+                raise NotADirectoryError(path)
+            del parent.children[name]  # at once, as nodes are only reachable from here
+            parent.mtime = time.time()
+
+
+class object_storage(storage_backend):
+    '''
+    Store files as objects in a flat key space, like an object store does.
+
+    This is a stand-in for a remote object store, keeping each object as a
+    local file named by its quoted key in the object directory. A directory
+    is a marker object whose key ends with '/', and listing a directory is a
+    prefix scan of all keys. Reads are ranged GETs, writes are PUTs of whole
+    objects, and a directory is renamed key by key.
+    '''
+
+    def __init__(self, object_dir: str, base_dir: str) -> None:
+        '''
+        Initialize object storage.
+
+        :param object_dir: real path of the object directory, outside the server root
+        :param base_dir: real path of the server root
+        '''
+
+        # Properties
+        self.object_dir: str = object_dir
+        self.base_dir: str = base_dir
+        os.makedirs(object_dir, exist_ok=True)
+
+    def _key(self, path: str, is_dir: bool = False) -> str:
+        '''
+        Return the object key of a path, without a leading '/'.
+
+        :param path: real path under the server root
+        :param is_dir: True for the key of a directory marker
+        '''
+
+        rel_path = os.path.relpath(path, self.base_dir)
+        if rel_path.startswith('..'):
+            raise PermissionError(f'Outside of server root: {path}')
+        key = '' if rel_path == '.' else rel_path.replace(os.sep, '/')
+        return key + '/' if is_dir and key else key
+
+    def _object_path(self, key: str) -> str:
+        '''
+        Return the local file of an object.
+
+        :param key: object key
+        '''
+
+        return os.path.join(self.object_dir, 'obj-' + quote(key, safe=''))
+
+    def _keys(self, prefix: str) -> Iterator[str]:
+        '''
+        List all keys starting with a prefix, as a LIST request does.
+
+        :param prefix: key prefix
+        '''
+
+        for name in os.listdir(self.object_dir):
+            if name.startswith('obj-'):  # not a temporary file
+                key = unquote(name[4:])
+                if key.startswith(prefix):
+                    yield key
+
+    def stat(self, path: str) -> os.stat_result:
+        key = self._key(path)
+        if not key:  # the root always exists
+            return make_stat(True, 0, os.stat(self.object_dir).st_mtime)
+        try:
+            st = os.stat(self._object_path(key))
+            return make_stat(False, st.st_size, st.st_mtime, st.st_ino)
+        except FileNotFoundError:
+            st = os.stat(self._object_path(key + '/'))  # the marker, or not found
+            return make_stat(True, 0, st.st_mtime, st.st_ino)
+
+    def list(self, path: str) -> Iterator[Tuple[str, os.stat_result]]:
+        if not self.isdir(path):
+            raise NotADirectoryError(path)
+        prefix = self._key(path, is_dir=True)
+        for key in self._keys(prefix):
+            name = key[len(prefix):]
+            if name.count('/') == 1 and name.endswith('/'):  # a subdirectory marker
+                name = name[:-1]
+            elif not name or '/' in name:  # itself, or deeper
+                continue
+            try:
+                yield name, self.stat(os.path.join(path, name))
+            except OSError:  # deleted meanwhile
+                continue
+
+    def open_read(self, path: str, offset: int = 0) -> BinaryIO:
+        f = open(self._object_path(self._key(path)), 'rb')
+        if offset:  # Range: bytes=offset-
+            f.seek(offset)
+        return f
+
+    def open_write(self, path: str) -> BinaryIO:
+        if not self.isdir(os.path.dirname(path)):
+            raise FileNotFoundError(path)
+        if self.isdir(path):
+            raise IsADirectoryError(path)
+        return open_replacing(self._object_path(self._key(path)), self.object_dir)
+
+    def delete(self, path: str) -> None:
+        os.remove(self._object_path(self._key(path)))
+
+    def mkdir(self, path: str) -> None:
+        if self.exists(path):
+            raise FileExistsError(path)
+        parent = os.path.dirname(path)
+        if not self.isdir(parent):
+            self.mkdir(parent)
+        open(self._object_path(self._key(path, is_dir=True)), 'wb').close()
+
+    def rmdir(self, path: str) -> None:
+        prefix = self._key(path, is_dir=True)
+        if any(key != prefix for key in self._keys(prefix)):
+            raise OSError(f'Directory not empty: {path}')
+        os.remove(self._object_path(prefix))
+
+    def rename(self, src_path: str, dst_path: str) -> None:
+        if not self.isdir(src_path):
+            if self.isdir(dst_path):
+                raise IsADirectoryError(dst_path)
+            os.replace(self._object_path(self._key(src_path)), self._object_path(self._key(dst_path)))
+            return
+        if self.exists(dst_path):
+            raise FileExistsError(dst_path)
+        src_prefix = self._key(src_path, is_dir=True)
+        dst_prefix = self._key(dst_path, is_dir=True)
+        for key in sorted(self._keys(src_prefix), reverse=True):  # the marker last
+            os.replace(self._object_path(key), self._object_path(dst_prefix + key[len(src_prefix):]))
+
+    def remove_tree(self, path: str) -> None:
+        prefix = self._key(path, is_dir=True)
+        for key in sorted(self._keys(prefix), reverse=True):  # the marker last
+            os.remove(self._object_path(key))
@@ -0,0 +1,195 @@
+import multiprocessing as mp
+import socket
+import time
+from multiprocessing.connection import Connection
+from threading import Event, Lock, Thread
+from typing import Any, Callable, List, Tuple
+from naive_ftp.utils import log
+
+# Forking while the console thread holds the stdin lock would deadlock workers
+mp_context = mp.get_context('spawn')
+
+
+def partition_ports(port_range: Tuple[int, int], workers: int, index: int) -> range:
+    '''
+    Return the slice of a port range assigned to a worker.
+
+    :param port_range: (first_port, last_port), both inclusive
+    :param workers: total number of workers
+    :param index: index of the worker
+    '''
+
+    first, last = port_range
+    size = (last - first + 1) // workers
+    if size <= 0:
+        raise ValueError(f'Port range {first}-{last} too small for {workers} workers')
+    start = first + index * size
+    return range(start, start + size)
+
+
+class worker_supervisor(Thread):
+    '''
+    Naive-FTP worker supervisor
+
+    Start worker processes and restart them if crashed.
+
+    A worker sends 'ready' through its pipe once it accepts connections,
+    and other messages, e.g. change events, to on_message afterwards.
+    It is stopped gracefully by the command ['drain', timeout].
+
+    Listening sockets of workers are opened by the supervisor and kept open
+    until it stops, so that connections waiting in the backlog of a worker
+    are accepted by the next one, after a crash or a restart, instead of reset.
+    '''
+
+    def __init__(
+        self, workers: int, target: Callable, args: Callable[[int], tuple],
+        on_message: Callable[[Any], None] = None, socks: List[socket.socket] = None,
+    ) -> None:
+        '''
+        Initialize worker supervisor.
+
+        :param workers: number of worker processes
+        :param target: worker entry, called with a command pipe, the worker index
+                       and args(index)
+        :param args: a function returning the extra arguments for a worker index
+        :param on_message: called with each message from workers, in a thread of each worker
+        :param socks: listening sockets passed to workers by args, closed when stopped
+        '''
+
+        super().__init__(daemon=True)
+
+        # Properties
+        self.check_interval: float = 1.0
+        self.restart_delay: float = 1.0
+        self.workers: int = workers
+        self.target: Callable = target
+        self.args: Callable[[int], tuple] = args
+        self.on_message: Callable[[Any], None] = on_message
+        self.socks: List[socket.socket] = socks or []
+
+        # Worker processes, their command pipes, locks for sending, and whether ready
+        self.procs: List[mp.Process] = [None] * workers
+        self.pipes: List[Connection] = [None] * workers
+        self.send_locks: List[Lock] = [Lock() for _ in range(workers)]
+        self.ready: List[Event] = [Event() for _ in range(workers)]
+        self.stopped: Event = Event()
+
+    def spawn(self, index: int) -> None:
+        '''
+        Start a worker process.
+
+        :param index: index of the worker
+        '''
+
+        parent_conn, child_conn = mp_context.Pipe()
+        proc = mp_context.Process(
+            target=self.target,
+            args=(child_conn, index, *self.args(index)),
+            name=f'naive-ftp-worker-{index}',
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+        self.ready[index].clear()
+        self.procs[index] = proc
+        self.pipes[index] = parent_conn
+        Thread(target=self._receive, args=(index, parent_conn), daemon=True).start()
+        log('info', f'Worker {index} started, pid: {proc.pid}')
+
+    def _receive(self, index: int, pipe: Connection) -> None:
+        '''
+        Receive messages from a worker, until it exits.
+
+        :param index: index of the worker
+        :param pipe: command pipe of the worker
+        '''
+
+        try:
+            while True:
+                msg = pipe.recv()
+                if msg == 'ready':
+                    self.ready[index].set()
+                elif self.on_message:
+                    self.on_message(msg)
+        except (EOFError, OSError):
+            pass
+
+    def broadcast(self, cmd: List[str]) -> None:
+        '''
+        Send a console command to all workers.
+
+        :param cmd: console command
+        '''
+
+        for index, pipe in enumerate(self.pipes):
+            try:
+                with self.send_locks[index]:
+                    pipe.send(cmd)
+            except (OSError, AttributeError):
+                log('warn', f'Failed to send command to worker {index}')
+
+    def wait_ready(self, timeout: float) -> bool:
+        '''
+        Wait until all workers accept connections.
+
+        Return True if ready within timeout.
+
+        :param timeout: seconds to wait
+        '''
+
+        deadline = time.monotonic() + timeout
+        for index in range(self.workers):
+            while not self.ready[index].wait(0.05):
+                proc = self.procs[index]
+                if (proc and proc.exitcode is not None) or time.monotonic() >= deadline:  # exited
+                    return False
+        return True
+
+    def drain(self, timeout: float) -> None:
+        '''
+        Stop all workers gracefully, once their sessions finish current commands.
+
+        :param timeout: seconds to wait before active sessions are aborted
+        '''
+
+        self.stopped.set()
+        self.broadcast(['drain', str(timeout)])
+        deadline = time.monotonic() + timeout + self.check_interval  # to abort and exit
+        for proc in self.procs:
+            if proc:
+                proc.join(max(deadline - time.monotonic(), 0))
+        self.close()
+
+    def close(self) -> None:
+        '''
+        Stop all workers.
+        '''
+
+        self.stopped.set()
+        for proc in self.procs:
+            if proc and proc.is_alive():
+                proc.terminate()
+        for index, proc in enumerate(self.procs):
+            if proc:
+                proc.join()
+                self.pipes[index].close()
+        for sock in self.socks:
+            sock.close()
+
+    def run(self) -> None:
+        '''
+        Main function for worker supervisor.
+        '''
+
+        for index in range(self.workers):
+            self.spawn(index)
+        while not self.stopped.wait(self.check_interval):
+            for index, proc in enumerate(self.procs):
+                if proc.is_alive() or self.stopped.is_set():
+                    continue
+                log('warn', f'Worker {index} exited, code: {proc.exitcode}, restarting')
+                self.pipes[index].close()
+                if self.stopped.wait(self.restart_delay):
+                    break
+                self.spawn(index)
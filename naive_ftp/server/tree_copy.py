@@ -0,0 +1,126 @@
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# ioctl request to clone a file (reflink), on Btrfs / XFS / OCFS2
+FICLONE: int = 0x40049409
+
+# Maximum number of files copied concurrently in a tree
+copy_workers: int = 8
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    '''
+    Share the extents of the source file with the destination, if supported.
+
+    Return True if succeeded.
+
+    :param src_fd: file descriptor of the source file
+    :param dst_fd: file descriptor of the destination file
+    '''
+
+    if not fcntl:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _copy_range(src_fd: int, dst_fd: int, size: int) -> bool:
+    '''
+    Copy file content in kernel with copy_file_range, if supported.
+
+    Return True if succeeded.
+
+    :param src_fd: file descriptor of the source file
+    :param dst_fd: file descriptor of the destination file
+    :param size: size of the source file
+    '''
+
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    copied = 0
+    try:
+        while copied < size:
+            n = os.copy_file_range(src_fd, dst_fd, size - copied)
+            if not n:  # source shrunk
+                break
+            copied += n
+    except OSError:
+        if copied:
+            raise
+        return False  # e.g. across file systems on old kernels
+    return True
+
+
+def copy_file(src_path: str, dst_path: str) -> None:
+    '''
+    Copy a file without passing its content through user space where possible,
+    trying reflink, copy_file_range and sendfile (by shutil) in turn.
+
+    :param src_path: real path of the source file
+    :param dst_path: real path of the destination file
+    '''
+
+    if os.path.islink(src_path):  # keep links as links, never follow them out
+        os.symlink(os.readlink(src_path), dst_path)
+        return
+    dir_name, file_name = os.path.split(dst_path)
+    tmp_path = os.path.join(dir_name, f'.{file_name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(src_path, 'rb') as src_file, open(tmp_path, 'wb') as dst_file:
+            src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+            size = os.fstat(src_fd).st_size
+            if not _reflink(src_fd, dst_fd) and not _copy_range(src_fd, dst_fd, size):
+                shutil.copyfileobj(src_file, dst_file)
+        shutil.copystat(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)  # never truncate a file being read
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def copy_tree(src_path: str, dst_path: str) -> int:
+    '''
+    Copy a file or a directory tree. Directories are created in order,
+    and files are copied by a pool of threads.
+
+    Return the number of copied files.
+
+    :param src_path: real path of the source
+    :param dst_path: real path of the destination, which should not exist
+                     if the source is a directory
+    '''
+
+    if not os.path.isdir(src_path) or os.path.islink(src_path):
+        copy_file(src_path, dst_path)
+        return 1
+
+    dirs: List[Tuple[str, str]] = []
+    files: List[Tuple[str, str]] = []
+    for dir_path, dir_names, file_names in os.walk(src_path):
+        dst_dir = os.path.normpath(os.path.join(dst_path, os.path.relpath(dir_path, src_path)))
+        os.makedirs(dst_dir, exist_ok=dir_path != src_path)
+        dirs.append((dir_path, dst_dir))
+        for name in dir_names:
+            if os.path.islink(os.path.join(dir_path, name)):  # not walked into
+                files.append((os.path.join(dir_path, name), os.path.join(dst_dir, name)))
+        for name in file_names:
+            files.append((os.path.join(dir_path, name), os.path.join(dst_dir, name)))
+
+    with ThreadPoolExecutor(copy_workers) as executor:
+        for future in [executor.submit(copy_file, src, dst) for src, dst in files]:
+            future.result()  # raise the first error
+    for dir_path, dst_dir in dirs:  # after files, which change mtime of directories
+        shutil.copystat(dir_path, dst_dir)
+    return len(files)
@@ -1,5 +1,6 @@
 import inspect
 import os
+import socket
 from datetime import date, datetime
 
 
@@ -50,7 +51,7 @@ def logf(level: str, msg: str) -> None:
         log('error', f'Failed to write to a log file, error: {e}')
 
 
-def is_safe_path(path: str, base_dir: str, allow_base: bool = False) -> bool:
+def is_safe_path(path: str, base_dir: str, allow_base: bool = False, resolved: bool = False) -> bool:
     '''
     Check if the requested path is safe to access.
 
@@ -59,8 +60,28 @@ def is_safe_path(path: str, base_dir: str, allow_base: bool = False) -> bool:
     :param path: requested path
     :param base_dir: base directory, requested path should be restricted inside
     :param allow_base: if allowed to access base directory
+    :param resolved: True if path is already a real path, skipping realpath
     '''
 
-    if not allow_base:
-        base_dir += os.sep
-    return os.path.realpath(path).startswith(base_dir)
+    if not resolved:
+        path = os.path.realpath(path)
+    if allow_base and path == base_dir:
+        return True
+    return path.startswith(base_dir.rstrip(os.sep) + os.sep)
+
+
+def set_keepalive(sock: socket.socket, idle: int = 60, interval: int = 10, count: int = 5) -> None:
+    '''
+    Enable TCP keepalive on a connection, so that a dead peer is detected,
+    and middleboxes do not drop the connection while it is idle.
+
+    :param sock: the connection
+    :param idle: seconds of idleness before the first probe
+    :param interval: seconds between probes
+    :param count: number of unanswered probes before the connection is dropped
+    '''
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, name):  # not on every platform
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
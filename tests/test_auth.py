@@ -0,0 +1,104 @@
+import pytest
+
+from naive_ftp.server import auth
+
+
+@pytest.fixture(autouse=True)
+def fast_kdf(monkeypatch):
+    monkeypatch.setattr(auth, 'kdf_iterations', 1000)
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'users.json')
+
+
+@pytest.fixture
+def db(db_path):
+    d = auth.user_db(db_path)
+    d.add('alice', 'secret', root='home/alice', quota=1024)
+    return d
+
+
+@pytest.fixture
+def kdf_calls(monkeypatch):
+    calls = []
+    check_password = auth.check_password
+
+    def counting_check(password, password_hash):
+        calls.append(password)
+        return check_password(password, password_hash)
+
+    monkeypatch.setattr(auth, 'check_password', counting_check)
+    return calls
+
+
+def test_hash_round_trip():
+    h = auth.hash_password('secret')
+    assert h.startswith('pbkdf2_sha256$1000$')
+    assert auth.check_password('secret', h)
+    assert not auth.check_password('Secret', h)
+    assert h != auth.hash_password('secret')  # salted
+    assert not auth.check_password('secret', 'md5$1$x$y')
+    assert not auth.check_password('secret', 'garbage')
+
+
+def test_verify(db):
+    u = db.verify('alice', 'secret')
+    assert (u.name, u.root, u.quota) == ('alice', 'home/alice', 1024)
+    assert db.verify('alice', 'wrong') is None
+    assert db.verify('bob', 'secret') is None
+
+
+def test_login_cached(db, kdf_calls):
+    assert db.verify('alice', 'secret')
+    assert db.verify('alice', 'secret')
+    assert db.verify('alice', 'secret')
+    assert kdf_calls == ['secret']  # derived once
+    assert db.stats()['cache_hits'] == 2
+    assert db.stats()['cached_logins'] == 1
+
+
+def test_wrong_password_not_cached(db, kdf_calls):
+    assert db.verify('alice', 'secret')
+    assert db.verify('alice', 'wrong') is None
+    assert db.verify('alice', 'wrong') is None
+    assert kdf_calls == ['secret', 'wrong', 'wrong']  # never accepted from the cache
+    assert db.stats()['cached_logins'] == 1
+
+
+def test_missing_user_costs_a_derivation(db, kdf_calls):
+    assert db.verify('bob', 'secret') is None
+    assert kdf_calls == ['secret']
+
+
+def test_cache_forgotten_after_password_changed(db):
+    assert db.verify('alice', 'secret')
+    db.add('alice', 'changed')
+    assert db.verify('alice', 'secret') is None
+    assert db.verify('alice', 'changed')
+
+
+def test_cache_expired(db_path, kdf_calls):
+    d = auth.user_db(db_path, cache_ttl=0.0)
+    d.add('alice', 'secret')
+    assert d.verify('alice', 'secret')
+    assert d.verify('alice', 'secret')
+    assert len(kdf_calls) == 2
+
+
+def test_cache_size(db_path):
+    d = auth.user_db(db_path, cache_size=2)
+    for name in ('a', 'b', 'c'):
+        d.add(name, name)
+        assert d.verify(name, name)
+    assert [key[0] for key in d.cache] == ['b', 'c']
+
+
+def test_changed_by_another_process(db, db_path):
+    other = auth.user_db(db_path)  # e.g. the console of the main process
+    assert other.verify('alice', 'secret')
+    other.add('bob', 'pass')
+    assert db.verify('bob', 'pass')
+    assert other.remove('alice')
+    assert db.verify('alice', 'secret') is None
@@ -0,0 +1,138 @@
+import os
+import random
+
+import pytest
+
+from naive_ftp.server import dedup
+from naive_ftp.server.storage import discard
+
+
+@pytest.fixture
+def root(tmp_path):
+    base = os.path.realpath(tmp_path)
+    os.makedirs(os.path.join(base, 'srv'))
+    return base
+
+
+@pytest.fixture
+def storage(root):
+    return dedup.dedup_storage(os.path.join(root, 'chunks'), os.path.join(root, 'srv'))
+
+
+def content(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def write(storage, path, data, step=10000):
+    with storage.open_write(path) as f:
+        for i in range(0, len(data), step):
+            f.write(data[i:i+step])
+
+
+def read(storage, path, offset=0):
+    chunks = []
+    with storage.open_read(path, offset) as f:
+        while True:
+            data = f.read(4096)
+            if not data:
+                return b''.join(chunks)
+            chunks.append(data)
+
+
+def chunk_files(storage):
+    return sorted(
+        name for _, _, names in os.walk(storage.chunk_dir) for name in names if not name.startswith('.')
+    )
+
+
+def age_chunks(storage):
+    for dir_path, _, names in os.walk(storage.chunk_dir):
+        for name in names:
+            os.utime(os.path.join(dir_path, name), (1, 1))
+
+
+def test_small_file_stored_as_it_is(root, storage):
+    path = os.path.join(root, 'srv', 'small')
+    write(storage, path, b'hello')
+    with open(path, 'rb') as f:
+        assert f.read() == b'hello'
+    assert not chunk_files(storage)
+    assert read(storage, path, 1) == b'ello'
+
+
+def test_round_trip(root, storage):
+    path = os.path.join(root, 'srv', 'big')
+    data = content(500000)
+    write(storage, path, data)
+    assert storage.stat(path).st_size == len(data)  # sparse tail
+    with open(path, 'rb') as f:
+        assert storage.read_manifest(f)
+    assert chunk_files(storage)
+    assert read(storage, path) == data
+    for offset in (1, 2047, 65536, 499999, 500000):
+        assert read(storage, path, offset) == data[offset:]
+    assert not [name for name in os.listdir(os.path.join(root, 'srv')) if name.endswith('.tmp')]
+
+
+def test_duplicates_stored_once(root, storage):
+    data = content(300000)
+    write(storage, os.path.join(root, 'srv', 'a'), data)
+    chunks = chunk_files(storage)
+    write(storage, os.path.join(root, 'srv', 'b'), data)
+    assert chunk_files(storage) == chunks
+    edited = data[:150000] + b'inserted' + data[150000:]
+    write(storage, os.path.join(root, 'srv', 'c'), edited)
+    assert len(chunk_files(storage)) <= len(chunks) + 2  # around the insertion only
+    assert read(storage, os.path.join(root, 'srv', 'c')) == edited
+    stats = storage.stats()
+    assert stats['logical_bytes'] == 2 * len(data) + len(edited)
+    assert stats['dedup_ratio'] > 2
+
+
+def test_forged_manifest_read_as_plain_file(root, storage):
+    write(storage, os.path.join(root, 'srv', 'big'), content(100000))
+    with open(os.path.join(root, 'srv', 'big'), 'rb') as f:
+        manifest = f.read(1000)
+    path = os.path.join(root, 'srv', 'forged')
+    other = dedup.dedup_storage(os.path.join(root, 'other_chunks'), os.path.join(root, 'srv'))
+    write(other, path, manifest)  # uploaded as it is, but signed by another key
+    assert read(storage, path) == manifest
+
+
+def test_discarded_upload(root, storage):
+    path = os.path.join(root, 'srv', 'big')
+    data = content(200000)
+    write(storage, path, data)
+    with storage.open_write(path) as f:
+        f.write(content(200000, seed=1))
+        discard(f)
+    assert read(storage, path) == data
+    assert os.listdir(os.path.join(root, 'srv')) == ['big']
+
+
+def test_gc(root, storage):
+    keep, drop = content(200000, seed=1), content(200000, seed=2)
+    write(storage, os.path.join(root, 'srv', 'keep'), keep)
+    kept = chunk_files(storage)
+    write(storage, os.path.join(root, 'srv', 'drop'), drop)
+    storage.delete(os.path.join(root, 'srv', 'drop'))
+    unreferenced = len(chunk_files(storage)) - len(kept)
+    assert unreferenced
+    age_chunks(storage)
+    assert storage.gc() == unreferenced
+    assert chunk_files(storage) == kept
+    assert read(storage, os.path.join(root, 'srv', 'keep')) == keep
+    assert os.path.exists(storage.key_path)
+    assert storage.gc() == 0
+
+
+def test_gc_keeps_upload_in_progress(root, storage):
+    path = os.path.join(root, 'srv', 'big')
+    data = content(300000)
+    f = storage.open_write(path)
+    f.write(data[:200000])
+    age_chunks(storage)
+    assert storage.gc() == 0
+    f.write(data[200000:])
+    f.close()
+    assert read(storage, path) == data
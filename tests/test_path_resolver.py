@@ -0,0 +1,167 @@
+import os
+
+import pytest
+
+from naive_ftp.server import path_resolver as pr
+from naive_ftp.utils import is_safe_path
+
+
+@pytest.fixture
+def root(tmp_path):
+    '''
+    Server root with a sibling sharing its prefix, and a directory tree:
+
+    srv/a/b/f, srv/link -> a/b, srv/out -> ../srv2, srv2/secret
+    '''
+
+    base = os.path.realpath(tmp_path)
+    srv = os.path.join(base, 'srv')
+    os.makedirs(os.path.join(srv, 'a', 'b'))
+    open(os.path.join(srv, 'a', 'b', 'f'), 'w').close()
+    os.makedirs(os.path.join(base, 'srv2'))
+    open(os.path.join(base, 'srv2', 'secret'), 'w').close()
+    os.symlink(os.path.join('a', 'b'), os.path.join(srv, 'link'))
+    os.symlink(os.path.join('..', 'srv2'), os.path.join(srv, 'out'))
+    return srv
+
+
+@pytest.fixture
+def resolver(root):
+    r = pr.path_resolver(root)
+    yield r
+    r.close()
+
+
+@pytest.mark.parametrize('path', [
+    '/', '.', 'a', '/a/b/f', 'a/./b//f', 'a/b/../b/f', 'missing', 'a/missing/../b',
+    'link', 'link/f', 'link/../b', 'out', 'out/secret', '../srv2', '/../../..',
+])
+def test_same_as_realpath(root, resolver, path):
+    base = root if path.startswith('/') else resolver.cwd_real
+    assert resolver.resolve(path) == os.path.realpath(os.path.join(base, path.lstrip('/')))
+
+
+def test_same_as_realpath_in_subdirectory(root, resolver):
+    resolver.chdir(os.path.join(root, 'a'))
+    for path in ('b/f', '../link/f', '../out', '/a', '..'):
+        base = root if path.startswith('/') else os.path.join(root, 'a')
+        assert resolver.resolve(path) == os.path.realpath(os.path.join(base, path.lstrip('/')))
+
+
+@pytest.mark.parametrize('path', ['..', '../srv2/secret', '/../srv2', 'a/../../srv2', 'out', 'out/secret'])
+def test_escapes_rejected(root, resolver, path):
+    assert not is_safe_path(resolver.resolve(path), root, allow_base=True, resolved=True)
+
+
+def test_sibling_prefix_rejected(root, resolver):
+    sibling = resolver.resolve('../srv2')
+    assert sibling.startswith(root)  # /srv2 shares the prefix of /srv
+    assert not is_safe_path(sibling, root, resolved=True)
+    assert is_safe_path(resolver.resolve('a/b/f'), root, resolved=True)
+
+
+def test_link_not_followed_as_last_component(root, resolver):
+    assert resolver.resolve('link', follow_symlinks=False) == os.path.join(root, 'link')
+    assert resolver.resolve('/link/f', follow_symlinks=False) == os.path.join(root, 'a', 'b', 'f')
+    assert resolver.resolve('out/', follow_symlinks=False) == os.path.join(root, 'out')
+    assert resolver.resolve('.', follow_symlinks=False) == root
+
+
+def test_lstat_count(root, resolver, monkeypatch):
+    calls = []
+    lstat = os.lstat
+
+    def counting_lstat(*args, **kwargs):
+        calls.append(args[0])
+        return lstat(*args, **kwargs)
+
+    monkeypatch.setattr(pr.os, 'lstat', counting_lstat)
+    assert resolver.resolve('a/b/f') == os.path.join(root, 'a', 'b', 'f')
+    assert len(calls) == 3  # one per component
+    if resolver.use_dir_fd:
+        assert calls == ['a', os.path.join('a', 'b'), os.path.join('a', 'b', 'f')]
+
+    calls.clear()
+    assert resolver.resolve('a/b/f') == os.path.join(root, 'a', 'b', 'f')
+    assert not calls  # cached
+
+    resolver.chdir(os.path.join(root, 'a', 'b'))
+    calls.clear()
+    resolver.resolve('f')
+    assert len(calls) == 1  # working directory not resolved again
+
+
+def test_invalidated_after_rename(root, resolver):
+    assert resolver.resolve('link/f') == os.path.join(root, 'a', 'b', 'f')
+    os.remove(os.path.join(root, 'link'))
+    os.rename(os.path.join(root, 'a'), os.path.join(root, 'link'))  # as by RNFR a, RNTO link
+    assert resolver.resolve('link/f') == os.path.join(root, 'a', 'b', 'f')  # stale until told
+    resolver.invalidate()
+    assert resolver.resolve('link/f') == os.path.join(root, 'link', 'f')
+
+
+def test_invalidated_by_another_session(root, resolver):
+    other = pr.path_resolver(root)
+    try:
+        assert resolver.resolve('link/f') == os.path.join(root, 'a', 'b', 'f')
+        os.remove(os.path.join(root, 'link'))
+        os.symlink('out', os.path.join(root, 'link'))
+        other.invalidate()
+        assert resolver.resolve('link/f') == os.path.realpath(os.path.join(root, 'link', 'f'))
+        assert not is_safe_path(resolver.resolve('link/secret'), root, resolved=True)
+    finally:
+        other.close()
+
+
+def test_cache_size(root):
+    r = pr.path_resolver(root, cache_size=2)
+    try:
+        for path in ('a', 'a/b', 'a/b/f'):
+            r.resolve(path)
+        assert list(r.cache) == [(root, 'a/b'), (root, 'a/b/f')]
+    finally:
+        r.close()
+
+
+@pytest.fixture
+def validating(root):
+    r = pr.path_resolver(root, validate=True)
+    yield r
+    r.close()
+
+
+def test_validated_after_directory_swapped(root, validating):
+    # Changed by another process, which does not invalidate this one
+    os.makedirs(os.path.join(root, 'x'))
+    assert validating.resolve('x/new') == os.path.join(root, 'x', 'new')
+    os.rmdir(os.path.join(root, 'x'))
+    os.symlink('out', os.path.join(root, 'x'))
+    assert not is_safe_path(validating.resolve('x/new'), root, resolved=True)
+    assert validating.resolve('x/new') == os.path.realpath(os.path.join(root, 'x', 'new'))
+
+
+def test_validated_after_file_swapped(root, validating):
+    assert validating.resolve('a/b/f') == os.path.join(root, 'a', 'b', 'f')
+    os.remove(os.path.join(root, 'a', 'b', 'f'))
+    os.symlink(os.path.join(os.path.dirname(root), 'srv2', 'secret'), os.path.join(root, 'a', 'b', 'f'))
+    assert not is_safe_path(validating.resolve('a/b/f'), root, resolved=True)
+
+
+def test_validated_after_missing_parent_created(root, validating):
+    assert validating.resolve('y/new') == os.path.join(root, 'y', 'new')
+    os.symlink('out', os.path.join(root, 'y'))
+    assert not is_safe_path(validating.resolve('y/new'), root, resolved=True)
+
+
+def test_validated_hit_lstat_count(root, validating, monkeypatch):
+    calls = []
+    lstat = os.lstat
+
+    def counting_lstat(*args, **kwargs):
+        calls.append(args[0])
+        return lstat(*args, **kwargs)
+
+    validating.resolve('a/b/f')
+    monkeypatch.setattr(pr.os, 'lstat', counting_lstat)
+    assert validating.resolve('a/b/f') == os.path.join(root, 'a', 'b', 'f')
+    assert len(calls) == 2  # the parent and the file
@@ -0,0 +1,118 @@
+import os
+
+import pytest
+
+from naive_ftp.server import quota
+from naive_ftp.server.storage import local_storage
+
+
+@pytest.fixture
+def root(tmp_path):
+    '''
+    Server root with files: srv/home/alice/a (100 B), srv/home/al/b (10 B), srv/c (1 B)
+    '''
+
+    srv = os.path.join(os.path.realpath(tmp_path), 'srv')
+    for path, size in (('home/alice/a', 100), ('home/al/b', 10), ('c', 1)):
+        os.makedirs(os.path.dirname(os.path.join(srv, path)), exist_ok=True)
+        with open(os.path.join(srv, path), 'wb') as f:
+            f.write(bytes(size))
+    return srv
+
+
+@pytest.fixture
+def storage():
+    return local_storage()
+
+
+@pytest.fixture
+def quotas(tmp_path, root):
+    return quota.quota_index(str(tmp_path / 'quotas.db'), root)
+
+
+def used(quotas, path):
+    return {p: u for p, _, u in quotas.list()}[path]
+
+
+def test_set_counts_usage(root, storage, quotas):
+    quotas.set('home/alice', 1000, storage)
+    quotas.set('/', 5000, storage)
+    assert quotas.list() == [('/', 5000, 111), ('/home/alice', 1000, 100)]
+    quotas.set('/home/alice/', 2000, storage)  # changed, not counted again
+    assert quotas.list()[1] == ('/home/alice', 2000, 100)
+
+
+def test_temporary_files_not_counted(root, storage, quotas):
+    with open(os.path.join(root, 'home', 'alice', '.a.123.tmp'), 'wb') as f:
+        f.write(bytes(50))  # an upload in progress
+    assert quota.tree_size(storage, os.path.join(root, 'home', 'alice')) == 100
+
+
+def test_charge_parents_only(storage, quotas):
+    for path in ('/', 'home', 'home/alice', 'home/al'):
+        quotas.set(path, 1000, storage)
+    quotas.charge('/home/alice/new', 40)
+    assert quotas.list() == [('/', 1000, 151), ('/home', 1000, 150), ('/home/al', 1000, 10), ('/home/alice', 1000, 140)]
+    quotas.charge('/home/alice/a', -1000)
+    assert used(quotas, '/home/alice') == 0  # never negative
+    assert used(quotas, '/home/al') == 10
+
+
+def test_remaining(storage, quotas):
+    assert quotas.remaining('/home/alice/a') is None
+    quotas.set('/', 1000, storage)
+    quotas.set('home/alice', 150, storage)
+    assert quotas.remaining('/home/alice/new') == 50
+    assert quotas.remaining('/home/al/new') == 889
+    quotas.charge('/home/alice/new', 60)
+    assert quotas.remaining('/home/alice/new') == -10
+
+
+def test_reconcile_corrects_drift(root, storage, quotas):
+    quotas.set('home/alice', 1000, storage)
+    quotas.charge('/home/alice/a', 500)  # e.g. a change not seen by the server
+    os.remove(os.path.join(root, 'home', 'alice', 'a'))
+    quotas.reconcile('/home/alice', storage)
+    assert used(quotas, '/home/alice') == 0
+
+
+def test_reconcile_keeps_changes_meanwhile(root, storage, quotas, monkeypatch):
+    quotas.set('home/alice', 1000, storage)
+    tree_size = quota.tree_size
+
+    def charged_during_walk(storage, real_path):
+        size = tree_size(storage, real_path)
+        quotas.charge('/home/alice/new', 30)  # an upload finished by another session
+        return size
+
+    monkeypatch.setattr(quota, 'tree_size', charged_during_walk)
+    quotas.reconcile('/home/alice', storage)
+    assert used(quotas, '/home/alice') == 130
+
+
+def test_reconcile_missing_directory(storage, quotas):
+    quotas.set('home/bob', 1000, storage)
+    assert used(quotas, '/home/bob') == 0
+    quotas.reconcile('/missing', storage)  # no such quota
+    assert len(quotas.list()) == 1
+
+
+def test_mark(storage, quotas):
+    for path in ('/', 'home', 'home/alice', 'home/al'):
+        quotas.set(path, 1000, storage)
+    quotas.mark('/home/alice')
+    checked = dict(quotas._connect().execute('SELECT path, checked FROM quotas'))
+    assert checked['/'] == checked['/home'] == checked['/home/alice'] == 0
+    assert checked['/home/al'] > 0
+    quotas.mark('/home/')  # a renamed tree, under which quotas are stale too
+    checked = dict(quotas._connect().execute('SELECT path, checked FROM quotas'))
+    assert checked['/home/al'] == 0
+
+
+def test_remove_and_stats(storage, quotas):
+    quotas.set('home/alice', 50, storage)
+    quotas.set('home/al', 50, storage)
+    assert quotas.stats() == {'quotas': 2, 'over_quota': 1}
+    assert quotas.remove('/home/alice/')
+    assert not quotas.remove('home/alice')
+    assert quotas.stats() == {'quotas': 1, 'over_quota': 0}
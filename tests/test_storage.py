@@ -0,0 +1,151 @@
+import os
+import stat
+
+import pytest
+
+from naive_ftp.server import storage as st
+
+
+@pytest.fixture(params=['local', 'memory', 'object'])
+def backend(request, tmp_path):
+    '''
+    Return a storage and its server root.
+    '''
+
+    base = os.path.realpath(tmp_path)
+    root = os.path.join(base, 'srv')
+    if request.param == 'local':
+        os.makedirs(root)
+        return st.local_storage(), root
+    if request.param == 'memory':
+        return st.memory_storage(root), root
+    return st.object_storage(os.path.join(base, 'objects'), root), root
+
+
+def write(storage, path, data):
+    with storage.open_write(path) as f:
+        f.write(data)
+
+
+def read(storage, path, offset=0):
+    with storage.open_read(path, offset) as f:
+        return f.read()
+
+
+def names(storage, path):
+    return sorted((name, stat.S_ISDIR(s.st_mode)) for name, s in storage.list(path))
+
+
+def test_files(backend):
+    storage, root = backend
+    path = os.path.join(root, 'f')
+    assert not storage.exists(path)
+    write(storage, path, b'hello')
+    assert storage.exists(path) and storage.isfile(path) and not storage.isdir(path)
+    assert storage.stat(path).st_size == 5
+    assert read(storage, path) == b'hello'
+    assert read(storage, path, 2) == b'llo'
+    write(storage, path, b'bye')
+    assert read(storage, path) == b'bye'
+    storage.delete(path)
+    assert not storage.exists(path)
+    with pytest.raises(FileNotFoundError):
+        storage.stat(path)
+    with pytest.raises(OSError):
+        storage.delete(path)
+
+
+def test_directories(backend):
+    storage, root = backend
+    assert storage.isdir(root)
+    storage.mkdir(os.path.join(root, 'a', 'b'))  # with missing parents
+    write(storage, os.path.join(root, 'a', 'f'), b'x')
+    assert names(storage, root) == [('a', True)]
+    assert names(storage, os.path.join(root, 'a')) == [('b', True), ('f', False)]
+    with pytest.raises(FileExistsError):
+        storage.mkdir(os.path.join(root, 'a'))
+    with pytest.raises(OSError):
+        storage.rmdir(os.path.join(root, 'a'))  # not empty
+    with pytest.raises(NotADirectoryError):
+        list(storage.list(os.path.join(root, 'a', 'f')))
+    storage.rmdir(os.path.join(root, 'a', 'b'))
+    assert names(storage, os.path.join(root, 'a')) == [('f', False)]
+
+
+def test_write_replaces_on_close(backend):
+    storage, root = backend
+    path = os.path.join(root, 'f')
+    write(storage, path, b'old')
+    ino = storage.stat(path).st_ino
+    with storage.open_read(path) as reader:
+        f = storage.open_write(path)
+        f.write(b'new content')
+        assert read(storage, path) == b'old'  # not seen until closed
+        f.close()
+        assert reader.read() == b'old'  # opened before
+    assert read(storage, path) == b'new content'
+    assert storage.stat(path).st_ino != ino  # as hot_files and caches expect
+
+
+def test_discarded_write(backend):
+    storage, root = backend
+    path = os.path.join(root, 'f')
+    write(storage, path, b'old')
+    with storage.open_write(path) as f:
+        f.write(b'partial')
+        st.discard(f)
+    assert read(storage, path) == b'old'
+    assert names(storage, root) == [('f', False)]  # no temporary file left
+
+
+def test_write_errors(backend):
+    storage, root = backend
+    storage.mkdir(os.path.join(root, 'd'))
+    with pytest.raises(OSError):
+        write(storage, os.path.join(root, 'missing', 'f'), b'x')
+    with pytest.raises(OSError):
+        write(storage, os.path.join(root, 'd'), b'x')
+    with pytest.raises(OSError):
+        read(storage, os.path.join(root, 'd'))
+
+
+def test_rename(backend):
+    storage, root = backend
+    storage.mkdir(os.path.join(root, 'a', 'b'))
+    write(storage, os.path.join(root, 'a', 'b', 'f'), b'x')
+    write(storage, os.path.join(root, 'g'), b'y')
+    write(storage, os.path.join(root, 'h'), b'z')
+    storage.rename(os.path.join(root, 'g'), os.path.join(root, 'h'))  # replacing a file
+    assert read(storage, os.path.join(root, 'h')) == b'y'
+    assert not storage.exists(os.path.join(root, 'g'))
+    storage.rename(os.path.join(root, 'a'), os.path.join(root, 'c'))
+    assert read(storage, os.path.join(root, 'c', 'b', 'f')) == b'x'
+    assert names(storage, root) == [('c', True), ('h', False)]
+    with pytest.raises(OSError):
+        storage.rename(os.path.join(root, 'c'), os.path.join(root, 'h'))
+    with pytest.raises(OSError):
+        storage.rename(os.path.join(root, 'missing'), os.path.join(root, 'x'))
+
+
+def test_copy_and_remove_tree(backend):
+    storage, root = backend
+    storage.mkdir(os.path.join(root, 'a', 'b'))
+    write(storage, os.path.join(root, 'a', 'f'), b'x')
+    write(storage, os.path.join(root, 'a', 'b', 'g'), b'y' * 100000)
+    assert storage.copy(os.path.join(root, 'a'), os.path.join(root, 'c')) == 2
+    assert read(storage, os.path.join(root, 'c', 'b', 'g')) == b'y' * 100000
+    assert storage.copy(os.path.join(root, 'a', 'f'), os.path.join(root, 'f')) == 1
+    storage.remove_tree(os.path.join(root, 'a'))
+    assert names(storage, root) == [('c', True), ('f', False)]
+    assert names(storage, os.path.join(root, 'c')) == [('b', True), ('f', False)]
+
+
+def test_outside_root_rejected(backend):
+    storage, root = backend
+    if storage.on_disk:
+        pytest.skip('paths are checked by the session only')
+    with pytest.raises(PermissionError):
+        storage.stat(os.path.join(os.path.dirname(root), 'secret'))
+    with pytest.raises(OSError):
+        storage.open_write(os.path.join(os.path.dirname(root), 'secret'))
+    assert not os.path.exists(os.path.join(os.path.dirname(root), 'secret'))